@@ -0,0 +1,69 @@
+"""
+Load time, peak memory and vector conversion cost of ``read_hdf5``.
+"""
+import h5py
+
+from cyrsoxs_visualizer._reader import read_hdf5, alignment_to_vectors
+
+from .common import SIZES, morphology_file
+
+
+class ReadSuite:
+    """``read_hdf5`` with its default eager/lazy choice, at full resolution
+
+    The 64^3 and 256^3 files are read eagerly, the 1024^3 file lazily.
+    Pyramids are turned off, so a sidecar left by another run doesn't turn
+    the lazy read into a multiscale one.
+    """
+    params = [SIZES]
+    param_names = ['size']
+    timeout = 3600
+
+    def setup(self, size):
+        self.path = morphology_file(size)
+
+    def time_read_hdf5(self, size):
+        read_hdf5(self.path, multiscale=False, cache=False)
+
+    def peakmem_read_hdf5(self, size):
+        read_hdf5(self.path, multiscale=False, cache=False)
+
+
+class LayoutSuite:
+    """Eager reads of a 256^3 file across HDF5 chunkings and compression"""
+    params = [['contiguous', 'planes', 'cubes'], [None, 'gzip', 'lzf']]
+    param_names = ['chunks', 'compression']
+    timeout = 600
+    chunks = {'contiguous': None, 'planes': (1, 256, 256), 'cubes': (32, 32, 32)}
+
+    def setup(self, chunks, compression):
+        if chunks == 'contiguous' and compression is not None:
+            # filters need chunked datasets
+            raise NotImplementedError
+        self.path = morphology_file(256, chunks=self.chunks[chunks], compression=compression)
+
+    def time_read_hdf5(self, chunks, compression):
+        read_hdf5(self.path, cache=False)
+
+
+class VectorSuite:
+    """Alignment field to napari vectors conversion"""
+    params = [SIZES, [0.5, 0.99]]
+    param_names = ['size', 'sparsity']
+    timeout = 3600
+
+    def setup(self, size, sparsity):
+        if size >= 1024 and sparsity < 0.99:
+            # half a billion vectors don't fit in memory
+            raise NotImplementedError
+        self.h5 = h5py.File(morphology_file(size, sparsity=sparsity), 'r')
+        self.s = self.h5['vector_morphology/Mat_1_alignment']
+
+    def teardown(self, size, sparsity):
+        self.h5.close()
+
+    def time_alignment_to_vectors(self, size, sparsity):
+        alignment_to_vectors(self.s)
+
+    def peakmem_alignment_to_vectors(self, size, sparsity):
+        alignment_to_vectors(self.s)
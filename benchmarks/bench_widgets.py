@@ -0,0 +1,98 @@
+"""
+Interaction latency of the dock widgets, in a viewer that is never shown.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+
+from cyrsoxs_visualizer._reader import read_hdf5
+
+from .common import SIZES, morphology_file
+
+
+def _viewer_with_morphology(size):
+    import napari
+
+    viewer = napari.Viewer(show=False)
+    # the 1024^3 file is read lazily, at full resolution like the smaller ones
+    for data, meta, layer_type in read_hdf5(morphology_file(size), multiscale=False, cache=False):
+        if layer_type == 'image':
+            viewer.add_image(data, **meta)
+    return viewer
+
+
+class LineProfilerSuite:
+    """``LineProfiler.profile_lines`` on eagerly and lazily read morphologies"""
+    params = [SIZES, [1, 5]]
+    param_names = ['size', 'width']
+    timeout = 3600
+
+    def setup(self, size, width):
+        from cyrsoxs_visualizer._dock_widget import LineProfiler
+
+        self.viewer = _viewer_with_morphology(size)
+        self.widget = LineProfiler(self.viewer)
+        self.widget.width_box.setValue(width)
+        self.widget.shapes_layer.data = [
+            np.array([[0.1, 0.1], [0.9, 0.8]])*size,
+            np.array([[0.9, 0.1], [0.2, 0.7]])*size,
+        ]
+        # first profile draws the axes; the timed ones are blitted
+        self.widget.profile_lines(rescale=True)
+
+    def teardown(self, size, width):
+        self.viewer.close()
+
+    def time_profile_lines(self, size, width):
+        self.widget.profile_lines()
+
+
+class ClippingPlanesSuite:
+    """A 20-step drag of the clipping plane through ``shift_plane_along_normal``
+
+    Every mouse move is followed by the plane update the frame timer would
+    run, and the drag waits for the last slabs, so the time covers the whole
+    drag as the user sees it.
+    """
+    params = [SIZES, [False, True]]
+    param_names = ['size', 'slab_mode']
+    timeout = 3600
+
+    def setup(self, size, slab_mode):
+        from cyrsoxs_visualizer._dock_widget import ClippingPlanes
+
+        self.viewer = _viewer_with_morphology(size)
+        self.viewer.dims.ndisplay = 3
+        self.widget = ClippingPlanes(self.viewer)
+        self.widget.slab_checkbox.setChecked(slab_mode)
+        self.size = size
+
+    def teardown(self, size, slab_mode):
+        self.viewer.close()
+
+    def _drag(self):
+        from qtpy.QtWidgets import QApplication
+
+        center = (self.size/2,)*3
+        self.widget.plane_parameters['position'] = center
+        self.widget._sync_planes()
+        direction = np.asarray(self.viewer.camera.view_direction)
+        event = SimpleNamespace(type='mouse_press', position=np.asarray(center) - direction,
+                                view_direction=direction, dims_displayed=[0, 1, 2],
+                                pos=np.array([0., 0.]))
+        drag = self.widget.shift_plane_along_normal(self.viewer, event)
+        next(drag)
+        event.type = 'mouse_move'
+        for step in range(1, 21):
+            event.pos = np.array([step, step], dtype=float)
+            next(drag)
+            self.widget._plane_timer.stop()
+            self.widget._apply_plane_position()
+        event.type = 'mouse_release'
+        next(drag, None)
+        # slabs are extracted on a worker thread; the drag ends when they are shown
+        while self.widget._slab_worker is not None:
+            QApplication.processEvents()
+
+    def time_shift_plane_along_normal(self, size, slab_mode):
+        self._drag()
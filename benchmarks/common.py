@@ -0,0 +1,29 @@
+"""
+Synthetic morphology files shared by the benchmarks.
+
+Files are generated on first use and kept in ``CYRSOXS_BENCH_DIR`` (default:
+a ``cyrsoxs-bench`` folder in the temp directory), so they are only written
+once per machine. The 1024^3 files take about 32 GB.
+"""
+import os
+import tempfile
+
+from cyrsoxs_visualizer._synthetic import make_morphology
+
+BENCH_DIR = os.environ.get('CYRSOXS_BENCH_DIR',
+                           os.path.join(tempfile.gettempdir(), 'cyrsoxs-bench'))
+SIZES = [64, 256, 1024]
+
+
+def morphology_file(size, num_materials=2, sparsity=0.5, chunks=None, compression=None):
+    """Path of a synthetic size^3 morphology, generated if missing"""
+    chunk_name = 'contiguous' if chunks is None else 'x'.join(map(str, chunks))
+    name = f'morphology_{size}_{num_materials}_{sparsity}_{chunk_name}_{compression}.hdf5'
+    path = os.path.join(BENCH_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        # written under a temporary name, so an interrupted run leaves no partial file
+        partial = path + '.partial'
+        make_morphology(partial, (size,)*3, num_materials, sparsity, chunks, compression)
+        os.replace(partial, path)
+    return path
@@ -1,8 +1,8 @@
 
 __version__ = "0.0.1"
 
-
-from ._reader import napari_get_reader
-from ._writer import napari_get_writer, napari_write_image
-from ._dock_widget import napari_experimental_provide_dock_widget
-from ._function import napari_experimental_provide_function
+# napari registers the hooks at startup; the modules doing the work are
+# only imported when a hook's reader, writer, widget or function is used
+from ._hooks import (napari_get_reader, napari_get_writer, napari_write_image,
+                     napari_experimental_provide_dock_widget,
+                     napari_experimental_provide_function)
@@ -0,0 +1,116 @@
+"""
+Decimated, view-dependent display of alignment vectors.
+
+An ``AlignmentIndex`` holds block-averaged copies of a material's alignment
+field at power-of-two block sizes. It is built once per material, slab by
+slab, and answers "which vectors should be drawn in this region" by reading
+only the cells that fall inside the region, at the finest block size that
+keeps the vector count under a budget.
+"""
+import numpy as np
+
+from ._pyramid import downsample
+from ._morphology import _slab_size
+
+# smallest block size kept in memory; finer levels are read from the field
+MIN_INDEX_BLOCK = 4
+
+
+def _factors(shape, block):
+    # axes of length one (2D morphologies) are never averaged over
+    return tuple(block if n > 1 else 1 for n in shape) + (1,)
+
+
+class AlignmentIndex:
+    """Block-averaged pyramid of a (Z,Y,X,D) alignment field
+
+    Parameters
+    ----------
+    field : array-like
+        Alignment field. It is only sliced, so h5py datasets and dask arrays
+        work without being loaded.
+    min_block : int
+        Block size of the finest level kept in memory. Must be a power of
+        two. Finer blocks are averaged from the field on demand.
+    """
+    def __init__(self, field, min_block=MIN_INDEX_BLOCK):
+        self.field = field
+        self.shape = tuple(field.shape[:-1])
+        self.min_block = min_block
+        self.levels = {}
+
+        # finest stored level, built slab by slab from the field
+        factors = _factors(self.shape, min_block)
+        slab = _slab_size(field.shape, field.dtype.itemsize, factors[0])
+        level = np.concatenate([
+            downsample(np.asarray(field[z0:z0+slab]), factors)
+            for z0 in range(0, self.shape[0], slab)
+        ])
+        self.levels[min_block] = level
+
+        # coarser levels are built from the previous one in memory
+        block = min_block
+        while max(level.shape[1:-1]) > 1:
+            level = downsample(level, _factors(level.shape[:-1], 2))
+            block *= 2
+            self.levels[block] = level
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels.values())
+
+    def _block_size(self, region, max_vectors):
+        block = 1
+        while True:
+            cells = np.prod([-(-(stop-start)//block) if stop-start > 1 else 1
+                             for start, stop in region])
+            if cells <= max_vectors or block >= max(self.levels):
+                return block
+            block *= 2
+
+    def query(self, region, max_vectors):
+        """Returns the decimated vectors inside ``region``
+
+        Parameters
+        ----------
+        region : sequence of (int, int)
+            Start and stop index along each spatial axis. Axes with an extent
+            of one are treated as the displayed slice, and vectors are placed
+            exactly on it.
+        max_vectors : int
+            Vector budget. The finest block size that keeps the number of
+            cells in ``region`` under this budget is used.
+
+        Returns
+        -------
+        vectors : np.ndarray
+            (N,2,D) float32 napari vectors array. Positions are block
+            centres and components are block-averaged alignment vectors,
+            scaled by the block size so they span their block.
+        """
+        region = [(max(0, int(start)), min(n, int(stop)))
+                  for (start, stop), n in zip(region, self.shape)]
+        if any(stop <= start for start, stop in region):
+            return np.empty((0, 2, len(self.shape)), dtype=np.float32)
+
+        block = self._block_size(region, max_vectors)
+        factors = _factors(self.shape, block)[:-1]
+        cells = tuple(slice(start//f, -(-stop//f)) for (start, stop), f in zip(region, factors))
+        if block in self.levels:
+            data = self.levels[block][cells]
+        else:
+            raw = tuple(slice(c.start*f, c.stop*f) for c, f in zip(cells, factors))
+            data = np.asarray(self.field[raw], dtype=np.float32)
+            if block > 1:
+                data = downsample(data, _factors(data.shape[:-1], block))
+
+        mask = np.einsum('...i,...i->...', data, data) > 0
+        vectors = np.empty((np.count_nonzero(mask), 2, len(self.shape)), dtype=np.float32)
+        idx = np.nonzero(mask)
+        for axis, ((start, stop), c, f) in enumerate(zip(region, cells, factors)):
+            if stop - start == 1:
+                vectors[:,0,axis] = start
+            else:
+                vectors[:,0,axis] = (idx[axis] + c.start)*f + (f-1)/2
+        vectors[:,1,:] = data[mask]*block
+        return vectors
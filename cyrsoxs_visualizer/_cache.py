@@ -0,0 +1,67 @@
+"""
+Process-level LRU cache with an eviction policy capped in bytes.
+"""
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'entries', 'nbytes', 'max_bytes'])
+
+
+def file_key(path):
+    """Identifies the current version of a file by path, mtime and size"""
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+class LRUCache:
+    """Least-recently-used cache holding at most ``max_bytes`` of values
+
+    Values are stored with their size in bytes. Inserting a value evicts
+    the least recently used entries until the total fits. A value larger
+    than ``max_bytes`` is not stored at all.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for ``key``, or None"""
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.nbytes + nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Hit and miss counts and resident size, like ``functools.lru_cache``"""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, len(self._entries),
+                             self.nbytes, self.max_bytes)
@@ -10,39 +10,74 @@ ClippingPlanes QWidget inspired by and adapted from
 
 https://github.com/napari/napari/blob/b39647d94e587f0255b0d4cc3087855e160a8929/examples/clipping_planes_interactive.py
 
-It implements the ``napari_experimental_provide_dock_widget`` hook specification.
+AlignmentVectors QWidget draws a decimated subsample of a material's alignment
+vectors for the current view, using an AlignmentIndex built once per material
+on a worker thread.
+
+FourierPreview QWidget shows the power spectrum and azimuthally averaged I(q)
+of the displayed slice or slab of each material, computed on a worker thread.
+
+The widgets are provided by the ``napari_experimental_provide_dock_widget``
+hook in ``_hooks``, which only imports this module when a widget is opened.
 see: https://napari.org/docs/dev/plugins/hook_specifications.html
 
 Replace code below according to your needs.
 """
-from napari_plugin_engine import napari_hook_implementation
-from qtpy.QtWidgets import QWidget, QGridLayout, QRadioButton, QPushButton, QVBoxLayout, QHBoxLayout
+import itertools
+
+from qtpy.QtWidgets import (QWidget, QGridLayout, QRadioButton, QPushButton, QVBoxLayout, QHBoxLayout,
+                            QComboBox, QSpinBox, QLabel, QFileDialog, QCheckBox)
+from qtpy.QtCore import QTimer
 from magicgui import widgets
 
-from skimage import measure
 import numpy as np
 
-import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvas
 from matplotlib.figure import Figure
 
 import napari
+from napari.qt.threading import thread_worker
+
+from ._alignment import AlignmentIndex
+from ._cache import file_key
+from ._sampling import (line_coordinates, sample_slices, sample_chunked, chunk_shape,
+                        ChunkCache, TILE, profile_coordinates, average_profiles,
+                        export_profiles, extract_slab)
+from ._trace import span, count, traced
+from ._fourier import slab_spectrum, azimuthal_average
 
 
 class LineProfiler(QWidget):
+    # ms between profile updates while dragging, about one display frame
+    frame_interval = 16
+
     # your QWidget.__init__ can optionally request the napari viewer instance
     # in one of two ways:
     # 1. use a parameter called `napari_viewer`, as done here
     # 2. use a type annotation of 'napari.viewer.Viewer' for any parameter
     def __init__(self, napari_viewer):
-        super().__init__(napari_viewer.window.qt_viewer)
+        super().__init__()
         self.viewer = napari_viewer
         self.viewer.axes.visible = True
         self.viewer.dims.axis_labels = ('y','x')
         self.canvas = FigureCanvas(Figure(figsize=(2,4)))
         self.ax = self.canvas.figure.subplots()
+        self._background = None
+        self._chunk_caches = {}
+        self.canvas.mpl_connect('draw_event', self._on_canvas_draw)
+        self._profile_timer = QTimer()
+        self._profile_timer.setSingleShot(True)
+        self._profile_timer.timeout.connect(self.profile_lines)
         self.layout = QGridLayout()
-        self.layout.addWidget(self.canvas)
+        self.layout.addWidget(self.canvas, 0, 0, 1, 3)
+        self.width_box = QSpinBox()
+        self.width_box.setRange(1, 100)
+        self.width_box.setPrefix('Width: ')
+        self.width_box.valueChanged.connect(lambda: self.profile_lines(rescale=True))
+        self.layout.addWidget(self.width_box, 1, 0)
+        self.export_button = QPushButton('Export Profiles')
+        self.export_button.clicked.connect(self._export_profiles)
+        self.layout.addWidget(self.export_button, 1, 2)
         self.setLayout(self.layout)
 
         self.shapes_layer = self.viewer.add_shapes(
@@ -70,75 +105,182 @@ class LineProfiler(QWidget):
         # napari.utils.events.connect(self.print_event)
 
         self.lines = []
+        self.profiles = {}
         self.profile_lines()
 
-    def _get_line(self):
-        line = None
+    def _get_lines(self):
+        """End points of every line in the last Shapes layer that has lines"""
+        lines = []
         for layer in self.viewer.layers:
             if isinstance(layer, napari.layers.Shapes):
-                try:
-                    line = layer.data[-1]
-                except IndexError:
-                    pass
-        return line        
+                layer_lines = [np.asarray(data)[[0,-1],-2:]
+                               for data, shape_type in zip(layer.data, layer.shape_type)
+                               if shape_type == 'line']
+                if layer_lines:
+                    lines = layer_lines
+        return lines
     
+    def get_slice_axes(self, ndim):
+        """Sliced axes of an ``ndim`` image and the displayed index along each
+
+        Layers line up with the viewer's last dimensions, so (N,Z,Y,X)
+        stacks, (Z,Y,X) volumes and 2D images can be profiled together.
+        Both tuples are empty for 2D images.
+        """
+        offset = self.viewer.dims.ndim - ndim
+        displayed = [axis - offset for axis in list(self.viewer.dims.displayed)[-2:]]
+        axes = tuple(axis for axis in range(ndim) if axis not in displayed)
+        return axes, tuple(int(self.viewer.dims.current_step[axis + offset]) for axis in axes)
+
+    def get_slice(self, image):
+        """The 2D slice of ``image`` currently displayed"""
+        index = [slice(None)]*image.ndim
+        for axis, slice_nr in zip(*self.get_slice_axes(image.ndim)):
+            index[axis] = slice_nr
+        return image[tuple(index)]
+
     def get_line_data(self, image, start, end):
-        if image.ndim == 2:
-            return measure.profile_line(image, start, end, mode='reflect')
-        else:
-            displayed = list(self.viewer.dims.displayed)
-            remaining_dim = [x for x in [0,1,2] if x not in displayed]
-            slice_nr = self.viewer.dims.current_step[remaining_dim[0]]
-            if remaining_dim[0] == 0:
-                line_data = measure.profile_line(image[slice_nr,:,:], start, end, mode='reflect')
-            elif remaining_dim[0] == 1:
-                line_data = measure.profile_line(image[:,slice_nr,:], start, end, mode='reflect')
-            elif remaining_dim[0] == 2:
-                line_data = measure.profile_line(image[:,:,slice_nr], start, end, mode='reflect')
-            return line_data
+        return sample_slices([self.get_slice(image)], line_coordinates(start, end))[0]
     
     def get_image_layers(self):
         return [layer for layer in self.viewer.layers if isinstance(layer, napari.layers.Image)]
 
-    def profile_lines(self):
-        line = self._get_line()
-        if line is None:
+    def get_layer_data(self, layer):
+        """Full resolution data of an image layer"""
+        return layer.data[0] if layer.multiscale else layer.data
+
+    def get_chunk_cache(self, layer):
+        """Tile cache of a lazy layer's displayed slice
+
+        Tiles are one voxel thick across the slice, and the cache is
+        replaced when the data or the displayed slice changes.
+        """
+        data = self.get_layer_data(layer)
+        axes, slice_nrs = self.get_slice_axes(data.ndim)
+        key = (id(data), axes, slice_nrs)
+        if layer not in self._chunk_caches or self._chunk_caches[layer][0] != key:
+            tile = [min(c, TILE) for c in chunk_shape(data)]
+            for axis in axes:
+                tile[axis] = 1
+            self._chunk_caches[layer] = (key, ChunkCache(data, tile))
+        return self._chunk_caches[layer][1]
+
+    def sample_layers(self, layers, coords):
+        """Profiles of each layer at the slice coordinates ``coords``"""
+        in_memory = [layer for layer in layers if isinstance(self.get_layer_data(layer), np.ndarray)]
+        # one set of interpolation weights for all in-memory layers
+        profiles = dict(zip(in_memory,
+                            sample_slices([self.get_slice(self.get_layer_data(layer)) for layer in in_memory],
+                                          coords)))
+        # lazy layers only read the tiles under the line
+        for layer in layers:
+            if layer not in profiles:
+                data = self.get_layer_data(layer)
+                profiles[layer] = sample_chunked(self.get_chunk_cache(layer), coords,
+                                                 *self.get_slice_axes(data.ndim))
+        return profiles
+
+    @traced('LineProfiler.profile_lines')
+    def profile_lines(self, rescale=False):
+        lines = self._get_lines()
+        if not lines:
             return
         image_layers = self.get_image_layers()
+        visible_layers = [layer for layer in image_layers if layer.visible]
+        # every line, across its width, for every layer in one coordinate map
+        with span('sample profiles', lines=len(lines), layers=len(visible_layers)):
+            coords, lengths = profile_coordinates(lines, self.width_box.value())
+            self.profiles = {layer.name: average_profiles(values, lengths)
+                             for layer, values in self.sample_layers(visible_layers, coords).items()}
+        x = np.arange(coords.shape[-1])
         for j, selected_layer in enumerate(image_layers):
-            if selected_layer.visible != 0:
-                y = self.get_line_data(selected_layer.data,*line)
-                x = np.arange(len(y))
-                try:
-                    self.lines[j][0].set_data(x,y)
-                    self.lines[j][0].set_label(selected_layer.name)
-                except IndexError:
-                    self.lines.append(self.ax.plot(self.get_line_data(selected_layer.data,*line),
-                                                label=selected_layer.name))
-            elif selected_layer.visible == 0:
-                x = []
-                y = []
-                self.lines[j][0].set_data(x,y)
-        
-        self.ax.relim()
-        self.ax.legend()
-        self.ax.autoscale_view()
-        self.canvas.draw()
-    
+            table = self.profiles.get(selected_layer.name, [])
+            try:
+                layer_lines = self.lines[j]
+            except IndexError:
+                layer_lines = []
+                self.lines.append(layer_lines)
+            # one plot line per profile, and at least one per layer
+            while len(layer_lines) < max(len(table), 1):
+                layer_lines.extend(self.ax.plot([], [], animated=True))
+                rescale = True
+            while len(layer_lines) > max(len(table), 1):
+                layer_lines.pop().remove()
+                rescale = True
+            for k, plot_line in enumerate(layer_lines):
+                if k < len(table):
+                    plot_line.set_data(x, table[k])
+                    rescale = rescale or not self._within_limits(table[k])
+                else:
+                    plot_line.set_data([], [])
+                label = selected_layer.name if len(table) <= 1 else f'{selected_layer.name} [{k}]'
+                if plot_line.get_label() != label:
+                    plot_line.set_label(label)
+                    rescale = True
+        self._draw(rescale)
+
+    def _within_limits(self, y):
+        if np.all(np.isnan(y)):
+            return True
+        xmin, xmax = self.ax.get_xlim()
+        ymin, ymax = self.ax.get_ylim()
+        return np.count_nonzero(~np.isnan(y))-1 <= xmax and ymin <= np.nanmin(y) and np.nanmax(y) <= ymax
+
+    def _export_profiles(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Profiles', 'profiles.csv',
+                                              'CSV (*.csv);;NumPy (*.npz)')
+        if path:
+            export_profiles(path, self.profiles)
+
+    def _draw(self, rescale=False):
+        """Redraws the profiles, blitting them onto the cached background
+
+        The axes, ticks and legend are only redrawn when the profiles no
+        longer fit in the current limits or the set of lines changed.
+        """
+        if rescale or self._background is None:
+            with span('canvas draw'):
+                self.ax.relim()
+                self.ax.legend()
+                self.ax.autoscale_view()
+                # the draw_event handler caches the new background
+                self.canvas.draw()
+            return
+        with span('canvas blit'):
+            self.canvas.restore_region(self._background)
+            for line in self.ax.lines:
+                self.ax.draw_artist(line)
+            self.canvas.blit(self.ax.bbox)
+
+    def _on_canvas_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        for line in self.ax.lines:
+            self.ax.draw_artist(line)
+
+    def _schedule_profile(self):
+        # coalesce mouse moves into at most one profile per display frame
+        if not self._profile_timer.isActive():
+            self._profile_timer.start(self.frame_interval)
     
     def _remove_extra_lines(self, event):
         if len(self.lines) > len(self.get_image_layers()):
-            self.lines.pop(-1)
-            self.ax.lines.pop(-1)
+            for plot_line in self.lines.pop(-1):
+                plot_line.remove()
+        for layer in list(self._chunk_caches):
+            if layer not in self.viewer.layers:
+                del self._chunk_caches[layer]
 
-        self.profile_lines()
+        self.profile_lines(rescale=True)
 
+    @traced('LineProfiler drag')
     def _profile_lines_drag(self, layer, event):
         self.profile_lines()
         yield
         while event.type =='mouse_move':
-            self.profile_lines()
+            self._schedule_profile()
             yield
+        self._profile_timer.stop()
+        self.profile_lines(rescale=True)
     
     def _update_visibility(self, event):
         # print('entered visibility function')
@@ -154,10 +296,31 @@ class LineProfiler(QWidget):
     #     print(event, event.type)
 
 
+@thread_worker
+def _extract_slabs(caches, position, normal, thickness):
+    """(slab, affine) of each cached volume, off the GUI thread"""
+    with span('extract slabs', layers=len(caches)):
+        return [extract_slab(cache, position, normal, thickness) for cache in caches]
+
+
 class ClippingPlanes(QWidget):
+    # ms between plane updates while dragging, about one display frame
+    frame_interval = 16
+    # tiles kept per layer in slab mode, so a moving plane reuses them
+    slab_cache_bytes = 2**28
+
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
+        self._pending_position = None
+        self._plane_timer = QTimer()
+        self._plane_timer.setSingleShot(True)
+        self._plane_timer.timeout.connect(self._apply_plane_position)
+        # source image layer -> slab layer, and the tile caches slabs are read through
+        self.slab_layers = {}
+        self._slab_caches = {}
+        self._slab_worker = None
+        self._slabs_pending = False
         self.viewer.axes.visible = True
         self.viewer.camera.angles = (45, 45, 45)
         self.viewer.dims.axis_labels = ('z','y','x')
@@ -183,13 +346,22 @@ class ClippingPlanes(QWidget):
         self.visible_button.setText('Make Clipping Plane Invisible')
         self.visible_button.clicked.connect(self._update_clipping_visibility)
         self.layout.addWidget(self.visible_button)
+        self.slab_checkbox = QCheckBox('Slab Mode')
+        self.slab_checkbox.toggled.connect(self._toggle_slab_mode)
+        self.layout.addWidget(self.slab_checkbox)
+        self.slab_thickness = QSpinBox()
+        self.slab_thickness.setRange(1, 1024)
+        self.slab_thickness.setValue(16)
+        self.slab_thickness.setPrefix('Slab Thickness: ')
+        self.slab_thickness.valueChanged.connect(self.update_slabs)
+        self.layout.addWidget(self.slab_thickness)
         self.layout.addStretch()
         self.setLayout(self.layout)
 
         self.viewer.mouse_drag_callbacks.append(self.shift_plane_along_normal)
         self.viewer.layers.events.connect(self._on_load)
 
-        for layer in self.viewer.layers:
+        for layer in self.get_clipped_layers():
             layer.experimental_clipping_planes = self.plane_parameters
 
     def point_in_bounding_box(self, point, bounding_box):
@@ -198,9 +370,15 @@ class ClippingPlanes(QWidget):
         return False
 
     def get_image_layers(self):
-        return [layer for layer in self.viewer.layers if isinstance(layer, napari.layers.Image)]
+        return [layer for layer in self.get_clipped_layers() if isinstance(layer, napari.layers.Image)]
+
+    def get_clipped_layers(self):
+        """Every layer but the slab layers, which are already cut to the plane"""
+        slabs = list(self.slab_layers.values())
+        return [layer for layer in self.viewer.layers if layer not in slabs]
 
 
+    @traced('ClippingPlanes drag')
     def shift_plane_along_normal(self, viewer, event):
         """Shift a plane along its normal vector on mouse drag.
         This callback will shift a plane along its normal vector when the plane is
@@ -232,10 +410,17 @@ class ClippingPlanes(QWidget):
             event.dims_displayed,
         )
 
+        # the plane as this widget last set it; layers it skipped may lag behind
+        plane_position = np.array(self.plane_parameters['position'], dtype=float)
+        plane_normal = np.array(self.plane_parameters['normal'], dtype=float)
+        plane_normal /= np.linalg.norm(plane_normal)
+
         # Calculate intersection of click with plane through data
-        intersection = self.volume_layer.experimental_clipping_planes[0].intersect_with_line(
-            line_position=near_point, line_direction=event.view_direction
-        )
+        view_direction = np.asarray(event.view_direction, dtype=float)
+        denominator = view_direction @ plane_normal
+        if near_point is None or denominator == 0:
+            return
+        intersection = near_point + view_direction*((plane_position - near_point) @ plane_normal)/denominator
 
         # Check if click was on plane by checking if intersection occurs within
         # data bounding box. If so, exit early.
@@ -243,8 +428,8 @@ class ClippingPlanes(QWidget):
             return
 
         # Get plane parameters in vispy coordinates (zyx -> xyz)
-        plane_normal_data_vispy = np.array(self.volume_layer.experimental_clipping_planes[0].normal)[[2, 1, 0]]
-        plane_position_data_vispy = np.array(self.volume_layer.experimental_clipping_planes[0].position)[[2, 1, 0]]
+        plane_normal_data_vispy = plane_normal[[2, 1, 0]]
+        plane_position_data_vispy = plane_position[[2, 1, 0]]
 
         # Get transform which maps from data (vispy) to canvas
         visual2canvas = self.viewer.window.qt_viewer.layer_to_visual[self.volume_layer].node.get_transform(
@@ -266,7 +451,7 @@ class ClippingPlanes(QWidget):
             layer.interactive = False
 
         # Store original plane position and start position in canvas coordinates
-        original_plane_position = self.volume_layer.experimental_clipping_planes[0].position
+        original_plane_position = plane_position
         start_position_canv = event.pos
 
         yield
@@ -286,39 +471,173 @@ class ClippingPlanes(QWidget):
             # Update position of plane according to drag vector
             # only update if plane position is within data bounding box
             drag_distance_data = drag_projection_on_plane_normal / np.linalg.norm(plane_normal_canv)
-            updated_position = original_plane_position + drag_distance_data * np.array(
-                self.volume_layer.experimental_clipping_planes[0].normal)
+            updated_position = original_plane_position + drag_distance_data * plane_normal
 
             if self.point_in_bounding_box(updated_position, self.volume_layer.extent.data):
-                for layer in viewer.layers:
-                    layer.experimental_clipping_planes[0].position = updated_position
+                self._pending_position = updated_position
+                self._schedule_plane_update()
 
             yield
 
+        # apply the last position right away
+        self._plane_timer.stop()
+        self._apply_plane_position()
+
         # Re-enable
         for layer in self.viewer.layers:
             layer.interactive = True
-    
+
+    def _schedule_plane_update(self):
+        # coalesce mouse moves into at most one plane update per display frame
+        if not self._plane_timer.isActive():
+            self._plane_timer.start(self.frame_interval)
+
+    def plane_side(self, layer, position, normal):
+        """Side of the plane a layer's bounding box is on
+
+        Returns 1 or -1 if the whole box is on the positive or negative side
+        of the plane through ``position``, and 0 if the plane cuts the box.
+        """
+        box = np.asarray(layer.extent.data)
+        if box.shape[1] != len(position):
+            return 0
+        corners = np.array(list(itertools.product(*box.T)))
+        distance = (corners - position) @ np.asarray(normal)
+        if np.all(distance >= 0):
+            return 1
+        if np.all(distance <= 0):
+            return -1
+        return 0
+
+    @traced('ClippingPlanes.apply_plane_position')
+    def _apply_plane_position(self):
+        """Moves the clipping plane to the pending position
+
+        The position is kept in ``plane_parameters``. Layers the plane stays
+        clear of, on the same side as before, look the same wherever the
+        plane is, so their planes are not updated and they are not
+        re-rendered. ``_sync_planes`` brings them back in line.
+        """
+        position = self._pending_position
+        if position is None:
+            return
+        self._pending_position = None
+        old_position = self.plane_parameters['position']
+        normal = self.plane_parameters['normal']
+        self.plane_parameters['position'] = tuple(float(x) for x in position)
+        for layer in self.get_clipped_layers():
+            old_side = self.plane_side(layer, old_position, normal)
+            if old_side != 0 and old_side == self.plane_side(layer, position, normal):
+                continue
+            layer.experimental_clipping_planes[0].position = position
+        self.update_slabs()
+
+    def _sync_planes(self):
+        """Gives every layer the plane in ``plane_parameters``"""
+        for layer in self.get_clipped_layers():
+            plane = layer.experimental_clipping_planes[0]
+            plane.position = self.plane_parameters['position']
+            plane.normal = self.plane_parameters['normal']
+            plane.enabled = self.plane_parameters['enabled']
+
+    def _toggle_slab_mode(self, checked):
+        """Swaps the full volumes for slabs around the plane, and back
+
+        In slab mode only a slab of the chosen thickness around the plane is
+        read, through the layer's lazy data, and uploaded to the GPU. Tiles
+        read for one plane position are reused as the plane moves.
+        """
+        if checked:
+            for layer in self.get_image_layers():
+                layer.visible = False
+            self.update_slabs()
+        else:
+            for source, slab_layer in list(self.slab_layers.items()):
+                self.slab_layers.pop(source)
+                if slab_layer in self.viewer.layers:
+                    self.viewer.layers.remove(slab_layer)
+                if source in self.viewer.layers:
+                    source.visible = True
+            self._slab_caches.clear()
+
+    def update_slabs(self):
+        """Re-extracts the slabs for the current plane on a worker thread
+
+        While an extraction runs, plane moves only mark the slabs as stale,
+        and one more extraction for the latest plane follows, so dragging
+        never queues up work or blocks the viewer.
+        """
+        if not self.slab_checkbox.isChecked():
+            return
+        self._slabs_pending = True
+        if self._slab_worker is None:
+            self._start_slab_update()
+
+    def _start_slab_update(self):
+        self._slabs_pending = False
+        layers = []
+        for layer in self.get_image_layers():
+            data = layer.data[0] if layer.multiscale else layer.data
+            if data.ndim != 3:
+                continue
+            if layer not in self._slab_caches or self._slab_caches[layer].data is not data:
+                cache = ChunkCache(data)
+                tile_bytes = np.prod(cache.tile)*np.dtype(data.dtype).itemsize
+                cache.max_tiles = max(cache.max_tiles, int(self.slab_cache_bytes // tile_bytes))
+                self._slab_caches[layer] = cache
+            layers.append(layer)
+        if not layers:
+            return
+        self._slab_worker = _extract_slabs([self._slab_caches[layer] for layer in layers],
+                                           self.plane_parameters['position'],
+                                           self.plane_parameters['normal'],
+                                           self.slab_thickness.value())
+        self._slab_worker.returned.connect(lambda slabs: self._show_slabs(layers, slabs))
+        self._slab_worker.finished.connect(self._on_slabs_finished)
+        self._slab_worker.start()
+
+    def _on_slabs_finished(self):
+        self._slab_worker = None
+        if self._slabs_pending:
+            self._start_slab_update()
+
+    @traced('ClippingPlanes.show_slabs')
+    def _show_slabs(self, layers, slabs):
+        if not self.slab_checkbox.isChecked():
+            return
+        for layer, (slab, affine) in zip(layers, slabs):
+            if layer not in self.viewer.layers:
+                continue
+            if layer in self.slab_layers:
+                self.slab_layers[layer].data = slab
+                self.slab_layers[layer].affine = affine
+            else:
+                self.slab_layers[layer] = self.viewer.add_image(
+                    slab, name=f'{layer.name} slab', affine=affine,
+                    colormap=layer.colormap, contrast_limits=layer.contrast_limits,
+                    blending=layer.blending)
+                # _on_load clipped it on insertion, but a slab is already cut to the plane
+                self.slab_layers[layer].experimental_clipping_planes = []
 
     def _update_plane_normal(self):
         rbtn = self.sender()
 
         if rbtn.isChecked() == True:
             self.plane_parameters['normal'] = self.choices[rbtn.text()]
-            for layer in self.viewer.layers:
-                layer.experimental_clipping_planes[0].normal = self.choices[rbtn.text()]
+            self._sync_planes()
+            self.update_slabs()
             # print(self.plane_parameters['normal'])
     
     def _update_clipping_visibility(self):
         if self.plane_parameters['enabled']:
             self.plane_parameters['enabled'] = False
             self.visible_button.setText('Make Clipping Plane Visible')
-            for layer in self.viewer.layers:
+            for layer in self.get_clipped_layers():
                 layer.experimental_clipping_planes[0].enabled = False
         else:
             self.plane_parameters['enabled'] = True
             self.visible_button.setText('Make Clipping Plane Invisible')
-            for layer in self.viewer.layers:
+            for layer in self.get_clipped_layers():
                 layer.experimental_clipping_planes[0].enabled = True
         
         # print(self.plane_parameters['enabled'])
@@ -328,14 +647,268 @@ class ClippingPlanes(QWidget):
     
     def _on_load(self, event):
         if event.type == 'inserted':
-            for layer in self.viewer.layers:
+            for layer in self.get_clipped_layers():
                 layer.experimental_clipping_planes = self.plane_parameters
+        elif event.type == 'removed':
+            for source in list(self.slab_layers):
+                if source not in self.viewer.layers or self.slab_layers[source] not in self.viewer.layers:
+                    slab_layer = self.slab_layers.pop(source)
+                    self._slab_caches.pop(source, None)
+                    if slab_layer in self.viewer.layers:
+                        self.viewer.layers.remove(slab_layer)
+
+
+
+
+class AlignmentVectors(QWidget):
+    """Shows the alignment vectors of one material, decimated to the view
+
+    Works on image layers that carry their alignment field in
+    ``layer.metadata['alignment']``, as lazily read morphologies do. The
+    vectors are re-queried whenever the camera or the displayed slice
+    changes, and updates are coalesced to one per event loop pass. A
+    material's index is built on a worker thread the first time it is shown,
+    and kept per file version and dataset, see ``index_key``.
+    """
+    def __init__(self, napari_viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+        self.indexes = {}
+        self._workers = {}
+        self.vectors_layer = None
+
+        self.layout = QVBoxLayout()
+        self.layer_combo = QComboBox()
+        self.layer_combo.currentTextChanged.connect(self._schedule_update)
+        self.layout.addWidget(QLabel('Material'))
+        self.layout.addWidget(self.layer_combo)
+        self.max_vectors = QSpinBox()
+        self.max_vectors.setRange(100, 10**6)
+        self.max_vectors.setSingleStep(1000)
+        self.max_vectors.setValue(20000)
+        self.max_vectors.valueChanged.connect(self._schedule_update)
+        self.layout.addWidget(QLabel('Vectors per view'))
+        self.layout.addWidget(self.max_vectors)
+        self.layout.addStretch()
+        self.setLayout(self.layout)
+
+        self._update_timer = QTimer()
+        self._update_timer.setSingleShot(True)
+        self._update_timer.timeout.connect(self.update_vectors)
+
+        self.viewer.camera.events.zoom.connect(self._schedule_update)
+        self.viewer.camera.events.center.connect(self._schedule_update)
+        self.viewer.dims.events.current_step.connect(self._schedule_update)
+        self.viewer.dims.events.ndisplay.connect(self._schedule_update)
+        self.viewer.layers.events.inserted.connect(self._refresh_layers)
+        self.viewer.layers.events.removed.connect(self._refresh_layers)
+        self._refresh_layers()
+
+    def get_alignment_layers(self):
+        return [layer for layer in self.viewer.layers
+                if isinstance(layer, napari.layers.Image) and 'alignment' in layer.metadata]
+
+    def _refresh_layers(self, event=None):
+        names = [layer.name for layer in self.get_alignment_layers()]
+        current = self.layer_combo.currentText()
+        self.layer_combo.blockSignals(True)
+        self.layer_combo.clear()
+        self.layer_combo.addItems(names)
+        if current in names:
+            self.layer_combo.setCurrentText(current)
+        self.layer_combo.blockSignals(False)
+        if self.vectors_layer is not None and self.vectors_layer not in self.viewer.layers:
+            self.vectors_layer = None
+        self._schedule_update()
+
+    def _schedule_update(self, event=None):
+        self._update_timer.start(0)
+
+    def index_key(self, layer):
+        """Key of a layer's index: the file version and alignment dataset
+        for layers read from a file, the field itself for the others"""
+        metadata = layer.metadata
+        if 'path' in metadata and 'alignment_dataset' in metadata:
+            return file_key(metadata['path']), metadata['alignment_dataset']
+        # the index references its field, so the id is not reused while cached
+        return id(metadata['alignment'])
+
+    def get_index(self, layer):
+        """The layer's index, or None while it is being built
+
+        Built once per material on a worker thread, then reused for every
+        view change; the vectors are updated when it is ready.
+        """
+        key = self.index_key(layer)
+        if key in self.indexes:
+            return self.indexes[key]
+        if key not in self._workers:
+            worker = _build_index(layer.metadata['alignment'])
+            worker.returned.connect(lambda index: self._on_index(key, index))
+            worker.finished.connect(lambda: self._workers.pop(key, None))
+            self._workers[key] = worker
+            worker.start()
+        return None
+
+    def _on_index(self, key, index):
+        self.indexes[key] = index
+        self._schedule_update()
+
+    def visible_region(self, shape):
+        """Index bounds of the part of a volume of ``shape`` in view"""
+        region = [(0, n) for n in shape]
+        if self.viewer.dims.ndisplay == 3:
+            return region
+        displayed = list(self.viewer.dims.displayed)
+        for axis in range(len(shape)):
+            if axis not in displayed:
+                step = int(self.viewer.dims.current_step[axis])
+                region[axis] = (step, step+1)
+        center = np.array(self.viewer.camera.center[-2:])
+        half_size = np.array(self.viewer.window.qt_viewer.canvas.size)/self.viewer.camera.zoom/2
+        for axis, c, h in zip(displayed, center, half_size):
+            region[axis] = (int(np.floor(c-h)), int(np.ceil(c+h))+1)
+        return region
+
+    @traced('AlignmentVectors.update_vectors')
+    def update_vectors(self):
+        name = self.layer_combo.currentText()
+        if not name or name not in self.viewer.layers:
+            return
+        index = self.get_index(self.viewer.layers[name])
+        if index is None:
+            return
+        vectors = index.query(self.visible_region(index.shape), self.max_vectors.value())
+        count('vectors drawn', len(vectors))
+        if self.vectors_layer is None:
+            self.vectors_layer = self.viewer.add_vectors(
+                vectors, name=f'{name} alignment', edge_width=0.1)
+        else:
+            self.vectors_layer.data = vectors
+            self.vectors_layer.name = f'{name} alignment'
+
+
+@thread_worker
+def _build_index(field):
+    """AlignmentIndex of a field, off the GUI thread"""
+    with span('alignment index'):
+        return AlignmentIndex(field)
 
 
+@thread_worker
+def _compute_spectra(volumes, axis, index, thickness):
+    """(power spectrum, q, I(q)) of each volume's slab, off the GUI thread"""
+    results = []
+    for volume in volumes:
+        with span('power spectrum'):
+            spectrum = slab_spectrum(volume, axis, index, thickness)
+            q, intensity = azimuthal_average(spectrum)
+        results.append((spectrum, q, intensity))
+    return results
 
 
-@napari_hook_implementation
-def napari_experimental_provide_dock_widget():
-    # you can return either a single widget, or a sequence of widgets
-    return [(LineProfiler, {'area':'bottom','name':'Line Profiler'}),
-            (ClippingPlanes, {'area':'right','name':'3D Clipping Plane'})]
+class FourierPreview(QWidget):
+    """Power spectrum and azimuthally averaged I(q) of the displayed slice
+
+    The spectra of every visible image layer are computed on a worker
+    thread. While a computation runs, slice changes only mark the preview
+    as stale, and one more computation for the latest slice follows, so
+    scrolling never queues up work or blocks the viewer.
+    """
+    def __init__(self, napari_viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+        self._worker = None
+        self._pending = False
+        self.canvas = FigureCanvas(Figure(figsize=(4,2)))
+        self.ax_spectrum, self.ax_profile = self.canvas.figure.subplots(1, 2)
+        self.ax_spectrum.set_axis_off()
+        self.ax_profile.set_xlabel('q (1/voxel)')
+        self.ax_profile.set_ylabel('I(q)')
+        self._spectrum_image = None
+
+        self.layout = QGridLayout()
+        self.layout.addWidget(self.canvas, 0, 0, 1, 2)
+        self.layer_combo = QComboBox()
+        self.layer_combo.currentTextChanged.connect(self._schedule_update)
+        self.layout.addWidget(self.layer_combo, 1, 0)
+        self.thickness = QSpinBox()
+        self.thickness.setRange(1, 1024)
+        self.thickness.setPrefix('Slab Thickness: ')
+        self.thickness.valueChanged.connect(self._schedule_update)
+        self.layout.addWidget(self.thickness, 1, 1)
+        self.setLayout(self.layout)
+
+        self.viewer.dims.events.current_step.connect(self._schedule_update)
+        self.viewer.dims.events.order.connect(self._schedule_update)
+        self.viewer.layers.events.connect(self._on_layers_change)
+        self._refresh_layers()
+
+    def get_image_layers(self):
+        return [layer for layer in self.viewer.layers
+                if isinstance(layer, napari.layers.Image) and layer.visible
+                and layer.ndim in (2, 3) and not layer.rgb]
+
+    def _refresh_layers(self):
+        names = [layer.name for layer in self.get_image_layers()]
+        current = self.layer_combo.currentText()
+        self.layer_combo.blockSignals(True)
+        self.layer_combo.clear()
+        self.layer_combo.addItems(names)
+        if current in names:
+            self.layer_combo.setCurrentText(current)
+        self.layer_combo.blockSignals(False)
+        self._schedule_update()
+
+    def _on_layers_change(self, event):
+        if event.type in ('inserted', 'removed', 'visible', 'set_data'):
+            self._refresh_layers()
+
+    def _schedule_update(self, event=None):
+        self._pending = True
+        if self._worker is None:
+            self._start_update()
+
+    def _start_update(self):
+        self._pending = False
+        layers = self.get_image_layers()
+        if not layers:
+            return
+        # the sliced axis is the first in the dims order, as in 2D display
+        axis = self.viewer.dims.order[0]
+        index = self.viewer.dims.current_step[axis]
+        volumes = [layer.data[0] if layer.multiscale else layer.data for layer in layers]
+        names = [layer.name for layer in layers]
+        self._worker = _compute_spectra(volumes, axis, index, self.thickness.value())
+        self._worker.returned.connect(lambda results: self._show(names, results))
+        self._worker.finished.connect(self._on_finished)
+        self._worker.start()
+
+    def _on_finished(self):
+        self._worker = None
+        if self._pending:
+            self._start_update()
+
+    @traced('FourierPreview.show')
+    def _show(self, names, results):
+        selected = self.layer_combo.currentText()
+        for line in list(self.ax_profile.lines):
+            line.remove()
+        for name, (spectrum, q, intensity) in zip(names, results):
+            # q = 0 is removed with the mean
+            self.ax_profile.loglog(q[1:], intensity[1:], label=name)
+            if name == selected or (selected not in names and name == names[0]):
+                log_spectrum = np.log10(spectrum + np.finfo(np.float32).tiny)
+                if self._spectrum_image is None or self._spectrum_image.get_array().shape != spectrum.shape:
+                    self.ax_spectrum.clear()
+                    self.ax_spectrum.set_axis_off()
+                    self._spectrum_image = self.ax_spectrum.imshow(log_spectrum, cmap='magma')
+                else:
+                    self._spectrum_image.set_data(log_spectrum)
+                finite = log_spectrum[np.isfinite(log_spectrum)]
+                self._spectrum_image.set_clim(np.percentile(finite, [1, 99.9]))
+                self.ax_spectrum.set_title(name, fontsize='small')
+        self.ax_profile.relim()
+        self.ax_profile.autoscale_view()
+        self.ax_profile.legend(fontsize='small')
+        self.canvas.draw_idle()
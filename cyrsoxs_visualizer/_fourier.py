@@ -0,0 +1,105 @@
+"""
+Power spectra of morphology slices, used by the FourierPreview widget.
+
+The radial bin index map used for azimuthal averaging depends only on the
+image shape, so it is computed once per shape and reused. FFTs go through
+``scipy.fft`` when it is installed, which caches its plans per shape and
+runs batched transforms on several threads, and ``numpy.fft`` otherwise.
+"""
+import functools
+import os
+
+import numpy as np
+
+try:
+    import scipy.fft as _fft
+    _FFT_OPTIONS = {'workers': os.cpu_count() or 1}
+except ImportError:
+    import numpy.fft as _fft
+    _FFT_OPTIONS = {}
+
+
+@functools.lru_cache(maxsize=16)
+def radial_bins(shape):
+    """Radial bin of each frequency of an fftshifted spectrum of ``shape``
+
+    Bins are ``1/max(shape)`` cycles per voxel wide, the frequency spacing
+    along the longest axis.
+
+    Returns
+    -------
+    index : np.ndarray
+        Flat bin index of each frequency, ``shape`` raveled.
+    counts : np.ndarray
+        Number of frequencies in each bin.
+    q : np.ndarray
+        Centre of each bin, in cycles per voxel.
+    """
+    freqs = [np.fft.fftshift(np.fft.fftfreq(n)) for n in shape]
+    q = np.sqrt(sum(f**2 for f in np.meshgrid(*freqs, indexing='ij', sparse=True)))
+    width = 1/max(shape)
+    index = np.floor(q/width).astype(np.intp).ravel()
+    counts = np.bincount(index)
+    centres = (np.arange(len(counts)) + 0.5)*width
+    for array in (index, counts, centres):
+        array.flags.writeable = False
+    return index, counts, centres
+
+
+def power_spectrum(images):
+    """Mean fftshifted power spectrum of a stack of 2D images
+
+    Parameters
+    ----------
+    images : np.ndarray
+        (..., Y, X) images. Each image's mean is removed first, so the
+        q = 0 peak doesn't swamp the rest of the spectrum.
+
+    Returns
+    -------
+    np.ndarray
+        (Y, X) float32 power spectrum, averaged over the leading axes.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    images = images.reshape((-1,) + images.shape[-2:])
+    images = images - images.mean(axis=(-2, -1), keepdims=True)
+    spectra = np.abs(_fft.fft2(images, **_FFT_OPTIONS))**2
+    return np.fft.fftshift(spectra.mean(axis=0)).astype(np.float32)
+
+
+def azimuthal_average(spectrum):
+    """(q, I(q)) of a 2D fftshifted power spectrum, with bins from ``radial_bins``"""
+    index, counts, q = radial_bins(spectrum.shape)
+    intensity = np.bincount(index, weights=spectrum.ravel(), minlength=len(counts))
+    return q, intensity/np.maximum(counts, 1)
+
+
+def slab_spectrum(volume, axis, index, thickness=1):
+    """Power spectrum of a slab of planes across ``axis`` of a 3D volume
+
+    Parameters
+    ----------
+    volume : array-like
+        3D array; lazy arrays only have the slab read. 2D arrays are used
+        as they are.
+    axis : int
+        Axis across the planes.
+    index : int
+        Central plane of the slab.
+    thickness : int
+        Number of planes averaged, centred on ``index`` and clipped to the
+        volume.
+
+    Returns
+    -------
+    np.ndarray
+        (H, W) power spectrum, see ``power_spectrum``.
+    """
+    if volume.ndim == 2:
+        return power_spectrum(volume)
+    start = int(np.clip(index - (thickness-1)//2, 0, volume.shape[axis]-1))
+    stop = int(np.clip(start + thickness, start+1, volume.shape[axis]))
+    region = [slice(None)]*volume.ndim
+    region[axis] = slice(start, stop)
+    slab = np.asarray(volume[tuple(region)])
+    return power_spectrum(np.moveaxis(slab, axis, 0))
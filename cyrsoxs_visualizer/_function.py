@@ -1,37 +1,230 @@
 """
 This module is an example of a barebones function plugin for napari
 
-It implements the ``napari_experimental_provide_function`` hook specification.
+The functions are provided by the ``napari_experimental_provide_function``
+hook in ``_hooks``. Only NumPy is imported with this module; h5py and the
+reader and writer are imported when a function needs them.
 see: https://napari.org/docs/dev/plugins/hook_specifications.html
 
 Replace code below according to your needs.
 """
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
+try:
+    from typing import Annotated
+except ImportError:
+    # python < 3.9, typing_extensions comes with magicgui
+    from typing_extensions import Annotated
 
 from enum import Enum
+import pathlib
+import re
 import numpy as np
-from napari_plugin_engine import napari_hook_implementation
-from magicgui import magicgui
 
+from . import _morphology as morphology
+from ._morphology import Angle, VectorField, map_slabs, _slab_size
 
 if TYPE_CHECKING:
     import napari
 
 
-# This is the actual plugin function, where we export our function
-# (The functions themselves are defined below)
-@napari_hook_implementation
-def napari_experimental_provide_function():
-    # we can return a single function
-    # or a tuple of (function, magicgui_options)
-    # or a list of multiple functions with or without options, as shown here:
-    return [threshold, image_arithmetic]
-
-
 # 1.  First example, a simple function that thresholds an image and creates a labels layer
 def threshold(data: "napari.types.ImageData", threshold: int) -> "napari.types.LabelsData":
-    """Threshold an image and return a mask."""
-    return (data > threshold).astype(int)
+    """Threshold an image and return a uint8 mask, slab by slab for lazy images."""
+    return map_slabs(lambda block: block > threshold, [data], data.shape, np.uint8)
+
+
+# bits of the labels returned by validate_morphology
+COMPOSITION_SUM = 1
+NON_FINITE = 2
+ALIGNMENT_EXCEEDS_FRACTION = 4
+VALIDATION_CHECKS = {
+    'composition sum': COMPOSITION_SUM,
+    'NaN/Inf': NON_FINITE,
+    'alignment exceeds fraction': ALIGNMENT_EXCEEDS_FRACTION,
+}
+
+
+def validate_morphology(path: pathlib.Path, tolerance: Annotated[float, {'step': 1e-4}] = 1e-3,
+                        out: Annotated[object, {'bind': None}] = None) -> "napari.types.LabelsData":
+    """Label the voxels of a morphology file that CyRSoXS would reject.
+
+    All ``Mat_N_unaligned`` and ``Mat_N_alignment`` datasets are read one
+    Z-slab at a time, so memory use is bounded by the slab size and the
+    labels. A material's volume fraction is its unaligned fraction plus
+    its alignment magnitude. Each voxel gets a bitmask of failed checks:
+
+    - ``COMPOSITION_SUM``: the material fractions don't add up to 1 (or,
+      when vacuum isn't stored, exceed 1) within ``tolerance``
+    - ``NON_FINITE``: a NaN or Inf value in any dataset
+    - ``ALIGNMENT_EXCEEDS_FRACTION``: an alignment magnitude exceeds its
+      material's volume fraction, i.e. the unaligned fraction is negative
+
+    ``out`` may be any uint8 array-like of the volume's shape, such as an
+    h5py dataset, to keep the labels out of memory. It is not part of the
+    widget.
+    """
+    import h5py
+    from ._reader import material_datasets, _num_materials
+
+    with h5py.File(path, 'r') as h5:
+        materials = material_datasets(h5, vacuum=True)
+        has_vacuum = len(materials) > _num_materials(h5)
+        shape = materials[0][0].shape
+        labels = np.zeros(shape, dtype=np.uint8) if out is None else out
+        s = materials[0][1]
+        slab = _slab_size(s.shape, s.dtype.itemsize)
+
+        for z0 in range(0, shape[0], slab):
+            z1 = min(z0+slab, shape[0])
+            flags = np.zeros((z1-z0,) + shape[1:], dtype=np.uint8)
+            total = np.zeros(flags.shape, dtype=np.float64)
+            for phi, s in materials:
+                phi = np.asarray(phi[z0:z1])
+                s = np.asarray(s[z0:z1])
+                finite = np.isfinite(phi) & np.isfinite(s).all(axis=-1)
+                flags[~finite] |= NON_FINITE
+                flags[phi < -tolerance] |= ALIGNMENT_EXCEEDS_FRACTION
+                total += phi
+                total += np.sqrt(np.einsum('...i,...i->...', s, s))
+            if has_vacuum:
+                bad = np.abs(total - 1) > tolerance
+            else:
+                bad = total > 1 + tolerance
+            flags[bad] |= COMPOSITION_SUM
+            labels[z0:z1] = flags
+    return labels
+
+
+def open_multiscale(path: pathlib.Path) -> List["napari.types.LayerDataTuple"]:
+    """Open a morphology file as multiscale pyramids, for smooth pan and zoom.
+
+    The pyramids are built once, reading the whole volume, and saved in a
+    sidecar file next to the morphology, which later opens of the file,
+    including napari's File > Open, reuse. Only the image layers are returned.
+    """
+    from ._reader import read_hdf5
+
+    return [layer_data for layer_data in read_hdf5(str(path), multiscale=True)
+            if layer_data[2] == 'image']
+
+
+def save_morphology(viewer: "napari.viewer.Viewer",
+                    path: Annotated[pathlib.Path, {'mode': 'w', 'filter': '*.hdf5'}]
+                    = pathlib.Path('morphology.hdf5')):
+    """Save the Mat_N_unaligned images and their alignment as a morphology.
+
+    The viewer's File > Save only reaches the multi-material writer through
+    a hook napari no longer converts, so this saves with ``write_hdf5``, the
+    vacuum material included.
+    """
+    from ._writer import write_hdf5
+
+    layer_data = [layer.as_layer_data_tuple() for layer in viewer.layers
+                  if re.fullmatch(r'Mat_\d+_(unaligned|alignment)', layer.name)]
+    layer_data = [data for data in layer_data if data[2] in ('image', 'vectors')]
+    if not layer_data:
+        raise ValueError('No Mat_N_unaligned image layers in the viewer')
+    write_hdf5(str(path), layer_data)
+
+
+# Morphology tools working on the Mat_N_unaligned image layers and their
+# alignment, either a Mat_N_alignment vectors layer or the image's
+# metadata['alignment'] field. See _morphology for the array versions.
+def _viewer_materials(viewer):
+    """(unaligned, alignment field or None) pair of each material in the viewer"""
+    from ._writer import _group_materials
+
+    layer_data = [layer.as_layer_data_tuple() for layer in viewer.layers
+                  if re.fullmatch(r'Mat_\d+_(unaligned|alignment)', layer.name)]
+    layer_data = [data for data in layer_data if data[2] in ('image', 'vectors')]
+    materials = []
+    for phi, alignment in _group_materials(layer_data).values():
+        if alignment is not None and np.ndim(alignment) == 3:
+            alignment = VectorField(alignment, phi.shape)
+        materials.append((phi, alignment))
+    if not materials:
+        raise ValueError('No Mat_N_unaligned image layers in the viewer')
+    return materials
+
+
+def _material(viewer, material):
+    materials = _viewer_materials(viewer)
+    if not 1 <= material <= len(materials):
+        raise ValueError(f'Material {material} not in 1..{len(materials)}')
+    return materials[material-1]
+
+
+def vacuum_fraction(viewer: "napari.viewer.Viewer") -> "napari.types.LayerDataTuple":
+    """Compute the volume fraction left to vacuum."""
+    vacuum = morphology.vacuum_fraction(_viewer_materials(viewer))
+    return (vacuum, {'name': 'vacuum', 'contrast_limits': [0, 1]}, 'image')
+
+
+def dominant_material(viewer: "napari.viewer.Viewer") -> "napari.types.LayerDataTuple":
+    """Label each voxel with its largest material, 0 for vacuum."""
+    labels = morphology.dominant_material(_viewer_materials(viewer))
+    return (labels, {'name': 'dominant material'}, 'labels')
+
+
+def alignment_magnitude(viewer: "napari.viewer.Viewer", material: int = 1) -> "napari.types.LayerDataTuple":
+    """Compute the aligned fraction of a material."""
+    _, s = _material(viewer, material)
+    if s is None:
+        raise ValueError(f'Material {material} has no alignment')
+    magnitude = morphology.alignment_magnitude(s)
+    return (magnitude, {'name': f'Mat_{material} alignment magnitude'}, 'image')
+
+
+def alignment_orientation(viewer: "napari.viewer.Viewer", material: int = 1,
+                          angle: Angle = Angle.theta) -> "napari.types.LayerDataTuple":
+    """Map the alignment angle of a material in degrees: theta from z or psi in the y-x plane."""
+    _, s = _material(viewer, material)
+    if s is None:
+        raise ValueError(f'Material {material} has no alignment')
+    orientation = morphology.alignment_orientation(s, angle)
+    limits = [0, 90] if angle is Angle.theta else [0, 180]
+    return (orientation, {'name': f'Mat_{material} {angle.value}', 'contrast_limits': limits,
+                          'colormap': 'twilight'}, 'image')
+
+
+def renormalize(viewer: "napari.viewer.Viewer") -> List["napari.types.LayerDataTuple"]:
+    """Scale the materials so their volume fractions add up to 1 in every voxel."""
+    layer_data = []
+    for i, (phi, s) in enumerate(morphology.renormalize(_viewer_materials(viewer))):
+        meta = {'name': f'Mat_{i+1}_unaligned renormalized', 'contrast_limits': [0, 1]}
+        if s is not None:
+            meta['metadata'] = {'alignment': s}
+        layer_data.append((phi, meta, 'image'))
+    return layer_data
+
+
+def interface_surface(viewer: "napari.viewer.Viewer", material: int = 1,
+                      level: Annotated[float, {'step': 0.01}] = 0.5,
+                      decimation: Annotated[float, {'step': 0.5}] = 0) -> "napari.types.LayerDataTuple":
+    """Extract the iso-surface of a material's fraction at level, optionally decimated.
+
+    Layers read from a file are meshed from the file on a process pool and
+    cached per level; other layers are meshed in memory. Decimation merges
+    the vertices within cubes of that many voxels.
+    """
+    from ._surface import material_surface, volume_surface
+
+    name = f'Mat_{material}_unaligned'
+    if name not in viewer.layers:
+        raise ValueError(f'No {name} image layer in the viewer')
+    layer = viewer.layers[name]
+    path = layer.metadata.get('path')
+    if path is not None:
+        vertices, faces = material_surface(path, material, level, decimation)
+    else:
+        data = layer.data[0] if layer.multiscale else layer.data
+        if data.ndim != 3:
+            raise ValueError(f'{name} is not a 3D volume')
+        vertices, faces = volume_surface(data, level, decimation)
+    if len(faces) == 0:
+        raise ValueError(f'Material {material} has no surface at level {level}')
+    return ((vertices, faces), {'name': f'Mat_{material} surface {level:g}',
+                                'translate': layer.translate, 'scale': layer.scale}, 'surface')
 
 
 # 2. Second example, a function that adds, subtracts, multiplies, or divides two layers
@@ -45,7 +238,17 @@ class Operation(Enum):
 
 
 def image_arithmetic(
-    layerA: "napari.types.ImageData", operation: Operation, layerB: "napari.types.ImageData"
+    layerA: "napari.types.ImageData", operation: Operation, layerB: "napari.types.ImageData",
+    out: Annotated[object, {'bind': None}] = None
 ) -> "napari.types.LayerDataTuple":
-    """Adds, subtracts, multiplies, or divides two same-shaped image layers."""
-    return (operation.value(layerA, layerB), {"colormap": "turbo"})
+    """Adds, subtracts, multiplies, or divides two same-shaped image layers.
+
+    The result has the layers' common dtype, or float32 for integer layers.
+    It is computed slab by slab into ``out`` when given, which may be
+    ``layerA`` itself to work in place. It is not part of the widget.
+    """
+    dtype = np.result_type(layerA.dtype, layerB.dtype)
+    if not np.issubdtype(dtype, np.inexact):
+        dtype = np.float32
+    result = map_slabs(operation.value, [layerA, layerB], layerA.shape, dtype, out)
+    return (result, {"colormap": "turbo"})
@@ -0,0 +1,136 @@
+"""
+napari hook implementations of the plugin.
+
+napari imports the plugin and calls some of its hooks at startup, so this
+module only imports ``napari_plugin_engine``. h5py, dask, Qt, matplotlib
+and napari itself are imported by the reader, writer, widget and function
+modules, which are loaded the first time a file is read or written or a
+widget or function is used.
+
+see: https://napari.org/docs/dev/plugins/hook_specifications.html
+"""
+from napari_plugin_engine import napari_hook_implementation
+
+
+def _is_morphology_path(path):
+    return path.endswith(".hd5") or path.endswith(".hdf5")
+
+
+def read_hdf5(path, **kwargs):
+    """CyRSoXS reader, see ``_reader.read_hdf5``"""
+    from ._reader import read_hdf5
+    return read_hdf5(path, **kwargs)
+
+
+def write_hdf5(path, layer_data):
+    """CyRSoXS writer, see ``_writer.write_hdf5``"""
+    from ._writer import write_hdf5
+    return write_hdf5(path, layer_data)
+
+
+@napari_hook_implementation
+def napari_get_reader(path):
+    """A basic implementation of the napari_get_reader hook specification.
+
+    Parameters
+    ----------
+    path : str or list of str
+        CyRSoXS morphology hdf5 file, or files to stack
+
+    Returns
+    -------
+    Callable or None
+        CyRSoXS hdf5 reader if the path file extension is correct
+    """
+    # reader plugins may be handed single path, or a list of paths.
+    # a list of morphologies is read as a stack, one file per step.
+    paths = path if isinstance(path, list) else [path]
+
+    # if we know we cannot read the file, we immediately return None.
+    if paths and all(_is_morphology_path(p) for p in paths):
+        return read_hdf5
+
+    # otherwise we return the *function* that can read ``path``.
+    return None
+
+
+@napari_hook_implementation
+def napari_get_writer(path, layer_types):
+    """Returns the CyRSoXS writer for image and vectors layers saved as hdf5
+
+    npe2 can't convert this hook, so napari only calls it through the npe1
+    plugin engine. In the viewer, several layers are saved with the
+    ``save_morphology`` function widget; File > Save reaches
+    ``napari_write_image`` for a single image.
+    """
+    if not _is_morphology_path(path):
+        return None
+    if not all(layer_type in ('image', 'vectors') for layer_type in layer_types):
+        return None
+    return write_hdf5
+
+
+@napari_hook_implementation
+def napari_write_image(path, data, meta):
+    """Writes a single image layer as a one-material morphology"""
+    if not _is_morphology_path(path):
+        return None
+    return write_hdf5(path, [(data, meta, 'image')])[0]
+
+
+class _DockWidget:
+    """Stands in for a widget class of ``_dock_widget`` until it is opened
+
+    napari passes the viewer to widget classes whose ``__init__`` takes
+    ``napari_viewer``, and instantiating this class returns the real widget,
+    so Qt and matplotlib are only imported when a widget is opened.
+    """
+    widget_class = None
+
+    def __new__(cls, napari_viewer):
+        from . import _dock_widget
+        return getattr(_dock_widget, cls.widget_class)(napari_viewer)
+
+    def __init__(self, napari_viewer):
+        # never called, __new__ returns another class
+        pass
+
+
+class line_profiler(_DockWidget):
+    widget_class = 'LineProfiler'
+
+
+class clipping_planes(_DockWidget):
+    widget_class = 'ClippingPlanes'
+
+
+class alignment_vectors(_DockWidget):
+    widget_class = 'AlignmentVectors'
+
+
+class fourier_preview(_DockWidget):
+    widget_class = 'FourierPreview'
+
+
+@napari_hook_implementation
+def napari_experimental_provide_dock_widget():
+    # you can return either a single widget, or a sequence of widgets
+    return [(line_profiler, {'area':'bottom','name':'Line Profiler'}),
+            (clipping_planes, {'area':'right','name':'3D Clipping Plane'}),
+            (alignment_vectors, {'area':'right','name':'Alignment Vectors'}),
+            (fourier_preview, {'area':'bottom','name':'Fourier Preview'})]
+
+
+@napari_hook_implementation
+def napari_experimental_provide_function():
+    # _function only needs NumPy at import time
+    from ._function import (threshold, validate_morphology, open_multiscale, save_morphology,
+                            vacuum_fraction, dominant_material,
+                            alignment_magnitude, alignment_orientation, renormalize,
+                            interface_surface, image_arithmetic)
+    # we can return a single function or a list of functions. Widget options
+    # go in Annotated type hints, npe2 drops (function, magicgui_options) tuples
+    return [threshold, validate_morphology, open_multiscale, save_morphology,
+            vacuum_fraction, dominant_material,
+            alignment_magnitude, alignment_orientation, renormalize,
+            interface_surface, image_arithmetic]
@@ -0,0 +1,286 @@
+"""
+Derived morphology fields, computed one Z-slab at a time.
+
+Inputs may be NumPy arrays or lazy array-likes (dask arrays, h5py datasets)
+that support slicing along the first axis; only one slab of each is in
+memory at a time. Outputs use compact dtypes (uint8 labels, float32 fields)
+and can be written into any preallocated array-like through ``out``,
+including one of the inputs, an ``np.memmap`` or an h5py dataset.
+
+A material is an ``(unaligned, alignment)`` pair: a (Z,Y,X) unaligned
+fraction and a (Z,Y,X,3) alignment field, or None for no alignment. Its
+volume fraction is the unaligned fraction plus the alignment magnitude.
+Materials stored as a volume fraction and Euler angles are decoded into
+this pair on demand by ``EulerUnaligned`` and ``EulerAlignment``.
+"""
+from enum import Enum
+
+import numpy as np
+
+# approximate size of the Z-slabs processed at a time
+SLAB_BYTES = 2**26
+
+
+class Angle(Enum):
+    theta = 'theta'
+    psi = 'psi'
+
+
+class VectorField:
+    """(Z,Y,X,D) alignment field view of an (N,2,D) napari vectors array
+
+    Only slicing along Z is supported; each slice scatters the vectors in
+    its slab into a zero field. The Z index of the vectors is built on the
+    first slice. Vectors from ``alignment_to_vectors`` are already in Z
+    order, so for them it is only the int32 Z of each vector.
+    """
+    def __init__(self, vectors, shape):
+        self.vectors = np.asarray(vectors)
+        self.shape = tuple(shape) + (self.vectors.shape[-1],)
+        self.dtype = self.vectors.dtype
+        self.ndim = len(self.shape)
+        self._z_index = None
+
+    def z_index(self):
+        """(order or None if already sorted, sorted Z) of the vectors"""
+        if self._z_index is None:
+            z = np.rint(self.vectors[:,0,0]).astype(np.int32)
+            order = None
+            if np.any(z[1:] < z[:-1]):
+                order = np.argsort(z, kind='stable')
+                z = z[order]
+            self._z_index = order, z
+        return self._z_index
+
+    def __getitem__(self, index):
+        z0, z1, _ = index.indices(self.shape[0])
+        block = np.zeros((max(z1-z0, 0),) + self.shape[1:], dtype=self.dtype)
+        order, z = self.z_index()
+        lo, hi = np.searchsorted(z, [z0, z1])
+        vectors = self.vectors[lo:hi] if order is None else self.vectors[order[lo:hi]]
+        pos = np.rint(vectors[:,0]).astype(np.intp)
+        block[(pos[:,0]-z0,) + tuple(pos[:,1:].T)] = vectors[:,1]
+        return block
+
+
+def _full_region(region, ndim):
+    """``region`` as a tuple of ``ndim`` indices, with Ellipsis expanded"""
+    if not isinstance(region, tuple):
+        region = (region,)
+    for i, r in enumerate(region):
+        if r is Ellipsis:
+            region = region[:i] + (slice(None),)*(ndim - len(region) + 1) + region[i+1:]
+            break
+    return region + (slice(None),)*(ndim - len(region))
+
+
+class _EulerDecoder:
+    """Array-like decoded on demand from a material's Euler angle datasets
+
+    Every slice reads the same region of the source datasets and decodes
+    only that, so dask arrays, slab-wise tools and the vector conversion
+    never hold more of the decoded field than they asked for. ``name`` and
+    ``file`` identify it like an h5py dataset's.
+    """
+    def __init__(self, vfrac, s, theta, psi, name, file=None):
+        self.vfrac, self.s, self.theta, self.psi = vfrac, s, theta, psi
+        self.name = name
+        self.file = file
+        self.dtype = np.result_type(vfrac.dtype, np.float32)
+        self.chunks = getattr(vfrac, 'chunks', None)
+        self.shape = tuple(vfrac.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def _read(self, source, region):
+        return np.asarray(source[region], dtype=self.dtype)
+
+
+class EulerUnaligned(_EulerDecoder):
+    """(Z,Y,X) unaligned fraction ``Vfrac*(1-S)`` of an Euler angle material"""
+    def __getitem__(self, region):
+        region = _full_region(region, 3)
+        return self._read(self.vfrac, region)*(1 - self._read(self.s, region))
+
+
+class EulerAlignment(_EulerDecoder):
+    """(Z,Y,X,3) alignment field ``S*Vfrac*n`` of an Euler angle material
+
+    ``n`` is the unit vector at polar angle theta from z and azimuth psi in
+    the y-x plane, both in radians, in (z, y, x) component order.
+    """
+    def __init__(self, vfrac, s, theta, psi, name, file=None):
+        super().__init__(vfrac, s, theta, psi, name, file)
+        self.chunks = None if self.chunks is None else self.chunks + (3,)
+        self.shape = self.shape + (3,)
+
+    def __getitem__(self, region):
+        region = _full_region(region, 4)
+        spatial, component = region[:3], region[3]
+        aligned = self._read(self.vfrac, spatial)*self._read(self.s, spatial)
+        theta = self._read(self.theta, spatial)
+        psi = self._read(self.psi, spatial)
+        in_plane = aligned*np.sin(theta)
+        field = np.stack([aligned*np.cos(theta), in_plane*np.sin(psi), in_plane*np.cos(psi)],
+                         axis=-1)
+        return field[..., component]
+
+
+def _slab_size(shape, nbytes, multiple=1, slab_bytes=None):
+    """Planes per slab when a voxel of ``shape`` takes ``nbytes`` in total
+
+    The result is a multiple of ``multiple`` planes and the slab takes about
+    ``slab_bytes``, ``SLAB_BYTES`` by default.
+    """
+    slab_bytes = SLAB_BYTES if slab_bytes is None else slab_bytes
+    plane_bytes = np.prod(shape[1:])*nbytes*multiple
+    return max(1, int(slab_bytes // plane_bytes))*multiple
+
+
+def _itemsize(arrays):
+    return sum(np.dtype(a.dtype).itemsize*int(np.prod(a.shape[3:])) for a in arrays)
+
+
+def map_slabs(func, arrays, shape, dtype, out=None):
+    """Applies ``func`` to matching Z-slabs of ``arrays``
+
+    Parameters
+    ----------
+    func : callable
+        Takes one NumPy block per array and returns the output block.
+    arrays : list of array-like
+        Inputs with the same length along the first axis.
+    shape : tuple of int
+        Output shape.
+    dtype : numpy dtype
+        Output dtype, used when ``out`` is None.
+    out : array-like, optional
+        Preallocated output. Defaults to a new NumPy array.
+
+    Returns
+    -------
+    array-like
+        ``out``.
+    """
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    slab = _slab_size(shape, _itemsize(arrays) + np.dtype(out.dtype).itemsize)
+    for z0 in range(0, shape[0], slab):
+        out[z0:z0+slab] = func(*[np.asarray(a[z0:z0+slab]) for a in arrays])
+    return out
+
+
+def _magnitude(s):
+    return np.sqrt(np.einsum('...i,...i->...', s, s, dtype=np.float32, casting='same_kind'))
+
+
+def _material_blocks(materials, z0, z1):
+    """(unaligned, alignment) NumPy blocks of each material's Z-slab"""
+    return [(np.asarray(phi[z0:z1]), None if s is None else np.asarray(s[z0:z1]))
+            for phi, s in materials]
+
+
+def _fractions(blocks):
+    """float32 volume fraction blocks of each material"""
+    fractions = []
+    for phi, s in blocks:
+        phi = phi.astype(np.float32, copy=False)
+        fractions.append(phi if s is None else phi + _magnitude(s))
+    return fractions
+
+
+def _material_itemsize(materials):
+    return _itemsize([a for pair in materials for a in pair if a is not None])
+
+
+def _map_materials(func, materials, dtype, out=None):
+    """Like ``map_slabs``, with ``func`` taking the list of material fraction blocks"""
+    shape = materials[0][0].shape
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    slab = _slab_size(shape, _material_itemsize(materials) + 4*len(materials)
+                      + np.dtype(out.dtype).itemsize)
+    for z0 in range(0, shape[0], slab):
+        out[z0:z0+slab] = func(_fractions(_material_blocks(materials, z0, z0+slab)))
+    return out
+
+
+def vacuum_fraction(materials, out=None):
+    """float32 volume fraction left to vacuum, one minus the material fractions"""
+    return _map_materials(lambda fractions: 1 - sum(fractions), materials, np.float32, out)
+
+
+def dominant_material(materials, out=None):
+    """uint8 labels of the material with the largest fraction, 0 for vacuum"""
+    def dominant(fractions):
+        stacked = np.stack([1 - sum(fractions)] + fractions)
+        return np.argmax(stacked, axis=0)
+    if len(materials) > 255:
+        raise ValueError('At most 255 materials fit in uint8 labels')
+    return _map_materials(dominant, materials, np.uint8, out)
+
+
+def alignment_magnitude(s, out=None):
+    """float32 magnitude of a (Z,Y,X,3) alignment field, the aligned fraction"""
+    return map_slabs(_magnitude, [s], s.shape[:-1], np.float32, out)
+
+
+def alignment_orientation(s, angle=Angle.theta, out=None):
+    """float32 orientation of a (Z,Y,X,3) alignment field, in degrees
+
+    ``Angle.theta`` is the polar angle from z (component 0), in [0, 90], and
+    ``Angle.psi`` the azimuth in the y-x plane, in [0, 180). Alignment is
+    headless, so s and -s give the same angles. Voxels without alignment
+    are NaN.
+    """
+    def orientation(block):
+        magnitude = _magnitude(block)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if Angle(angle) is Angle.theta:
+                values = np.degrees(np.arccos(np.clip(np.abs(block[...,0])/magnitude, 0, 1)))
+            else:
+                values = np.degrees(np.arctan2(block[...,1], block[...,2])) % 180
+        values[magnitude == 0] = np.nan
+        return values
+    return map_slabs(orientation, [s], s.shape[:-1], np.float32, out)
+
+
+def renormalize(materials, out=None):
+    """Scales each voxel's materials so their volume fractions add up to 1
+
+    Voxels without any material are left as they are.
+
+    Parameters
+    ----------
+    materials : list of (array-like, array-like or None)
+        (unaligned, alignment) pairs.
+    out : list of (array-like, array-like or None), optional
+        Preallocated outputs, one pair per material. Pass ``materials``
+        itself to renormalize in place. Defaults to new float32 arrays.
+
+    Returns
+    -------
+    list of (array-like, array-like or None)
+        ``out``.
+    """
+    shape = materials[0][0].shape
+    if out is None:
+        out = [(np.empty(phi.shape, dtype=np.float32),
+                None if s is None else np.empty(s.shape, dtype=np.float32))
+               for phi, s in materials]
+    slab = _slab_size(shape, 2*_material_itemsize(materials) + 8*len(materials))
+    for z0 in range(0, shape[0], slab):
+        blocks = _material_blocks(materials, z0, z0+slab)
+        total = sum(_fractions(blocks))
+        scale = np.divide(1, total, out=np.ones_like(total), where=total > 0)
+        for (phi_out, s_out), (phi, s) in zip(out, blocks):
+            phi_out[z0:z0+slab] = phi*scale
+            if s_out is not None:
+                s_out[z0:z0+slab] = s*scale[...,None]
+    return out
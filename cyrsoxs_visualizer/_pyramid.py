@@ -0,0 +1,147 @@
+"""
+Multiscale pyramids of CyRSoXS morphology volumes.
+
+Pyramids are built block by block, one Z-slab at a time, so the full volume
+never has to fit in memory. They are stored in a sidecar HDF5 file next to
+the morphology and are rebuilt only when the morphology's mtime or size
+changes.
+"""
+import os
+import warnings
+
+import numpy as np
+import h5py
+
+from ._trace import span
+from ._morphology import _slab_size
+
+# stop downsampling once the largest in-plane dimension is this small
+MIN_PYRAMID_SIZE = 256
+
+
+def sidecar_path(path):
+    """Path of the pyramid sidecar file for the morphology at ``path``"""
+    return os.path.splitext(path)[0] + '_pyramid.h5'
+
+
+def _source_key(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _factors(shape):
+    # a single plane (2D morphology) is only downsampled in-plane
+    return tuple(2 if n > 1 else 1 for n in shape)
+
+
+def downsample(block, factors):
+    """Mean-pools ``block`` by integer ``factors`` along each axis
+
+    Axes that are not a multiple of their factor are edge padded.
+    """
+    pad = [(0, -n % f) for n, f in zip(block.shape, factors)]
+    if any(p[1] for p in pad):
+        block = np.pad(block, pad, mode='edge')
+    shape = []
+    for n, f in zip(block.shape, factors):
+        shape.extend((n//f, f))
+    axes = tuple(range(1, 2*block.ndim, 2))
+    return block.reshape(shape).mean(axis=axes, dtype=np.float32)
+
+
+def _build_level(src, dst_group, name):
+    """Writes the 2x downsampled version of ``src`` into ``dst_group[name]``"""
+    factors = _factors(src.shape)
+    shape = tuple(-(-n//f) for n, f in zip(src.shape, factors))
+    chunks = (1,) + tuple(min(n, 256) for n in shape[1:])
+    dst = dst_group.create_dataset(name, shape=shape, dtype=np.float32, chunks=chunks)
+
+    fz = factors[0]
+    slab = _slab_size(src.shape, src.dtype.itemsize, fz)
+    for z0 in range(0, src.shape[0], slab):
+        block = src[z0:z0+slab]
+        dst[z0//fz:z0//fz + -(-block.shape[0]//fz)] = downsample(block, factors)
+    return dst
+
+
+def build_pyramid(h5, out, names, min_size=None):
+    """Builds a pyramid for each dataset in ``names``
+
+    Parameters
+    ----------
+    h5 : h5py.File or dict
+        Open morphology file, or any mapping of ``names`` to arrays.
+    out : h5py.File
+        Sidecar file opened for writing. Level ``n`` of dataset ``name`` is
+        stored as ``out[f'{name}/{n}']``, starting at level 1.
+    names : list of str
+        Dataset paths in ``h5``.
+    min_size : int, optional
+        Downsampling stops once the largest in-plane dimension is at most
+        this size. Defaults to ``MIN_PYRAMID_SIZE``.
+    """
+    if min_size is None:
+        min_size = MIN_PYRAMID_SIZE
+    for name in names:
+        group = out.require_group(name)
+        src = h5[name]
+        level = 1
+        while max(src.shape[1:]) > min_size:
+            src = _build_level(src, group, str(level))
+            level += 1
+
+
+def open_pyramid(path, h5, names, build=True):
+    """Returns the pyramid levels of each dataset in ``names``
+
+    The sidecar is (re)built if it is missing or was built from a different
+    version of the morphology, unless ``build`` is False.
+
+    Parameters
+    ----------
+    path : str
+        Path of the morphology file.
+    h5 : h5py.File or dict
+        Open morphology file, or any mapping of ``names`` to arrays.
+    names : list of str
+        Dataset paths in ``h5``.
+    build : bool
+        If False, only an up-to-date sidecar is opened and None is returned
+        otherwise, without reading the morphology.
+
+    Returns
+    -------
+    dict or None
+        Maps each name to a list of datasets, full resolution first, or None
+        if the sidecar could not be written. The sidecar file stays open.
+    """
+    pyramid_path = sidecar_path(path)
+    mtime, size = _source_key(path)
+    sidecar = None
+    if os.path.exists(pyramid_path):
+        sidecar = h5py.File(pyramid_path, 'r')
+        stale = (sidecar.attrs.get('source_mtime') != mtime
+                 or sidecar.attrs.get('source_size') != size
+                 or not all(name in sidecar for name in names))
+        if stale:
+            sidecar.close()
+            sidecar = None
+
+    if sidecar is None and not build:
+        return None
+    if sidecar is None:
+        try:
+            with h5py.File(pyramid_path, 'w') as out, span('build pyramid'):
+                build_pyramid(h5, out, names)
+                out.attrs['source_mtime'] = mtime
+                out.attrs['source_size'] = size
+        except OSError as err:
+            warnings.warn(f'Could not write pyramid sidecar {pyramid_path}: {err}')
+            return None
+        sidecar = h5py.File(pyramid_path, 'r')
+
+    levels = {}
+    for name in names:
+        group = sidecar[name]
+        levels[name] = [h5[name]] + [group[str(n)] for n in range(1, len(group)+1)]
+    return levels
@@ -1,9 +1,8 @@
 """
 This module is an example of a barebones numpy reader plugin for napari.
 
-It implements the ``napari_get_reader`` hook specification, (to create
-a reader plugin) but your plugin may choose to implement any of the hook
-specifications offered by napari.
+Its ``read_hdf5`` is returned by the ``napari_get_reader`` hook in ``_hooks``,
+which only imports this module when a file is read.
 see: https://napari.org/docs/dev/plugins/hook_specifications.html
 
 Replace code below accordingly.  For complete documentation see:
@@ -11,40 +10,281 @@ https://napari.org/docs/dev/plugins/for_plugin_developers.html
 """
 import numpy as np
 import h5py
-from napari_plugin_engine import napari_hook_implementation
-from skimage.transform import pyramid_gaussian
+import dask.array as da
+from dask.base import tokenize
+from concurrent.futures import ThreadPoolExecutor
 import os
+import warnings
 
+from ._pyramid import open_pyramid
+from ._cache import LRUCache, file_key
+from ._trace import span, count
+from ._morphology import EulerUnaligned, EulerAlignment, _slab_size
 
-@napari_hook_implementation
-def napari_get_reader(path):
-    """A basic implementation of the napari_get_reader hook specification.
+# files whose morphology datasets are larger than this are opened lazily
+LAZY_THRESHOLD = 2**30 # bytes
+
+# group of the Euler angle layout, Mat_N_Vfrac, Mat_N_S, Mat_N_Theta, Mat_N_Psi
+EULER_GROUP = 'Euler_Angles'
+
+# parsed eager reads, shared by every viewer in the process
+reader_cache = LRUCache(os.environ.get('CYRSOXS_CACHE_BYTES', 2**32))
+
+
+def is_euler(h5):
+    """True for morphologies stored as volume fractions and Euler angles"""
+    return 'vector_morphology' not in h5 and EULER_GROUP in h5
+
+
+def _num_materials(h5):
+    """Number of materials in the morphology, not counting vacuum"""
+    if is_euler(h5):
+        # the Euler layout has no separate vacuum
+        num_mat = 0
+        while f'{EULER_GROUP}/Mat_{num_mat+1}_Vfrac' in h5:
+            num_mat += 1
+        return num_mat
+    return int(h5['igor_parameters/igormaterialnum'][()]) - 1
+
+
+def _euler_material(h5, number, mmap=False):
+    """Decoded (unaligned, alignment) pair of Euler angle material ``number``"""
+    prefix = f'{EULER_GROUP}/Mat_{number}'
+    sources = [h5[f'{prefix}_{field}'] for field in ('Vfrac', 'S', 'Theta', 'Psi')]
+    if mmap:
+        sources = [_open_dataset(source) for source in sources]
+    return (EulerUnaligned(*sources, name=f'/{prefix}_unaligned', file=h5),
+            EulerAlignment(*sources, name=f'/{prefix}_alignment', file=h5))
+
+
+def material_datasets(h5, vacuum=False, mmap=False):
+    """(unaligned, alignment) dataset pairs of each material
 
     Parameters
     ----------
-    path : str or list of str
-        CyRSoXS morphology hdf5 file
+    h5 : h5py.File
+        Open CyRSoXS morphology file.
+    vacuum : bool
+        If True, the vacuum material is included as the last pair when the
+        file stores it. It is left out by default.
+    mmap : bool
+        If True, the Euler angle decoders read their sources through
+        ``memmap_dataset`` where possible.
 
     Returns
     -------
-    Callable or None
-        CyRSoXS hdf5 reader if the path file extension is correct
+    list of (h5py.Dataset, h5py.Dataset)
+        The (Z,Y,X) ``Mat_N_unaligned`` and (Z,Y,X,D) ``Mat_N_alignment``
+        datasets, in material order. For the Euler angle layout they are
+        ``EulerUnaligned`` and ``EulerAlignment`` array-likes instead,
+        decoding each slice from the ``Mat_N_Vfrac``, ``Mat_N_S``,
+        ``Mat_N_Theta`` and ``Mat_N_Psi`` datasets when it is read.
     """
-    if isinstance(path, list):
-        # reader plugins may be handed single path, or a list of paths.
-        # if it is a list, it is assumed to be an image stack...
-        # so we are only going to look at the first file.
-        path = path[0]
+    num_mat = _num_materials(h5)
+    if is_euler(h5):
+        return [_euler_material(h5, i+1, mmap) for i in range(num_mat)]
+    names = [(f'vector_morphology/Mat_{i+1}_unaligned', f'vector_morphology/Mat_{i+1}_alignment')
+             for i in range(num_mat + 1)]
+    if not (vacuum and all(name in h5 for name in names[-1])):
+        names = names[:-1]
+    return [(h5[unaligned], h5[alignment]) for unaligned, alignment in names]
+
+
+def _morphology_nbytes(h5):
+    """Total size in bytes of the unaligned and alignment datasets"""
+    nbytes = 0
+    for phi, s in material_datasets(h5):
+        nbytes += phi.size*phi.dtype.itemsize + s.size*s.dtype.itemsize
+    return nbytes
+
+
+def memmap_dataset(dset):
+    """Read-only memory map of a contiguous, unfiltered dataset
+
+    The map shares the OS page cache with every other process reading the
+    file, and slicing it only reads the pages touched. Changes made to the
+    file in place show through the map, and touching the map after the file
+    is truncated, e.g. rewritten with ``h5py.File(path, 'w')``, raises
+    SIGBUS, so maps are only kept where that is acceptable.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+        Dataset to map.
+
+    Returns
+    -------
+    np.memmap or None
+        None if the dataset is chunked (and so possibly compressed), not
+        yet written, stored externally, of a non-numeric dtype, or in a file
+        whose driver or user block moves it from its reported offset, or if
+        it is not an h5py dataset.
+    """
+    if not isinstance(dset, h5py.Dataset):
+        return None
+    if dset.chunks is not None or dset.external or dset.size == 0:
+        return None
+    if dset.id.get_create_plist().get_layout() != h5py.h5d.CONTIGUOUS:
+        return None
+    if dset.dtype.kind not in 'biuf' or dset.file.driver not in ('sec2', 'stdio'):
+        return None
+    if dset.file.userblock_size:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(dset.file.filename, dtype=dset.dtype, mode='r',
+                     offset=offset, shape=dset.shape)
+
+
+def _open_dataset(dset):
+    """Memory map of ``dset`` when it can be mapped, otherwise ``dset`` itself"""
+    mapped = memmap_dataset(dset)
+    return dset if mapped is None else mapped
+
+
+def lazy_dataset(dset, mmap=False):
+    """Wraps an h5py dataset in a dask array aligned to its HDF5 chunks
+
+    Contiguous datasets get one chunk per plane along the first axis, so
+    displaying a slice only reads that slice from disk. The dask name comes
+    from the file version and dataset name, so the data is never hashed.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+        Dataset, or array-like with ``chunks``, such as the Euler decoders
+        of ``material_datasets``, to wrap. Its file must stay open while the
+        array is in use.
+    mmap : bool
+        If True, the dataset is read through ``memmap_dataset`` when it can
+        be mapped, see ``read_hdf5`` for the hazard.
+
+    Returns
+    -------
+    dask.array.Array
+    """
+    chunks = dset.chunks
+    if chunks is None:
+        chunks = (1,) + dset.shape[1:]
+    name = 'cyrsoxs-' + tokenize(file_key(dset.file.filename), dset.name)
+    return da.from_array(_open_dataset(dset) if mmap else dset, chunks=chunks, name=name)
+
 
-    # if we know we cannot read the file, we immediately return None.
-    if path.endswith(".hd5") or path.endswith(".hdf5"):
-        return read_hdf5
+def _iter_alignment_slabs(s, stride, threshold, slab):
+    """Yields (z offset, strided slab, mask of vectors to keep) for each Z-slab"""
+    # memory maps are counted once, as bytes mapped, by whoever maps them
+    mapped = isinstance(s, np.memmap)
+    for z0 in range(0, s.shape[0], slab):
+        block = np.asarray(s[z0:z0+slab:stride, ::stride, ::stride])
+        if not mapped:
+            count('bytes read', block.nbytes)
+        # squared magnitude without a squared copy of the block
+        mag2 = np.einsum('...i,...i->...', block, block)
+        yield z0, block, mag2 > threshold**2
 
-    # otherwise we return the *function* that can read ``path``.
-    return none
 
+def alignment_to_vectors(s, stride: int = 1, threshold: float = 0):
+    """Converts a (Z,Y,X,D) alignment field into an (N,2,D) napari vectors array
 
-def read_hdf5(path: str):
+    The field is streamed in Z-slabs twice: once to count the vectors and
+    once to fill a single preallocated output, so peak memory is about the
+    size of the output plus one slab.
+
+    Parameters
+    ----------
+    s : array-like
+        Alignment field. Anything that supports strided slicing works,
+        including h5py datasets and dask arrays.
+    stride : int
+        Only every ``stride``-th voxel along each axis is converted.
+    threshold : float
+        Only vectors with a magnitude above ``threshold`` are kept.
+
+    Returns
+    -------
+    vectors : np.ndarray
+        (N,2,D) array of vector positions and components, in the dtype of
+        ``s`` (float32 for non-float fields).
+    """
+    dtype = s.dtype if np.issubdtype(s.dtype, np.floating) else np.float32
+    # slabs start on a multiple of stride so the strided grid is global
+    slab = _slab_size(s.shape, np.dtype(dtype).itemsize, stride)
+
+    num_vectors = 0
+    with span('count vectors'):
+        for _, _, mask in _iter_alignment_slabs(s, stride, threshold, slab):
+            num_vectors += np.count_nonzero(mask)
+
+    vectors = np.empty((num_vectors, 2, s.ndim-1), dtype=dtype)
+    n = 0
+    with span('fill vectors', vectors=num_vectors):
+        for z0, block, mask in _iter_alignment_slabs(s, stride, threshold, slab):
+            num = np.count_nonzero(mask)
+            if num == 0:
+                continue
+            out = vectors[n:n+num]
+            for axis, idx in enumerate(np.nonzero(mask)):
+                out[:,0,axis] = idx*stride
+            out[:,0,0] += z0
+            out[:,1,:] = block[mask]
+            n += num
+    count('vectors emitted', num_vectors)
+    return vectors
+
+
+def _max_workers(max_workers, num_mat):
+    if max_workers is None:
+        max_workers = os.environ.get('CYRSOXS_READER_WORKERS')
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    return max(1, min(int(max_workers), num_mat))
+
+
+def _read_material(path, i, material, vector_stride, vector_threshold, mmap=False):
+    """LayerData tuples of material ``i+1``: its unaligned image and alignment vectors"""
+    layer_data_list = []
+    # unaligned material, mapped rather than copied only when asked for
+    dset, alignment = material
+    with span('read unaligned', material=i+1):
+        phi = memmap_dataset(dset) if mmap else None
+        if phi is None:
+            phi = dset[()]
+            count('bytes read', phi.nbytes)
+        else:
+            count('bytes mapped', phi.nbytes)
+    layer_data_list.append((phi,{'name':f'Mat_{i+1}_unaligned','metadata':{'path':path}},"image"))
+    # alignment vectors, streamed from the (Z,Y,X,D) field
+    # into an (N,2,D) array (list) of vectors
+    if mmap:
+        alignment = _open_dataset(alignment)
+        if isinstance(alignment, np.memmap):
+            count('bytes mapped', alignment.nbytes)
+    vectors = alignment_to_vectors(alignment, vector_stride, vector_threshold)
+    if len(vectors) != 0:
+        layer_data_list.append((vectors,{'name':f'Mat_{i+1}_alignment','visible':False,'edge_width':0.1},"vectors"))
+    return layer_data_list
+
+
+def _resident_nbytes(layer_data_list):
+    """Bytes held in memory by the layers; memory maps live in the page cache"""
+    return sum(data.nbytes for data, _, _ in layer_data_list if not isinstance(data, np.memmap))
+
+
+def _read_only_views(layer_data_list):
+    """Copies of the LayerData tuples sharing the cached, read-only arrays"""
+    return [(data.view(), dict(meta), layer_type) for data, meta, layer_type in layer_data_list]
+
+
+def cache_info():
+    """Hit and miss counts and resident size of the reader cache"""
+    return reader_cache.info()
+
+
+def read_hdf5(path: str, lazy: bool = None, multiscale: bool = None,
+              vector_stride: int = 1, vector_threshold: float = 0,
+              max_workers: int = None, cache: bool = True, validate: bool = False,
+              mmap: bool = False):
     """Returns a list of LayerData tuples from the morphology hdf5
 
     Readers are expected to return data as a list of tuples, where each tuple
@@ -54,7 +294,54 @@ def read_hdf5(path: str):
     Parameters
     ----------
     path : str or list of str
-        Path to file, or list of paths.
+        Path to file, or list of paths. Several paths are stacked into one
+        lazy (N,Z,Y,X) layer per material by ``_stack.read_stack``, and the
+        other options are ignored.
+    lazy : bool, optional
+        If True, the unaligned datasets are returned as dask arrays backed by
+        the open file, so only the displayed slices are read. Alignment
+        vectors are not built in lazy mode; the lazy alignment field is
+        stored in the image layer metadata under ``'alignment'`` instead,
+        and its dataset name under ``'alignment_dataset'``.
+        By default, files larger than ``LAZY_THRESHOLD`` are opened lazily.
+    multiscale : bool, optional
+        If True, the unaligned datasets are returned as lazy multiscale
+        pyramids. The pyramid is built once, which reads the whole volume,
+        and cached in a sidecar file next to ``path``. Implies ``lazy``. By
+        default, lazily opened files use a sidecar that is already there
+        and up to date, and are otherwise opened at full resolution only,
+        so the first view never waits on a pyramid build. napari's reader
+        hook always reads with the default; in the viewer, the
+        ``open_multiscale`` function widget builds the sidecar.
+    vector_stride : int
+        Only every ``vector_stride``-th voxel is converted to an alignment
+        vector. Use to cap the number of vectors.
+    vector_threshold : float
+        Only alignment vectors with a magnitude above this are kept.
+    max_workers : int, optional
+        Number of threads materials are loaded on. Defaults to the
+        ``CYRSOXS_READER_WORKERS`` environment variable, or the CPU count.
+        Layer order does not depend on it.
+    cache : bool
+        Eagerly read files are kept in ``reader_cache``, keyed on path, mtime
+        and size, and returned as read-only views when reopened. The cache
+        size is capped by the ``CYRSOXS_CACHE_BYTES`` environment variable.
+    validate : bool
+        If True, the file is also checked with
+        ``_function.validate_morphology`` and a ``'validation'`` labels layer
+        marking the failing voxels is appended. The number of failing voxels
+        per check is stored in its metadata under ``'failures'``. napari's
+        reader hook always reads with the defaults, so this is only
+        available from Python; in the viewer, the ``validate_morphology``
+        function widget runs the same check on a file.
+    mmap : bool
+        If True, eagerly read contiguous, uncompressed unaligned datasets are
+        returned as read-only ``np.memmap`` arrays instead of copies, and
+        alignment fields are streamed from memory maps. The maps stay valid
+        only while the file is not rewritten in place: writing the same path
+        with ``h5py.File(path, 'w')`` truncates it, and touching the layer
+        afterwards kills the process with SIGBUS. The same goes for lazy
+        reads, which are then read through memory maps.
 
     Returns
     -------
@@ -65,26 +352,91 @@ def read_hdf5(path: str):
         in napari, and layer_type is a lower-case string naming the type of layer.
         Both "meta", and "layer_type" are optional. napari will default to
         layer_type=="image" if not provided
+
+    Notes
+    -----
+    Eager reads copy the datasets into memory, and lazy reads go through
+    h5py, unless ``mmap`` is set. Then contiguous, uncompressed datasets are
+    read through read-only memory maps, see ``memmap_dataset``, and chunked
+    or compressed ones still through h5py.
     """
-    with h5py.File(path, 'r') as h5:
-        layer_data_list = []
-        num_mat = int(h5['igor_parameters/igormaterialnum'][()])
-        for i in range(num_mat-1): # don't include vacuum
-            # unaligned material
-            phi = h5[f'vector_morphology/Mat_{i+1}_unaligned'][()]
-            layer_data_list.append((phi,{'name':f'Mat_{i+1}_unaligned'},"image"))
-            # alignment vectors
-            s = h5[f'vector_morphology/Mat_{i+1}_alignment'][()]
-
-            # reshape from (Z,Y,X,D) array to (N,2,D) array (list) of vectors
-            smag = np.sqrt(np.sum(s**2,axis=-1))
-            idx = smag > 0
-            vector_pos = np.column_stack(np.where(idx))
-            if len(vector_pos) != 0:
-                vectors = np.zeros((len(vector_pos),2,phi.ndim))
-                vectors[:,0,:] = vector_pos
-                vectors[:,1,:] = s[idx]
-
-                layer_data_list.append((vectors,{'name':f'Mat_{i+1}_alignment','visible':False,'edge_width':0.1},"vectors"))
-    
+    if isinstance(path, (list, tuple)):
+        if len(path) > 1:
+            from ._stack import read_stack
+            return read_stack(path, max_workers)
+        path = path[0]
+    with span('read_hdf5', path=str(path)):
+        layer_data_list = _read_layers(path, lazy, multiscale, vector_stride, vector_threshold,
+                                       max_workers, cache, mmap)
+        if validate:
+            with span('validate'):
+                layer_data_list.append(_validation_layer(path))
+    return layer_data_list
+
+
+def _read_layers(path, lazy, multiscale, vector_stride, vector_threshold, max_workers, cache, mmap):
+    key = file_key(path) + (vector_stride, vector_threshold, mmap)
+    if cache and lazy is not True and multiscale is not True:
+        layer_data_list = reader_cache.get(key)
+        if layer_data_list is not None:
+            return _read_only_views(layer_data_list)
+
+    h5 = h5py.File(path, 'r')
+    nbytes = _morphology_nbytes(h5)
+    if lazy is None:
+        lazy = bool(multiscale) or nbytes > LAZY_THRESHOLD
+    if lazy or multiscale:
+        # the file stays open for as long as the dask arrays reference it
+        return _read_lazy(h5, path, multiscale, mmap)
+
+    with h5:
+        # don't include vacuum; Euler sources are only mapped while decoding
+        materials = list(enumerate(material_datasets(h5, mmap=True)))
+        # h5py reads and the NumPy work in the vector conversion release the
+        # GIL, so materials load concurrently. map keeps the material order.
+        with ThreadPoolExecutor(_max_workers(max_workers, len(materials))) as pool:
+            materials = pool.map(lambda item: _read_material(path, *item, vector_stride, vector_threshold, mmap),
+                                 materials)
+            layer_data_list = [layer_data for material in materials for layer_data in material]
+
+    if cache:
+        for data, _, _ in layer_data_list:
+            data.flags.writeable = False
+        reader_cache.put(key, layer_data_list, _resident_nbytes(layer_data_list))
+        return _read_only_views(layer_data_list)
+    return layer_data_list
+
+
+def _validation_layer(path):
+    """Labels LayerData tuple of the voxels failing ``validate_morphology``"""
+    from ._function import validate_morphology, VALIDATION_CHECKS
+    labels = validate_morphology(path)
+    failures = {name: int(np.count_nonzero(labels & bit)) for name, bit in VALIDATION_CHECKS.items()}
+    if any(failures.values()):
+        warnings.warn(f'{path} failed validation: ' + ', '.join(
+            f'{n} voxels {name}' for name, n in failures.items() if n))
+    return (labels, {'name':'validation', 'metadata':{'path':path, 'failures':failures}}, "labels")
+
+
+def _read_lazy(h5, path, multiscale=None, mmap=False):
+    materials = material_datasets(h5, mmap=mmap)
+    sources = {phi.name: phi for phi, _ in materials}
+    pyramids = None
+    if multiscale is not False:
+        # an existing sidecar is used unless multiscale is False; only True builds one
+        pyramids = open_pyramid(path, sources, list(sources), build=bool(multiscale))
+
+    layer_data_list = []
+    for i, (name, (_, alignment)) in enumerate(zip(sources, materials)):
+        s = lazy_dataset(alignment, mmap)
+        # fixed contrast limits keep napari from scanning the volume
+        meta = {'name':f'Mat_{i+1}_unaligned',
+                'contrast_limits':[0,1],
+                'metadata':{'path':path, 'alignment':s, 'alignment_dataset':alignment.name}}
+        if pyramids is not None:
+            phi = [lazy_dataset(level, mmap) for level in pyramids[name]]
+            meta['multiscale'] = True
+        else:
+            phi = lazy_dataset(sources[name], mmap)
+        layer_data_list.append((phi,meta,"image"))
     return layer_data_list
@@ -0,0 +1,365 @@
+"""
+Vectorized sampling of image slices along lines, used by LineProfiler.
+
+The interpolation indices and weights for a line depend only on the line and
+the slice shape, so they are computed once and applied to every layer.
+
+Lazy arrays (dask, h5py, zarr) are sampled through a ``ChunkCache``, which
+reads only the tiles holding the voxels that are actually sampled.
+"""
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+from ._trace import count
+
+# largest tile read from a lazy array along any axis
+TILE = 256
+# tiles kept per ChunkCache
+MAX_TILES = 64
+# samples of an oblique slab gathered at a time
+SLAB_SAMPLES = 2**22
+
+
+def line_coordinates(start, end):
+    """(2, n) coordinates of unit-spaced samples from ``start`` to ``end``
+
+    Matches the sample positions of ``skimage.measure.profile_line``,
+    including both end points.
+    """
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    num = int(np.ceil(np.linalg.norm(end - start))) + 1
+    return np.linspace(start, end, num).T
+
+
+def profile_coordinates(lines, width=1):
+    """Sample coordinates of several lines, each averaged over a width
+
+    Parameters
+    ----------
+    lines : sequence of (start, end)
+        Line end points in slice coordinates.
+    width : int
+        Number of unit-spaced parallel samples across each line, centred
+        on it, like ``profile_line``'s ``linewidth``.
+
+    Returns
+    -------
+    coords : np.ndarray
+        (2, L, width, N) coordinates, N being the longest line's sample
+        count. Shorter lines repeat their end point.
+    lengths : np.ndarray
+        Number of samples of each of the L lines.
+    """
+    lines = np.asarray(lines, dtype=float).reshape(-1, 2, 2)
+    start, end = lines[:,0], lines[:,1]
+    delta = end - start
+    length = np.linalg.norm(delta, axis=1)
+    lengths = np.ceil(length).astype(int) + 1
+    # fraction along each line, held at 1 past its end
+    t = np.arange(lengths.max())/np.maximum(lengths-1, 1)[:,None]
+    t = np.minimum(t, 1)
+    direction = delta/np.where(length > 0, length, 1)[:,None]
+    normal = np.stack([-direction[:,1], direction[:,0]], axis=1)
+    offsets = np.arange(width) - (width-1)/2
+    coords = (start[:,None,None,:]
+              + t[:,None,:,None]*delta[:,None,None,:]
+              + offsets[None,:,None,None]*normal[:,None,None,:])
+    return np.moveaxis(coords, -1, 0), lengths
+
+
+def average_profiles(values, lengths):
+    """Averages (L, width, N) samples across the width, NaN past each line's end"""
+    profiles = values.mean(axis=1)
+    profiles[np.arange(profiles.shape[1]) >= lengths[:,None]] = np.nan
+    return profiles
+
+
+def export_profiles(path, profiles):
+    """Saves a {layer name: (L, N) profiles} table
+
+    ``.npz`` files hold one (L, N) array per layer. Any other extension is
+    written as CSV with one row per sample: layer, line, index, value.
+    """
+    if str(path).endswith('.npz'):
+        np.savez(path, **profiles)
+        return
+    with open(path, 'w') as f:
+        f.write('layer,line,index,value\n')
+        for name, table in profiles.items():
+            line, index = np.nonzero(~np.isnan(table))
+            rows = np.column_stack([line, index, table[line, index]])
+            name = str(name).replace('%', '%%')
+            np.savetxt(f, rows, fmt=[f'{name},%d', '%d', '%.9g'], delimiter=',')
+
+
+def bilinear_weights(coords, shape):
+    """Corner indices and weights for bilinear interpolation
+
+    Coordinates outside the image are clamped to its edge.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        (2, ...) array of row and column coordinates.
+    shape : tuple of int
+        Shape of the sampled 2D image.
+
+    Returns
+    -------
+    corners : list of (np.ndarray, np.ndarray)
+        Row and column index arrays of the four corner pixels.
+    weights : list of np.ndarray
+        Interpolation weight of each corner.
+    """
+    lower = []
+    frac = []
+    upper = []
+    for c, n in zip(coords, shape):
+        c = np.clip(c, 0, n-1)
+        c0 = np.minimum(np.floor(c).astype(np.intp), max(n-2, 0))
+        lower.append(c0)
+        upper.append(np.minimum(c0+1, n-1))
+        frac.append(c - c0)
+    (r0, c0), (r1, c1), (fr, fc) = lower, upper, frac
+    corners = [(r0, c0), (r0, c1), (r1, c0), (r1, c1)]
+    weights = [(1-fr)*(1-fc), (1-fr)*fc, fr*(1-fc), fr*fc]
+    return corners, weights
+
+
+def sample_slices(slices, coords):
+    """Bilinearly samples each 2D slice at ``coords``
+
+    Parameters
+    ----------
+    slices : list of array-like
+        2D slices, possibly of different shapes.
+    coords : np.ndarray
+        (2, ...) array of row and column coordinates.
+
+    Returns
+    -------
+    list of np.ndarray
+        Sampled values for each slice, shaped like ``coords[0]``.
+    """
+    weights_by_shape = {}
+    samples = []
+    for image in slices:
+        image = np.asarray(image)
+        if image.shape not in weights_by_shape:
+            weights_by_shape[image.shape] = bilinear_weights(coords, image.shape)
+        corners, weights = weights_by_shape[image.shape]
+        values = sum(w*image[idx] for idx, w in zip(corners, weights))
+        samples.append(values)
+    return samples
+
+
+def chunk_shape(data):
+    """Storage chunk shape of a dask, h5py or zarr array, else its shape"""
+    chunks = getattr(data, 'chunksize', None)
+    if chunks is None:
+        chunks = getattr(data, 'chunks', None)
+    if chunks is None or not all(np.isscalar(c) for c in chunks):
+        chunks = data.shape
+    return tuple(int(c) for c in chunks)
+
+
+class ChunkCache:
+    """Reads and caches the tiles of a lazy array that hold requested voxels
+
+    Parameters
+    ----------
+    data : array-like
+        Array supporting basic slicing, e.g. a dask array or h5py dataset.
+    tile : tuple of int, optional
+        Tile shape. Defaults to the storage chunks, capped at ``TILE``.
+    max_tiles : int
+        Number of tiles kept, least recently used first out.
+    """
+    def __init__(self, data, tile=None, max_tiles=MAX_TILES):
+        self.data = data
+        if tile is None:
+            tile = tuple(min(c, TILE) for c in chunk_shape(data))
+        self.tile = tuple(tile)
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+
+    def _read(self, key):
+        try:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+        except KeyError:
+            pass
+        region = tuple(slice(k*t, (k+1)*t) for k, t in zip(key, self.tile))
+        block = np.asarray(self.data[region])
+        count('bytes read', block.nbytes)
+        self._tiles[key] = block
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return block
+
+    def gather(self, index):
+        """Values at integer ``index``, a tuple of one index array per axis
+
+        Only the tiles containing the indexed voxels are read.
+        """
+        index = np.broadcast_arrays(*index)
+        shape = index[0].shape
+        flat = [np.ravel(i) for i in index]
+        grid = tuple(-(-n//t) for n, t in zip(self.data.shape, self.tile))
+        keys = np.ravel_multi_index([i // t for i, t in zip(flat, self.tile)], grid)
+        # voxels grouped by tile, so each tile is read and indexed once
+        order = np.argsort(keys, kind='stable')
+        unique, bounds = np.unique(keys[order], return_index=True)
+        bounds = np.append(bounds, len(keys))
+
+        values = np.empty(len(keys), dtype=self.data.dtype)
+        for k, flat_key in enumerate(unique):
+            sel = order[bounds[k]:bounds[k+1]]
+            key = np.unravel_index(flat_key, grid)
+            block = self._read(tuple(int(kk) for kk in key))
+            values[sel] = block[tuple(i[sel] - kk*t for i, kk, t in zip(flat, key, self.tile))]
+        return values.reshape(shape)
+
+
+def sample_chunked(cache, coords, axis=None, index=None):
+    """Bilinearly samples a 2D slice of a lazy array at ``coords``
+
+    Parameters
+    ----------
+    cache : ChunkCache
+        Cache of the sampled array.
+    coords : np.ndarray
+        (2, ...) row and column coordinates within the slice.
+    axis, index : int or tuple of int, optional
+        For arrays of more than two dimensions, the sliced axis or axes and
+        the index of the slice along each.
+
+    Returns
+    -------
+    np.ndarray
+        Sampled values, shaped like ``coords[0]``.
+    """
+    if axis is None:
+        axis, index = (), ()
+    elif np.isscalar(axis):
+        axis, index = (axis,), (index,)
+    plane_shape = [n for a, n in enumerate(cache.data.shape) if a not in axis]
+    corners, weights = bilinear_weights(coords, plane_shape)
+    # all four corners in one gather
+    rows = np.stack([r for r, _ in corners])
+    cols = np.stack([c for _, c in corners])
+    voxel = [rows, cols]
+    for a, i in sorted(zip(axis, index)):
+        voxel.insert(a, np.full_like(rows, i))
+    values = cache.gather(voxel)
+    return sum(w*v for w, v in zip(weights, values))
+
+
+def plane_basis(normal):
+    """Unit normal and two in-plane unit vectors of a plane
+
+    The in-plane vectors come from Gram-Schmidt on the two axes least aligned
+    with the normal, so axis-aligned planes get plain axis vectors.
+    """
+    n = np.asarray(normal, dtype=float)
+    n = n/np.linalg.norm(n)
+    i, j = sorted(np.argsort(np.abs(n), kind='stable')[:2])
+    u = np.eye(3)[i] - n[i]*n
+    u /= np.linalg.norm(u)
+    v = np.eye(3)[j] - n[j]*n - (np.eye(3)[j] @ u)*u
+    v /= np.linalg.norm(v)
+    return n, u, v
+
+
+def slab_grid(shape, position, normal, thickness):
+    """Plane-aligned sampling grid of a slab through a volume
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (Z,Y,X) shape of the volume.
+    position, normal : array-like
+        Point on the plane and plane normal, in (z,y,x) voxel coordinates.
+    thickness : int
+        Number of unit-spaced planes in the slab, centred on the plane
+        (with the extra plane on the normal's side for even thicknesses).
+
+    Returns
+    -------
+    grid_shape : tuple of int
+        (thickness, H, W) shape of the slab, H and W covering the plane's
+        intersection with the volume.
+    affine : np.ndarray
+        (4, 4) affine mapping slab indices to volume coordinates.
+    """
+    n, u, v = plane_basis(normal)
+    position = np.asarray(position, dtype=float)
+    corners = np.array(list(itertools.product(*[(0, s-1) for s in shape]))) - position
+    u_range = corners @ u
+    v_range = corners @ v
+    u0, v0 = np.floor(u_range.min()), np.floor(v_range.min())
+    grid_shape = (thickness,
+                  int(np.ceil(u_range.max()) - u0) + 1,
+                  int(np.ceil(v_range.max()) - v0) + 1)
+    affine = np.eye(4)
+    affine[:3,:3] = np.column_stack([n, u, v])
+    affine[:3,3] = position - (thickness-1)//2*n + u0*u + v0*v
+    return grid_shape, affine
+
+
+def _aligned_slab(data, grid_shape, affine, axis):
+    """Slab of planes normal to ``axis``, sliced from the volume"""
+    shape = data.shape
+    step = int(np.sign(affine[axis,0]))
+    first = int(np.floor(affine[axis,3] + 0.5))
+    planes = first + step*np.arange(grid_shape[0])
+    inside = (planes >= 0) & (planes < shape[axis])
+    slab = np.zeros((grid_shape[0],) + tuple(n for a, n in enumerate(shape) if a != axis),
+                    dtype=data.dtype)
+    if inside.any():
+        lo, hi = planes[inside].min(), planes[inside].max() + 1
+        region = tuple(slice(lo, hi) if a == axis else slice(None) for a in range(len(shape)))
+        block = np.moveaxis(np.asarray(data[region]), axis, 0)
+        count('bytes read', block.nbytes)
+        slab[inside] = block[planes[inside] - lo]
+    # the in-plane axes run over the whole volume, from voxel 0
+    affine = affine.copy()
+    affine[:3,3] = 0
+    affine[axis,3] = first
+    return slab, affine
+
+
+def extract_slab(cache, position, normal, thickness):
+    """Nearest-neighbour samples of a slab of a lazy volume
+
+    Slabs normal to an axis are sliced from the volume. Oblique slabs are
+    sampled through ``cache`` in blocks of rows spanning the whole
+    thickness, so each block reads every tile it passes through once, and
+    tiles already in ``cache`` from earlier blocks and slabs are reused.
+    Samples outside the volume are zero.
+
+    Returns
+    -------
+    slab : np.ndarray
+        (thickness, H, W) samples, see ``slab_grid``.
+    affine : np.ndarray
+        (4, 4) affine placing ``slab`` in the volume's coordinates.
+    """
+    shape = cache.data.shape
+    grid_shape, affine = slab_grid(shape, position, normal, thickness)
+    axes = np.flatnonzero(normal)
+    if len(axes) == 1:
+        return _aligned_slab(cache.data, grid_shape, affine, axes[0])
+
+    slab = np.zeros(grid_shape, dtype=cache.data.dtype)
+    rows = max(1, SLAB_SAMPLES // (grid_shape[0]*grid_shape[2]))
+    for r0 in range(0, grid_shape[1], rows):
+        index = np.mgrid[:grid_shape[0], r0:min(r0+rows, grid_shape[1]), :grid_shape[2]]
+        index = index.reshape(3, -1)
+        voxel = np.floor(affine[:3,:3] @ index + affine[:3,3:] + 0.5).astype(np.intp)
+        inside = np.all((voxel >= 0) & (voxel < np.array(shape)[:,None]), axis=0)
+        slab[tuple(index[:,inside])] = cache.gather(tuple(voxel[:,inside]))
+    return slab, affine
@@ -0,0 +1,155 @@
+"""
+Stacks of morphology files, such as parameter sweeps or time series, read
+as one lazy layer per material with an extra leading axis.
+
+Each (file, chunk) is read only when napari displays it, so moving the
+stack slider reads the one file and slice shown. Every read also queues the
+same region of the neighbouring files on a background thread, so stepping
+through the stack finds them already in memory.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import h5py
+import dask.array as da
+
+from ._reader import material_datasets, _max_workers
+from ._cache import LRUCache
+from ._trace import span, count
+
+# neighbouring files prefetched on each side of the one read
+PREFETCH_STEPS = 2
+# prefetched blocks kept per material
+PREFETCH_BYTES = 2**28
+
+
+def _region_key(region, shape):
+    return tuple(r.indices(n) if isinstance(r, slice) else int(r) for r, n in zip(region, shape))
+
+
+class StackSource:
+    """Reads one dataset from each file of a stack, prefetching neighbours
+
+    Parameters
+    ----------
+    datasets : list of h5py.Dataset
+        The same dataset in every file, in stack order.
+    prefetch : int
+        Number of files on each side of a read whose same region is read
+        ahead on a background thread.
+    max_bytes : int
+        Size cap of the prefetched blocks kept.
+    """
+    def __init__(self, datasets, prefetch=PREFETCH_STEPS, max_bytes=PREFETCH_BYTES):
+        self.datasets = datasets
+        self.prefetch = prefetch
+        self.cache = LRUCache(max_bytes)
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix='cyrsoxs-prefetch')
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    def read(self, step, region):
+        """``datasets[step][region]``, from the prefetched blocks if there"""
+        key = (step, _region_key(region, self.datasets[step].shape))
+        block = self.cache.get(key)
+        if block is None:
+            block = self._read(key, region)
+        for offset in range(1, self.prefetch+1):
+            for neighbour in (step+offset, step-offset):
+                if 0 <= neighbour < len(self.datasets):
+                    self._queue(neighbour, region)
+        return block
+
+    def _read(self, key, region):
+        with span('stack read', step=key[0]):
+            block = self.datasets[key[0]][region]
+        count('bytes read', block.nbytes)
+        return block
+
+    def _queue(self, step, region):
+        key = (step, _region_key(region, self.datasets[step].shape))
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+        self._pool.submit(self._prefetch, key, region)
+
+    def _prefetch(self, key, region):
+        try:
+            if self.cache.get(key) is None:
+                block = self._read(key, region)
+                self.cache.put(key, block, block.nbytes)
+        finally:
+            with self._lock:
+                self._queued.discard(key)
+
+
+class StackMember:
+    """Array-like view of one file of a ``StackSource``, for ``da.from_array``"""
+    def __init__(self, source, step):
+        self.source = source
+        self.step = step
+        dset = source.datasets[step]
+        self.shape = dset.shape
+        self.dtype = dset.dtype
+        self.ndim = dset.ndim
+
+    def __getitem__(self, region):
+        if not isinstance(region, tuple):
+            region = (region,)
+        return self.source.read(self.step, region)
+
+
+def _open_files(paths, max_workers=None):
+    """Opens the files on a thread pool, in the order of ``paths``"""
+    with ThreadPoolExecutor(_max_workers(max_workers, len(paths))) as pool:
+        return list(pool.map(lambda path: h5py.File(path, 'r'), paths))
+
+
+def read_stack(paths, max_workers=None, prefetch=PREFETCH_STEPS):
+    """Returns one lazy (N,Z,Y,X) image layer per material of N morphology files
+
+    Parameters
+    ----------
+    paths : list of str
+        Morphology files with the same materials and shape, in stack order.
+    max_workers : int, optional
+        Number of threads the files are opened on, see ``read_hdf5``.
+    prefetch : int
+        Number of neighbouring files whose displayed region is read ahead.
+
+    Returns
+    -------
+    layer_data : list of tuples
+        (data, metadata, 'image') LayerData tuples. The files stay open for
+        as long as the dask arrays reference them. Alignment vectors are not
+        built for stacks.
+    """
+    with span('open stack', files=len(paths)):
+        files = _open_files(paths, max_workers)
+    materials = [material_datasets(h5) for h5 in files]
+    counts = {len(m) for m in materials}
+    shapes = {phi.shape for m in materials for phi, _ in m}
+    if len(counts) != 1 or len(shapes) != 1:
+        for h5 in files:
+            h5.close()
+        raise ValueError('Stacked morphologies need the same materials and shape, '
+                         f'got {sorted(counts)} materials and shapes {sorted(shapes)}')
+
+    layer_data_list = []
+    for i in range(counts.pop()):
+        datasets = [m[i][0] for m in materials]
+        source = StackSource(datasets, prefetch)
+        dset = datasets[0]
+        chunks = dset.chunks if dset.chunks is not None else (1,) + dset.shape[1:]
+        # an empty meta keeps dask from probing (and prefetching) the files
+        meta = np.empty((0,)*dset.ndim, dtype=dset.dtype)
+        data = da.stack([da.from_array(StackMember(source, step), chunks=chunks, name=False, meta=meta)
+                         for step in range(len(datasets))])
+        # fixed contrast limits keep napari from scanning the stack
+        meta = {'name':f'Mat_{i+1}_unaligned',
+                'contrast_limits':[0,1],
+                'metadata':{'paths':list(paths)}}
+        layer_data_list.append((data, meta, "image"))
+    return layer_data_list
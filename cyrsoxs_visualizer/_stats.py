@@ -0,0 +1,172 @@
+"""
+Headless morphology statistics for parameter sweeps.
+
+``morphology_stats`` streams a CyRSoXS morphology one Z-slab at a time and
+summarises each material: its volume fraction, aligned fraction, alignment
+magnitude histogram and orientation distribution, along with the composition
+sum of the file. ``main`` is the ``cyrsoxs-stats`` command, which runs it on
+many files in a process pool and collects one table.
+
+Usage::
+
+    cyrsoxs-stats sweep/*.hdf5 -o stats.parquet -j 16
+"""
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import h5py
+
+from ._reader import material_datasets
+from ._morphology import _slab_size
+
+# default number of histogram bins
+BINS = 10
+
+
+def _histogram(values, bins, upper, weights=None):
+    counts, _ = np.histogram(np.clip(values, 0, upper), bins=bins, range=(0, upper),
+                             weights=weights)
+    return counts
+
+
+def morphology_stats(path, bins=BINS):
+    """Per-material statistics of a morphology, read one Z-slab at a time
+
+    A material's volume fraction in a voxel is its unaligned fraction plus
+    the magnitude of its alignment vector, the aligned fraction. Alignment
+    component 0 is taken as the z axis, as in ``read_hdf5``. The vacuum
+    material ``write_morphology`` stores after the others is summarised,
+    and counted in the composition sum, like any other material.
+
+    Parameters
+    ----------
+    path : str
+        CyRSoXS morphology hdf5 file.
+    bins : int
+        Number of bins of each histogram.
+
+    Returns
+    -------
+    rows : list of dict
+        One row per stored material with the file, material number, mean
+        ``volume_fraction`` and ``aligned_fraction``, the composition sum
+        ``composition_min``, ``composition_mean`` and ``composition_max``
+        over the file, and the histograms as ``magnitude_hist_k`` (fraction
+        of voxels, magnitudes binned over [0, 1]), ``theta_hist_k`` (polar
+        angle from z over [0, 90] degrees) and ``psi_hist_k`` (azimuth in
+        the y-x plane over [0, 180] degrees). Orientation histograms are
+        weighted by the aligned fraction and normalised to sum to 1.
+    """
+    with h5py.File(path, 'r') as h5:
+        materials = material_datasets(h5, vacuum=True)
+        if not materials:
+            return []
+        shape = materials[0][0].shape
+        num_voxels = int(np.prod(shape))
+        s = materials[0][1]
+        slab = _slab_size(s.shape, s.dtype.itemsize)
+
+        fraction = np.zeros(len(materials))
+        aligned = np.zeros(len(materials))
+        magnitude_hist = np.zeros((len(materials), bins))
+        theta_hist = np.zeros((len(materials), bins))
+        psi_hist = np.zeros((len(materials), bins))
+        composition = [np.inf, 0.0, -np.inf]
+
+        for z0 in range(0, shape[0], slab):
+            total = 0
+            for k, (phi, s) in enumerate(materials):
+                block = np.asarray(s[z0:z0+slab])
+                magnitude = np.sqrt(np.einsum('...i,...i->...', block, block))
+                local = np.asarray(phi[z0:z0+slab]) + magnitude
+                total = total + local
+                fraction[k] += local.sum(dtype=np.float64)
+                aligned[k] += magnitude.sum(dtype=np.float64)
+                magnitude_hist[k] += _histogram(magnitude, bins, 1)
+
+                mask = magnitude > 0
+                if not mask.any():
+                    continue
+                vectors = block[mask]
+                weights = magnitude[mask]
+                # alignment is headless: s and -s are the same orientation
+                theta = np.degrees(np.arccos(np.clip(np.abs(vectors[:,0])/weights, 0, 1)))
+                psi = np.degrees(np.arctan2(vectors[:,1], vectors[:,2])) % 180
+                theta_hist[k] += _histogram(theta, bins, 90, weights)
+                psi_hist[k] += _histogram(psi, bins, 180, weights)
+            composition[0] = min(composition[0], float(total.min()))
+            composition[1] += float(total.sum(dtype=np.float64))
+            composition[2] = max(composition[2], float(total.max()))
+
+    rows = []
+    for k in range(len(materials)):
+        row = {
+            'file': os.path.abspath(path),
+            'material': k + 1,
+            'volume_fraction': fraction[k]/num_voxels,
+            'aligned_fraction': aligned[k]/num_voxels,
+            'composition_min': composition[0],
+            'composition_mean': composition[1]/num_voxels,
+            'composition_max': composition[2],
+        }
+        weight = max(aligned[k], np.finfo(float).tiny)
+        for name, hist, norm in (('magnitude', magnitude_hist, num_voxels),
+                                 ('theta', theta_hist, weight),
+                                 ('psi', psi_hist, weight)):
+            for b in range(bins):
+                row[f'{name}_hist_{b}'] = hist[k, b]/norm
+        rows.append(row)
+    return rows
+
+
+def write_table(rows, path):
+    """Writes rows of statistics as Parquet (``.parquet``, needs pandas) or CSV"""
+    if str(path).endswith('.parquet'):
+        try:
+            import pandas as pd
+        except ImportError as err:
+            raise ImportError('Writing Parquet tables requires pandas and pyarrow') from err
+        pd.DataFrame(rows).to_parquet(path, index=False)
+        return
+    fieldnames = list(rows[0]) if rows else ['file', 'material']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    """``cyrsoxs-stats`` command line entry point"""
+    parser = argparse.ArgumentParser(
+        prog='cyrsoxs-stats',
+        description='Per-material statistics of CyRSoXS morphology files.')
+    parser.add_argument('paths', nargs='+', help='morphology hdf5 files')
+    parser.add_argument('-o', '--output', default='morphology_stats.csv',
+                        help='output table, Parquet if it ends in .parquet, else CSV')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('--bins', type=int, default=BINS, help='histogram bins')
+    args = parser.parse_args(argv)
+
+    workers = min(args.workers or os.cpu_count() or 1, len(args.paths))
+    rows = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(morphology_stats, path, args.bins) for path in args.paths]
+        for path, future in zip(args.paths, futures):
+            try:
+                rows.extend(future.result())
+            except Exception as err:
+                # one bad file doesn't lose the rest of the sweep
+                print(f'cyrsoxs-stats: skipping {path}: {err}', file=sys.stderr)
+                failed += 1
+    write_table(rows, args.output)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""
+Iso-surfaces of material fractions, extracted one Z-slab at a time.
+
+Marching cubes runs on slabs that overlap by one plane, so every cube of
+the volume is in exactly one slab and the vertices on the shared planes
+come out identical in both and are merged when the slabs are stitched.
+Slabs of a morphology file are meshed on a process pool, each worker
+reading only its slab, and the stitched meshes are cached per file
+version, material and level in ``surface_cache``. Decimation is applied to
+the cached mesh, so changing it doesn't re-run marching cubes.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import h5py
+from skimage.measure import marching_cubes
+
+from ._cache import LRUCache, file_key
+from ._trace import span, count
+from ._morphology import _slab_size
+
+# approximate size of the float32 Z-slabs meshed at a time
+SURFACE_SLAB_BYTES = 2**24
+
+# stitched, undecimated meshes, shared by every viewer in the process
+surface_cache = LRUCache(os.environ.get('CYRSOXS_SURFACE_CACHE_BYTES', 2**30))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Process pool kept for the session, started with spawn so the Qt
+    state of a running viewer is not forked"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _empty_mesh():
+    return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.int64)
+
+
+def _slab_planes(shape):
+    """Planes added by each slab, not counting the shared one"""
+    return _slab_size(shape, 4, slab_bytes=SURFACE_SLAB_BYTES)
+
+
+def _slab_bounds(shape):
+    """(z0, z1) of each slab; slab planes are z0..z1 inclusive"""
+    planes = _slab_planes(shape)
+    return [(z0, min(z0+planes, shape[0]-1)) for z0 in range(0, shape[0]-1, planes)]
+
+
+def _mesh_block(block, level, z0):
+    """Marching cubes of one slab, with vertices in volume coordinates"""
+    # a writable copy; marching cubes rejects read-only (memory mapped) buffers
+    block = np.array(block, dtype=np.float32)
+    low, high = block.min(), block.max()
+    if not low <= level <= high or low == high:
+        return _empty_mesh()
+    try:
+        vertices, faces, _, _ = marching_cubes(block, level)
+    except RuntimeError:
+        # level at an extreme of the slab without crossing it
+        return _empty_mesh()
+    vertices[:,0] += z0
+    return vertices.astype(np.float32), faces.astype(np.int64, copy=False)
+
+
+def _mesh_file_slab(path, material, z0, z1, level):
+    """Process pool task: reads planes z0..z1 of a material's unaligned
+    fraction and meshes them"""
+    from ._reader import material_datasets, _open_dataset
+    with h5py.File(path, 'r') as h5:
+        block = _open_dataset(material_datasets(h5, vacuum=True, mmap=True)[material-1][0])[z0:z1+1]
+    return _mesh_block(block, level, z0)
+
+
+def stitch(meshes):
+    """Joins slab meshes into one, merging the vertices shared by neighbours
+
+    Parameters
+    ----------
+    meshes : list of (np.ndarray, np.ndarray)
+        (vertices, faces) of each slab.
+
+    Returns
+    -------
+    vertices : np.ndarray
+        (V,3) float32 vertices.
+    faces : np.ndarray
+        (F,3) int64 indices into ``vertices``.
+    """
+    meshes = [mesh for mesh in meshes if len(mesh[1])]
+    if not meshes:
+        return _empty_mesh()
+    offsets = np.cumsum([0] + [len(vertices) for vertices, _ in meshes[:-1]])
+    vertices = np.concatenate([vertices for vertices, _ in meshes])
+    faces = np.concatenate([faces + offset for (_, faces), offset in zip(meshes, offsets)])
+    vertices, index = np.unique(vertices, axis=0, return_inverse=True)
+    return vertices, index.ravel()[faces]
+
+
+def decimate(vertices, faces, cell):
+    """Vertex clustering decimation of a triangle mesh
+
+    Vertices in the same ``cell``-sized cube are merged into their mean,
+    and the triangles that collapse are dropped.
+
+    Parameters
+    ----------
+    vertices : np.ndarray
+        (V,3) vertices.
+    faces : np.ndarray
+        (F,3) indices into ``vertices``.
+    cell : float
+        Edge of the clustering cubes, in voxels. 0 returns the mesh as is.
+
+    Returns
+    -------
+    vertices, faces : np.ndarray
+        The decimated mesh.
+    """
+    if cell <= 0 or len(faces) == 0:
+        return vertices, faces
+    cells = np.floor(vertices/cell).astype(np.int64)
+    _, cluster, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cluster = cluster.ravel()
+    centroids = np.column_stack([np.bincount(cluster, weights=vertices[:,axis])
+                                 for axis in range(vertices.shape[1])])/counts[:,None]
+    faces = cluster[faces]
+    faces = faces[(faces[:,0] != faces[:,1]) & (faces[:,1] != faces[:,2]) & (faces[:,0] != faces[:,2])]
+    # triangles collapsed onto the same three clusters are kept once
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    faces = faces[np.sort(first)]
+    used, faces = np.unique(faces, return_inverse=True)
+    return centroids[used].astype(vertices.dtype), faces.reshape(-1, 3)
+
+
+def _mesh_nbytes(mesh):
+    return sum(array.nbytes for array in mesh)
+
+
+def material_surface(path, material=1, level=0.5, cell=0):
+    """Iso-surface of a material's unaligned fraction in a morphology file
+
+    Parameters
+    ----------
+    path : str
+        CyRSoXS morphology file.
+    material : int
+        Material number N, counted from 1 as in ``Mat_N_unaligned``.
+    level : float
+        Fraction the surface is drawn at.
+    cell : float
+        Decimation cell size in voxels, see ``decimate``. 0 keeps every
+        vertex.
+
+    Returns
+    -------
+    vertices, faces : np.ndarray
+        The stitched surface, in (Z,Y,X) voxel coordinates.
+    """
+    key = (file_key(path), material, float(level))
+    mesh = surface_cache.get(key)
+    if mesh is None:
+        from ._reader import material_datasets
+        with h5py.File(path, 'r') as h5:
+            materials = material_datasets(h5, vacuum=True)
+            if not 1 <= material <= len(materials):
+                raise ValueError(f'Material {material} not in 1..{len(materials)}')
+            shape = materials[material-1][0].shape
+        bounds = _slab_bounds(shape)
+        with span('marching cubes', material=material, slabs=len(bounds)):
+            if len(bounds) == 1:
+                meshes = [_mesh_file_slab(path, material, *bounds[0], level)]
+            else:
+                futures = [_get_pool().submit(_mesh_file_slab, path, material, z0, z1, level)
+                           for z0, z1 in bounds]
+                meshes = [future.result() for future in futures]
+            mesh = stitch(meshes)
+        for array in mesh:
+            array.flags.writeable = False
+        surface_cache.put(key, mesh, _mesh_nbytes(mesh))
+    count('surface faces', len(mesh[1]))
+    return decimate(*mesh, cell)
+
+
+def volume_surface(volume, level=0.5, cell=0):
+    """Iso-surface of an in-memory or lazy (Z,Y,X) volume
+
+    Slabs are meshed in this process, one at a time, and not cached. See
+    ``material_surface`` for the parameters.
+    """
+    with span('marching cubes'):
+        mesh = stitch([_mesh_block(volume[z0:z1+1], level, z0)
+                       for z0, z1 in _slab_bounds(volume.shape)])
+    return decimate(*mesh, cell)
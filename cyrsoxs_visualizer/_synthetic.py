@@ -0,0 +1,83 @@
+"""
+Synthetic CyRSoXS morphologies for tests and benchmarks.
+
+Files are written one Z-slab at a time, so volumes much larger than memory
+(e.g. 1024^3 with several materials) can be generated.
+"""
+import numpy as np
+import h5py
+
+from ._morphology import _slab_size
+
+
+def make_morphology(path, shape=(64, 64, 64), num_materials=2, sparsity=0.5,
+                    chunks=None, compression=None, dtype=np.float32, seed=0):
+    """Writes a random morphology in the layout read by ``read_hdf5``
+
+    Each voxel's material fractions are random and add up to 1, so the file
+    passes ``validate_morphology``. A material's fraction is split between
+    its unaligned dataset and the magnitude of its alignment vector, which
+    points in a random direction.
+
+    Parameters
+    ----------
+    path : str
+        Output hdf5 file.
+    shape : tuple of int
+        (Z,Y,X) shape of the morphology.
+    num_materials : int
+        Number of materials, not counting vacuum. Vacuum is stored as
+        material ``num_materials + 1``, as ``write_morphology`` does; with
+        the fractions adding up to 1 it is zero up to rounding.
+    sparsity : float
+        Fraction of voxels of each material without alignment.
+    chunks : tuple of int, optional
+        (Z,Y,X) HDF5 chunk shape. Datasets are contiguous by default, like
+        CyRSoXS output.
+    compression : str, optional
+        h5py compression filter, e.g. 'gzip' or 'lzf'. Requires ``chunks``.
+    dtype : numpy dtype
+        dtype of the datasets.
+    seed : int
+        Seed of the random generator; the same arguments give the same file.
+
+    Returns
+    -------
+    str
+        ``path``.
+    """
+    shape = tuple(shape)
+    rng = np.random.default_rng(seed)
+    options = dict(dtype=dtype, compression=compression)
+    slab = _slab_size(shape, np.dtype(dtype).itemsize*4*num_materials)
+
+    with h5py.File(path, 'w') as h5:
+        h5.create_dataset('igor_parameters/igormaterialnum', data=num_materials + 1)
+        datasets = []
+        for i in range(num_materials):
+            phi = h5.create_dataset(f'vector_morphology/Mat_{i+1}_unaligned', shape=shape,
+                                    chunks=chunks, **options)
+            s = h5.create_dataset(f'vector_morphology/Mat_{i+1}_alignment', shape=shape + (3,),
+                                  chunks=None if chunks is None else tuple(chunks) + (3,),
+                                  **options)
+            datasets.append((phi, s))
+        vacuum = h5.create_dataset(f'vector_morphology/Mat_{num_materials+1}_unaligned',
+                                   shape=shape, chunks=chunks, **options)
+        h5.create_dataset(f'vector_morphology/Mat_{num_materials+1}_alignment', shape=shape + (3,),
+                          chunks=None if chunks is None else tuple(chunks) + (3,),
+                          fillvalue=0, **options)
+
+        for z0 in range(0, shape[0], slab):
+            z1 = min(z0+slab, shape[0])
+            block_shape = (z1-z0,) + shape[1:]
+            fractions = rng.random((num_materials,) + block_shape, dtype=np.float32)
+            fractions /= fractions.sum(axis=0)
+            vacuum[z0:z1] = 1 - fractions.sum(axis=0)
+            for (phi, s), fraction in zip(datasets, fractions):
+                aligned = fraction*rng.random(block_shape, dtype=np.float32)
+                aligned[rng.random(block_shape, dtype=np.float32) < sparsity] = 0
+                direction = rng.standard_normal(block_shape + (3,), dtype=np.float32)
+                direction /= np.linalg.norm(direction, axis=-1, keepdims=True)
+                phi[z0:z1] = fraction - aligned
+                s[z0:z1] = direction*aligned[..., None]
+    return path
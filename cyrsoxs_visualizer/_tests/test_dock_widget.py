@@ -1,5 +1,7 @@
 import cyrsoxs_visualizer
+import napari
 import pytest
+import numpy as np
 
 # this is your plugin name declared in your napari.plugins entry point
 MY_PLUGIN_NAME = "cyrsoxs-visualizer"
@@ -16,3 +18,271 @@ def test_something_with_viewer(widget_name, make_napari_viewer, napari_plugin_ma
         plugin_name=MY_PLUGIN_NAME, widget_name=widget_name
     )
     assert len(viewer.window._dock_widgets) == num_dw + 1
+
+
+def test_dock_widgets_open_from_the_plugin(qtbot):
+    # napari only passes the viewer to widgets that ask for napari_viewer
+    from cyrsoxs_visualizer import _dock_widget
+
+    viewer = napari.Viewer(show=False)
+    try:
+        classes = {"Line Profiler": _dock_widget.LineProfiler,
+                   "3D Clipping Plane": _dock_widget.ClippingPlanes,
+                   "Alignment Vectors": _dock_widget.AlignmentVectors,
+                   "Fourier Preview": _dock_widget.FourierPreview}
+        for name, widget_class in classes.items():
+            _, widget = viewer.window.add_plugin_dock_widget(MY_PLUGIN_NAME, name)
+            assert isinstance(widget, widget_class)
+    finally:
+        viewer.close()
+
+
+def test_alignment_vectors_decimated(make_napari_viewer, qtbot):
+    from cyrsoxs_visualizer._dock_widget import AlignmentVectors
+
+    viewer = make_napari_viewer()
+    s = np.random.rand(8, 64, 64, 3).astype(np.float32)
+    viewer.add_image(np.random.rand(8, 64, 64), name='Mat_1_unaligned',
+                     metadata={'alignment': s})
+    widget = AlignmentVectors(viewer)
+    widget.max_vectors.setValue(500)
+    # the index is built on a worker thread
+    qtbot.waitUntil(lambda: widget.vectors_layer is not None, timeout=5000)
+
+    vectors = widget.vectors_layer.data
+    assert 0 < len(vectors) <= 500
+    # vectors sit on the displayed slice
+    step = viewer.dims.current_step[0]
+    np.testing.assert_array_equal(vectors[:,0,0], step)
+
+
+def test_alignment_index_kept_per_file_version(tmp_path, qtbot):
+    from napari.components import ViewerModel
+    from cyrsoxs_visualizer._dock_widget import AlignmentVectors
+    from cyrsoxs_visualizer._reader import read_hdf5
+    from cyrsoxs_visualizer._writer import write_morphology
+
+    path = str(tmp_path / 'morphology.hdf5')
+    s = np.random.rand(4, 16, 16, 3).astype(np.float32)
+    write_morphology(path, [(np.random.rand(4, 16, 16), {'name': 'Mat_1_unaligned',
+                                                         'metadata': {'alignment': s}}, 'image')])
+    viewer = ViewerModel()
+    viewer.dims.ndisplay = 3
+    data, meta, _ = read_hdf5(path, lazy=True, cache=False)[0]
+    viewer.add_image(data, **meta)
+    widget = AlignmentVectors(viewer)
+    qtbot.addWidget(widget)
+    qtbot.waitUntil(lambda: widget.vectors_layer is not None, timeout=5000)
+    key = widget.index_key(viewer.layers['Mat_1_unaligned'])
+    assert key[1] == '/vector_morphology/Mat_1_alignment'
+    index = widget.indexes[key]
+
+    # a renamed layer of the same file reuses the index
+    viewer.layers['Mat_1_unaligned'].name = 'renamed'
+    assert widget.get_index(viewer.layers['renamed']) is index
+    # the same name from a rewritten file gets a new one
+    s[:] = 0
+    write_morphology(path, [(np.random.rand(4, 16, 16), {'name': 'Mat_1_unaligned',
+                                                         'metadata': {'alignment': s}}, 'image')])
+    data, meta, _ = read_hdf5(path, lazy=True, cache=False)[0]
+    viewer.add_image(data, **meta)
+    assert widget.get_index(viewer.layers['Mat_1_unaligned']) is None
+    qtbot.waitUntil(lambda: len(widget.indexes) == 2, timeout=5000)
+
+
+def test_sample_slices_matches_profile_line():
+    from skimage import measure
+    from cyrsoxs_visualizer._sampling import line_coordinates, sample_slices
+
+    images = [np.random.rand(30, 40), np.random.rand(30, 40), np.random.rand(20, 20)]
+    start, end = (2.5, 3.0), (18.2, 17.9)
+    profiles = sample_slices(images, line_coordinates(start, end))
+    for image, profile in zip(images, profiles):
+        np.testing.assert_allclose(profile, measure.profile_line(image, start, end, mode='reflect'))
+
+
+def test_sample_chunked_reads_only_crossed_tiles():
+    import dask.array as da
+    from skimage import measure
+    from cyrsoxs_visualizer._sampling import line_coordinates, sample_chunked, ChunkCache
+
+    volume = np.random.rand(3, 64, 64)
+    cache = ChunkCache(da.from_array(volume, chunks=(1, 16, 16)), tile=(1, 16, 16))
+    start, end = (1.5, 2.0), (12.0, 40.5)
+    profile = sample_chunked(cache, line_coordinates(start, end), axis=0, index=2)
+    np.testing.assert_allclose(profile, measure.profile_line(volume[2], start, end, mode='reflect'))
+    # the line stays within the top row of tiles
+    assert {key[:2] for key in cache._tiles} == {(2, 0)}
+    assert len(cache._tiles) == 3
+
+
+def test_averaged_profiles_of_several_lines(tmp_path):
+    from skimage import measure
+    from cyrsoxs_visualizer._sampling import (profile_coordinates, average_profiles,
+                                              sample_slices, export_profiles)
+
+    image = np.random.rand(50, 60)
+    lines = [((5, 5), (40, 50)), ((10, 3), (12, 30.5))]
+    coords, lengths = profile_coordinates(lines, width=3)
+    profiles = average_profiles(sample_slices([image], coords)[0], lengths)
+    for (start, end), profile, length in zip(lines, profiles, lengths):
+        expected = measure.profile_line(image, start, end, linewidth=3, mode='reflect')
+        np.testing.assert_allclose(profile[:length], expected)
+        assert np.all(np.isnan(profile[length:]))
+
+    export_profiles(str(tmp_path / 'profiles.npz'), {'Mat_1': profiles})
+    np.testing.assert_array_equal(np.load(tmp_path / 'profiles.npz')['Mat_1'], profiles)
+    export_profiles(str(tmp_path / 'profiles.csv'), {'Mat_1': profiles})
+    table = np.loadtxt(tmp_path / 'profiles.csv', delimiter=',', skiprows=1, usecols=(1, 2, 3))
+    assert len(table) == lengths.sum()
+
+
+def test_line_profiler_on_stacked_layers(tmp_path, qtbot):
+    from napari.components import ViewerModel
+    from skimage import measure
+    from cyrsoxs_visualizer._dock_widget import LineProfiler
+    from cyrsoxs_visualizer._reader import read_hdf5
+    from cyrsoxs_visualizer._writer import write_morphology
+
+    steps = np.random.rand(2, 4, 32, 32)
+    paths = [str(tmp_path / f'step{i}.hdf5') for i in range(2)]
+    for path, phi in zip(paths, steps):
+        write_morphology(path, [(phi, {'name': 'Mat_1_unaligned'}, 'image')])
+    viewer = ViewerModel()
+    data, meta, _ = read_hdf5(paths)[0]
+    viewer.add_image(data, **meta)
+    viewer.add_image(steps, name='eager')
+    viewer.add_image(steps[0], name='volume')
+    widget = LineProfiler(viewer)
+    qtbot.addWidget(widget)
+    widget.shapes_layer.data = [np.array([[2., 3.], [25., 28.]])]
+    viewer.dims.set_current_step(0, 1)
+    viewer.dims.set_current_step(1, 2)
+    widget.profile_lines()
+
+    expected = measure.profile_line(steps[1, 2], (2, 3), (25, 28), mode='reflect')
+    np.testing.assert_allclose(widget.profiles['Mat_1_unaligned'][0], expected)
+    np.testing.assert_allclose(widget.profiles['eager'][0], expected)
+    # the volume lines up with the last three axes of the stacks
+    expected = measure.profile_line(steps[0, 2], (2, 3), (25, 28), mode='reflect')
+    np.testing.assert_allclose(widget.profiles['volume'][0], expected)
+
+
+def test_clipping_plane_skips_layers_it_stays_clear_of(make_napari_viewer):
+    from cyrsoxs_visualizer._dock_widget import ClippingPlanes
+
+    viewer = make_napari_viewer()
+    viewer.add_image(np.random.rand(64, 64, 64), name='large')
+    viewer.add_image(np.random.rand(16, 64, 64), name='small')
+    widget = ClippingPlanes(viewer)
+
+    widget._pending_position = np.array([10., 32., 32.])
+    widget._apply_plane_position()
+    widget._pending_position = np.array([40., 32., 32.])
+    widget._apply_plane_position()
+    widget._pending_position = np.array([55., 32., 32.])
+    widget._apply_plane_position()
+    # the plane left 'small' behind on the same side, so it was not updated
+    np.testing.assert_array_equal(viewer.layers['large'].experimental_clipping_planes[0].position, (55, 32, 32))
+    np.testing.assert_array_equal(viewer.layers['small'].experimental_clipping_planes[0].position, (40, 32, 32))
+
+
+def test_clipping_plane_position_kept_for_skipped_layers(qtbot):
+    from napari.components import ViewerModel
+    from cyrsoxs_visualizer._dock_widget import ClippingPlanes
+
+    viewer = ViewerModel()
+    viewer.add_image(np.random.rand(16, 64, 64), name='small')
+    viewer.add_image(np.random.rand(64, 64, 64), name='large')
+    widget = ClippingPlanes(viewer)
+    qtbot.addWidget(widget)
+    widget.slab_checkbox.setChecked(True)
+
+    for z in (10, 40, 55):
+        widget._pending_position = np.array([z, 32., 32.])
+        widget._apply_plane_position()
+    assert widget.plane_parameters['position'] == (55, 32, 32)
+    # 'small', the first layer, was skipped, but the slabs follow the plane
+    np.testing.assert_array_equal(viewer.layers['small'].experimental_clipping_planes[0].position, (40, 32, 32))
+    # slabs are extracted on a worker thread
+    qtbot.waitUntil(lambda: widget._slab_worker is None and not widget._slabs_pending, timeout=5000)
+    slab = viewer.layers['large slab']
+    z_origin = slab.affine.affine_matrix[0, -1]
+    assert z_origin <= 55 < z_origin + slab.data.shape[0]
+
+    # changing the normal gives every layer the same plane
+    widget.plane_parameters['normal'] = (0, 1, 0)
+    widget._sync_planes()
+    for layer in widget.get_clipped_layers():
+        plane = layer.experimental_clipping_planes[0]
+        np.testing.assert_array_equal(plane.position, (55, 32, 32))
+        np.testing.assert_array_equal(plane.normal, (0, 1, 0))
+
+
+def test_extract_slab():
+    from cyrsoxs_visualizer._sampling import ChunkCache, extract_slab
+
+    volume = np.random.rand(20, 30, 40)
+    cache = ChunkCache(volume, tile=(4, 8, 8))
+    slab, affine = extract_slab(cache, (10, 15, 20), (1, 0, 0), 4)
+    np.testing.assert_array_equal(slab, volume[9:13])
+    np.testing.assert_array_equal(affine[:3, 3], (9, 0, 0))
+    # axis-aligned slabs are sliced, not gathered through the tiles
+    assert not cache._tiles
+
+    slab, affine = extract_slab(cache, (10, 15, 20), (0, 0, 1), 1)
+    np.testing.assert_array_equal(slab[0], volume[:, :, 20])
+
+    # oblique slabs are placed back into the volume by their affine
+    slab, affine = extract_slab(cache, (10, 15, 20), (1, 1, 1), 3)
+    idx = np.argwhere(slab != 0)[::50]
+    voxels = np.floor(affine[:3, :3] @ idx.T + affine[:3, 3:] + 0.5).astype(int)
+    np.testing.assert_array_equal(slab[tuple(idx.T)], volume[tuple(voxels)])
+
+    # every tile an oblique slab passes through is read once, even when
+    # the cache can't hold them all
+    reads = []
+
+    class CountingCache(ChunkCache):
+        def _read(self, key):
+            if key not in self._tiles:
+                reads.append(key)
+            return super()._read(key)
+
+    cache = CountingCache(volume, tile=(4, 8, 8), max_tiles=1)
+    np.testing.assert_array_equal(extract_slab(cache, (10, 15, 20), (1, 1, 1), 3)[0], slab)
+    assert len(reads) == len(set(reads))
+
+
+def test_azimuthal_average_of_a_stripe_pattern():
+    from cyrsoxs_visualizer._fourier import radial_bins, slab_spectrum, azimuthal_average
+
+    y, x = np.mgrid[:64, :64]
+    stripes = np.sin(2*np.pi*x/8)
+    volume = np.stack([stripes, np.roll(stripes, 2, axis=1), stripes.T])
+    q, intensity = azimuthal_average(slab_spectrum(volume, 0, 1, thickness=3))
+    assert abs(q[np.argmax(intensity)] - 1/8) < 1/64
+    # bins are computed once per shape
+    assert radial_bins((64, 64)) is radial_bins((64, 64))
+
+
+def test_fourier_preview_follows_the_slice(qtbot):
+    from napari.components import ViewerModel
+    from cyrsoxs_visualizer._dock_widget import FourierPreview
+    from cyrsoxs_visualizer._fourier import slab_spectrum
+
+    viewer = ViewerModel()
+    volume = np.random.rand(8, 32, 32)
+    viewer.add_image(volume, name='Mat_1_unaligned')
+    viewer.add_image(np.random.rand(8, 32, 32), name='Mat_2_unaligned')
+    widget = FourierPreview(viewer)
+    qtbot.addWidget(widget)
+    widget.layer_combo.setCurrentText('Mat_1_unaligned')
+    # scroll faster than the spectra are computed
+    for step in range(8):
+        viewer.dims.set_current_step(0, step)
+    qtbot.waitUntil(lambda: widget._worker is None and not widget._pending, timeout=5000)
+
+    assert len(widget.ax_profile.lines) == 2
+    expected = np.log10(slab_spectrum(volume, 0, 7) + np.finfo(np.float32).tiny)
+    np.testing.assert_allclose(widget._spectrum_image.get_array(), expected, rtol=1e-5)
@@ -1,7 +1,241 @@
 # from cyrsoxs_visualizer import threshold, image_arithmetic
+import os
+import numpy as np
+import pytest
+from cyrsoxs_visualizer import _function, _morphology
+from cyrsoxs_visualizer._function import (validate_morphology, COMPOSITION_SUM,
+                                          NON_FINITE, ALIGNMENT_EXCEEDS_FRACTION)
+from cyrsoxs_visualizer._reader import read_hdf5
+from cyrsoxs_visualizer._writer import write_morphology
+import h5py
 
 # add your tests here...
 
 
 def test_something():
     pass
+
+
+def _write_morphology(path, phi, s):
+    """Writes the materials with the plugin's writer, which adds vacuum"""
+    write_morphology(path, [(p, {'name': f'Mat_{i+1}_unaligned', 'metadata': {'alignment': a}}, 'image')
+                            for i, (p, a) in enumerate(zip(phi, s))])
+
+
+def test_validate_morphology(tmp_path, monkeypatch):
+    # force several slabs
+    monkeypatch.setattr(_morphology, 'SLAB_BYTES', 1)
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    # material 1 and the vacuum the writer adds, adding up to 1
+    phi = np.random.rand(3, 4, 5).astype(np.float32)*0.5
+    s = np.zeros((3, 4, 5, 3), dtype=np.float32)
+    s[..., 2] = 0.25
+    _write_morphology(my_test_file, [phi], [s])
+    assert validate_morphology(my_test_file).max() == 0
+    # then broken in place
+    with h5py.File(my_test_file, 'a') as f:
+        phi, vacuum = f['vector_morphology/Mat_1_unaligned'], f['vector_morphology/Mat_2_unaligned']
+        phi[0, 0, 0] = np.nan
+        phi[1, 2, 3] += 0.1
+        phi[2, 3, 4], vacuum[2, 3, 4] = -0.1, 0.85
+        phi = phi[()]
+
+    labels = validate_morphology(my_test_file)
+    assert labels.dtype == np.uint8
+    expected = np.zeros(phi.shape, dtype=np.uint8)
+    expected[0, 0, 0] = NON_FINITE
+    expected[1, 2, 3] = COMPOSITION_SUM
+    expected[2, 3, 4] = ALIGNMENT_EXCEEDS_FRACTION
+    np.testing.assert_array_equal(labels, expected)
+
+    with pytest.warns(UserWarning, match='failed validation'):
+        layer_data_list = read_hdf5(my_test_file, cache=False, validate=True)
+    data, meta, layer_type = layer_data_list[-1]
+    assert layer_type == 'labels'
+    np.testing.assert_array_equal(data, expected)
+    assert meta['metadata']['failures'] == {'composition sum': 1, 'NaN/Inf': 1,
+                                            'alignment exceeds fraction': 1}
+
+
+def test_open_multiscale(tmp_path):
+    from cyrsoxs_visualizer import _pyramid
+
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    _write_morphology(my_test_file, [np.random.rand(5, 33, 32)], [np.zeros((5, 33, 32, 3))])
+    layer_data_list = _function.open_multiscale(my_test_file)
+    assert [meta['name'] for _, meta, _ in layer_data_list] == ['Mat_1_unaligned']
+    assert all(meta['multiscale'] for _, meta, _ in layer_data_list)
+    # the sidecar it leaves is used by default
+    assert os.path.exists(_pyramid.sidecar_path(my_test_file))
+    assert read_hdf5(my_test_file, lazy=True, cache=False)[0][1]['multiscale']
+
+
+def test_image_arithmetic_dtype_and_out():
+    a = np.random.rand(3, 4, 5)
+    b = np.random.rand(3, 4, 5)
+    result, _ = _function.image_arithmetic(a, _function.Operation.divide, b)
+    assert result.dtype == np.float64
+    np.testing.assert_array_equal(result, a/b)
+    counts = np.arange(60, dtype=np.uint8).reshape(3, 4, 5)
+    result, _ = _function.image_arithmetic(counts, _function.Operation.divide, counts + 1)
+    assert result.dtype == np.float32
+
+    # in place
+    expected = a + b
+    result, _ = _function.image_arithmetic(a, _function.Operation.add, b, out=a)
+    assert result is a
+    np.testing.assert_array_equal(a, expected)
+
+
+def test_function_widget_options(qtbot):
+    from magicgui import magicgui
+    widget = magicgui(validate_morphology)
+    assert widget.tolerance.step == 1e-4
+    assert not widget.out.visible
+    widget = magicgui(_function.interface_surface)
+    assert (widget.level.step, widget.decimation.step) == (0.01, 0.5)
+    assert not magicgui(_function.image_arithmetic).out.visible
+
+
+def test_threshold_uint8():
+    import dask.array as da
+    from cyrsoxs_visualizer._function import threshold
+
+    data = np.random.rand(4, 5, 6)*10
+    mask = threshold(da.from_array(data, chunks=(1, 5, 6)), 5)
+    assert mask.dtype == np.uint8
+    np.testing.assert_array_equal(mask, data > 5)
+
+
+def test_morphology_operations(monkeypatch):
+    import dask.array as da
+    from cyrsoxs_visualizer._morphology import (vacuum_fraction, dominant_material, alignment_magnitude,
+                                                alignment_orientation, renormalize, Angle)
+
+    # force several slabs
+    monkeypatch.setattr(_morphology, 'SLAB_BYTES', 1)
+    phi = [np.random.rand(3, 4, 5).astype(np.float32)*0.3 for _ in range(2)]
+    s = np.zeros((3, 4, 5, 3), dtype=np.float32)
+    s[..., 0] = 0.1
+    s[0, 0, 0] = (0, 0.2, -0.2)
+    materials = [(da.from_array(phi[0], chunks=(1, 4, 5)), None), (phi[1], s)]
+    fractions = [phi[0], phi[1] + np.linalg.norm(s, axis=-1)]
+
+    vacuum = vacuum_fraction(materials)
+    assert vacuum.dtype == np.float32
+    np.testing.assert_allclose(vacuum, 1 - fractions[0] - fractions[1], rtol=1e-6)
+
+    labels = dominant_material(materials)
+    assert labels.dtype == np.uint8
+    np.testing.assert_array_equal(labels, np.argmax([vacuum] + fractions, axis=0))
+
+    magnitude = np.empty((3, 4, 5), dtype=np.float32)
+    assert alignment_magnitude(s, out=magnitude) is magnitude
+    np.testing.assert_allclose(magnitude, np.linalg.norm(s, axis=-1), rtol=1e-6)
+
+    theta = alignment_orientation(s, Angle.theta)
+    psi = alignment_orientation(s, Angle.psi)
+    np.testing.assert_allclose(theta[1:], 0)
+    np.testing.assert_allclose((theta[0, 0, 0], psi[0, 0, 0]), (90, 135))
+
+    # in place
+    phi_copy, s_copy = phi[1].copy(), s.copy()
+    out = [(phi[0].copy(), None), (phi_copy, s_copy)]
+    renormalize(out, out=out)
+    total = out[0][0] + out[1][0] + np.linalg.norm(out[1][1], axis=-1)
+    np.testing.assert_allclose(total, 1, rtol=1e-5)
+    np.testing.assert_allclose(out[1][1], s*(out[1][0]/phi[1])[..., None], rtol=1e-5)
+
+
+def test_vector_field():
+    from cyrsoxs_visualizer._morphology import VectorField
+    from cyrsoxs_visualizer._reader import alignment_to_vectors
+
+    s = np.random.rand(5, 4, 3, 3).astype(np.float32)
+    s[np.random.rand(5, 4, 3) > 0.5] = 0
+    vectors = alignment_to_vectors(s)
+    field = VectorField(vectors, s.shape[:-1])
+    assert field.shape == s.shape
+    np.testing.assert_array_equal(field[1:4], s[1:4])
+    np.testing.assert_array_equal(field[0:5], s)
+    # vectors in Z order are not sorted again
+    order, z = field.z_index()
+    assert order is None and z.dtype == np.int32
+
+    # nor need they be in Z order
+    field = VectorField(vectors[::-1], s.shape[:-1])
+    np.testing.assert_array_equal(field[1:4], s[1:4])
+
+
+def _sphere(shape=(12, 14, 16), radius=5):
+    z, y, x = np.indices(shape)
+    r = np.sqrt((z - shape[0]/2)**2 + (y - shape[1]/2)**2 + (x - shape[2]/2)**2)
+    return np.clip(radius + 0.5 - r, 0, 1).astype(np.float32)
+
+
+def _faces(vertices, faces):
+    # marching cubes works in float32, so z inside a slab may differ in the last bit
+    return {frozenset(map(tuple, np.round(vertices[face], 4))) for face in faces}
+
+
+def test_surface_stitching(monkeypatch):
+    from cyrsoxs_visualizer import _surface
+
+    phi = _sphere()
+    whole = _surface.volume_surface(phi)
+    # one plane per slab
+    monkeypatch.setattr(_surface, 'SURFACE_SLAB_BYTES', 1)
+    stitched = _surface.volume_surface(phi)
+    # the vertices shared by neighbouring slabs are merged
+    assert len(whole[0]) == len(stitched[0])
+    np.testing.assert_allclose(np.unique(whole[0], axis=0), stitched[0], rtol=1e-6)
+    assert _faces(*whole) == _faces(*stitched)
+
+    vertices, faces = _surface.decimate(*stitched, 2)
+    assert 0 < len(faces) < len(stitched[1])
+    assert faces.max() == len(vertices) - 1
+    assert len(_surface.volume_surface(phi, level=2)[1]) == 0
+
+
+def test_material_surface_cache(tmp_path, monkeypatch):
+    from cyrsoxs_visualizer import _surface
+
+    _surface.surface_cache.clear()
+    monkeypatch.setattr(_surface, 'SURFACE_SLAB_BYTES', 14*16*4*4)
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    phi = _sphere()
+    # the writer stores 1 - phi as vacuum, Mat_2
+    _write_morphology(my_test_file, [phi], [None])
+
+    vertices, faces = _surface.material_surface(my_test_file, 1, 0.5)
+    expected = _surface.volume_surface(phi, 0.5)
+    np.testing.assert_allclose(vertices, expected[0], rtol=1e-6)
+    # other decimation, same level: served from the cache
+    decimated = _surface.material_surface(my_test_file, 1, 0.5, cell=2)
+    assert len(decimated[1]) < len(faces)
+    _surface.material_surface(my_test_file, 2, 0.5)
+    info = _surface.surface_cache.info()
+    assert (info.hits, info.misses, info.entries) == (1, 2, 2)
+
+
+def test_interface_surface(tmp_path):
+    from napari.components import ViewerModel
+
+    viewer = ViewerModel()
+    phi = _sphere()
+    viewer.add_image(phi, name='Mat_1_unaligned')
+    (vertices, faces), meta, layer_type = _function.interface_surface(viewer, 1, 0.5, 0)
+    assert layer_type == 'surface' and meta['name'] == 'Mat_1 surface 0.5'
+    assert len(faces) > 0
+    with pytest.raises(ValueError, match='no surface'):
+        _function.interface_surface(viewer, 1, 2.0, 0)
+
+    # layers read from a file are meshed from it
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    _write_morphology(my_test_file, [phi], [None])
+    viewer = ViewerModel()
+    for data, meta, layer_type in read_hdf5(my_test_file, cache=False):
+        viewer._add_layer_from_data(data, meta, layer_type)
+    assert viewer.layers['Mat_1_unaligned'].metadata['path'] == my_test_file
+    (file_vertices, _), _, _ = _function.interface_surface(viewer, 1, 0.5, 0)
+    np.testing.assert_allclose(file_vertices, vertices, rtol=1e-6)
@@ -0,0 +1,33 @@
+import subprocess
+import sys
+
+# modules napari startup must not pay for when discovering the plugin
+HEAVY_MODULES = ['h5py', 'dask', 'matplotlib', 'napari', 'qtpy', 'skimage', 'magicgui', 'scipy']
+
+
+def _imported_modules(code):
+    """Top-level packages imported by ``code``, from ``python -X importtime``"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return modules
+
+
+def test_import_is_light():
+    modules = _imported_modules('import cyrsoxs_visualizer')
+    assert 'cyrsoxs_visualizer' in modules
+    assert not modules.intersection(HEAVY_MODULES)
+
+
+def test_hooks_are_light():
+    modules = _imported_modules(
+        'import cyrsoxs_visualizer as c\n'
+        'assert callable(c.napari_get_reader("morphology.hdf5"))\n'
+        'assert callable(c.napari_get_writer("morphology.hdf5", ["image"]))\n'
+        'assert all(callable(w) for w, _ in c.napari_experimental_provide_dock_widget())\n'
+        'functions = c.napari_experimental_provide_function()\n'
+        'assert functions and all(callable(f) for f in functions)\n')
+    assert not modules.intersection(HEAVY_MODULES)
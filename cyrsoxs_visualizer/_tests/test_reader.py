@@ -1,6 +1,13 @@
+import os
 import numpy as np
 from cyrsoxs_visualizer import napari_get_reader
+from cyrsoxs_visualizer._reader import read_hdf5, alignment_to_vectors
+from cyrsoxs_visualizer import _reader, _morphology
+from cyrsoxs_visualizer import _pyramid
+from cyrsoxs_visualizer._cache import LRUCache
+from cyrsoxs_visualizer._stack import StackSource
 import h5py
+import pytest
 
 
 # tmp_path is a pytest fixture
@@ -34,11 +41,273 @@ def test_reader(tmp_path):
     # np.testing.assert_allclose(original_data_aligned,layer_data_list[1][0])
 
 
+def test_reader_lazy(tmp_path):
+    my_test_file = str(tmp_path / "myfile.hd5")
+    original_data_unaligned = np.random.rand(4, 20, 20)
+    original_data_aligned = np.random.rand(4, 20, 20, 3)
+    with h5py.File(my_test_file,'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum',data=2)
+        f.create_dataset('vector_morphology/Mat_1_unaligned',data=original_data_unaligned)
+        f.create_dataset('vector_morphology/Mat_1_alignment',data=original_data_aligned,
+                         chunks=(2,10,10,3))
+
+    layer_data_list = read_hdf5(my_test_file, lazy=True)
+    assert len(layer_data_list) == 1
+    data, meta, layer_type = layer_data_list[0]
+    assert layer_type == 'image'
+    # contiguous datasets are chunked one plane at a time
+    assert data.chunksize == (1, 20, 20)
+    np.testing.assert_allclose(original_data_unaligned[2], data[2])
+
+    alignment = meta['metadata']['alignment']
+    assert alignment.chunksize == (2, 10, 10, 3)
+    np.testing.assert_allclose(original_data_aligned, alignment)
+
+
+def test_reader_multiscale(tmp_path, monkeypatch):
+    monkeypatch.setattr(_pyramid, 'MIN_PYRAMID_SIZE', 8)
+    my_test_file = str(tmp_path / "myfile.hd5")
+    original_data_unaligned = np.random.rand(5, 33, 32)
+    with h5py.File(my_test_file,'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum',data=2)
+        f.create_dataset('vector_morphology/Mat_1_unaligned',data=original_data_unaligned)
+        f.create_dataset('vector_morphology/Mat_1_alignment',data=np.zeros((5,33,32,3)))
+
+    # no sidecar is built unless asked for
+    sidecar = _pyramid.sidecar_path(my_test_file)
+    data, meta, _ = read_hdf5(my_test_file, lazy=True)[0]
+    assert 'multiscale' not in meta and not os.path.exists(sidecar)
+
+    data, meta, _ = read_hdf5(my_test_file, multiscale=True)[0]
+    assert meta['multiscale']
+    assert [level.shape for level in data] == [(5,33,32), (3,17,16), (2,9,8), (1,5,4)]
+    np.testing.assert_allclose(data[1][0,0,0], original_data_unaligned[:2,:2,:2].mean(), rtol=1e-6)
+    mtime = os.stat(sidecar).st_mtime_ns
+
+    # reopening reuses the sidecar, also by default once it exists
+    read_hdf5(my_test_file, multiscale=True)
+    assert os.stat(sidecar).st_mtime_ns == mtime
+    assert read_hdf5(my_test_file, lazy=True)[0][1]['multiscale']
+    assert 'multiscale' not in read_hdf5(my_test_file, lazy=True, multiscale=False)[0][1]
+
+
+def test_alignment_to_vectors(monkeypatch):
+    # force several slabs
+    monkeypatch.setattr(_morphology, 'SLAB_BYTES', 1)
+    s = np.random.rand(5, 6, 7, 3).astype(np.float32) - 0.5
+    s[np.random.rand(5, 6, 7) > 0.3] = 0
+
+    vectors = alignment_to_vectors(s)
+    assert vectors.dtype == np.float32
+    idx = np.linalg.norm(s, axis=-1) > 0
+    np.testing.assert_array_equal(vectors[:,0], np.column_stack(np.nonzero(idx)))
+    np.testing.assert_array_equal(vectors[:,1], s[idx])
+
+    vectors = alignment_to_vectors(s, stride=2, threshold=0.3)
+    strided = s[::2,::2,::2]
+    idx = np.linalg.norm(strided, axis=-1) > 0.3
+    np.testing.assert_array_equal(vectors[:,0], 2*np.column_stack(np.nonzero(idx)))
+    np.testing.assert_array_equal(vectors[:,1], strided[idx])
+
+
+def test_reader_parallel_order(tmp_path):
+    my_test_file = str(tmp_path / "myfile.hd5")
+    with h5py.File(my_test_file,'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum',data=5)
+        for i in range(4):
+            f.create_dataset(f'vector_morphology/Mat_{i+1}_unaligned',data=np.full((2,8,8),i))
+            f.create_dataset(f'vector_morphology/Mat_{i+1}_alignment',data=np.ones((2,8,8,3)))
+
+    serial = read_hdf5(my_test_file, max_workers=1)
+    parallel = read_hdf5(my_test_file, max_workers=4)
+    assert [meta['name'] for _, meta, _ in parallel] == [meta['name'] for _, meta, _ in serial]
+    for i in range(4):
+        np.testing.assert_array_equal(parallel[2*i][0], i)
+
+
+def test_reader_cache(tmp_path):
+    _reader.reader_cache.clear()
+    my_test_file = str(tmp_path / "myfile.hd5")
+    with h5py.File(my_test_file,'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum',data=2)
+        f.create_dataset('vector_morphology/Mat_1_unaligned',data=np.random.rand(2,8,8))
+        f.create_dataset('vector_morphology/Mat_1_alignment',data=np.random.rand(2,8,8,3))
+
+    first = read_hdf5(my_test_file)
+    second = read_hdf5(my_test_file)
+    info = _reader.cache_info()
+    assert (info.hits, info.misses, info.entries) == (1, 1, 1)
+    assert info.nbytes == sum(data.nbytes for data, _, _ in first)
+    # both reads share the cached, read-only arrays
+    assert np.shares_memory(first[0][0], second[0][0])
+    assert not second[0][0].flags.writeable
+
+    # a changed file is a cache miss
+    with h5py.File(my_test_file,'a') as f:
+        f['vector_morphology/Mat_1_unaligned'][0] = 0
+    np.testing.assert_array_equal(read_hdf5(my_test_file)[0][0][0], 0)
+    assert _reader.cache_info().misses == 2
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(max_bytes=10)
+    cache.put('a', 'a', 4)
+    cache.put('b', 'b', 4)
+    cache.get('a')
+    cache.put('c', 'c', 4)
+    assert cache.get('b') is None
+    assert cache.get('a') == 'a'
+    assert cache.info().nbytes == 8
+
+
+def test_reader_memmap(tmp_path):
+    my_test_file = str(tmp_path / "myfile.hd5")
+    phi = np.random.rand(4, 8, 8)
+    s = np.random.rand(4, 8, 8, 3)
+    with h5py.File(my_test_file,'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum',data=3)
+        f.create_dataset('vector_morphology/Mat_1_unaligned',data=phi)
+        f.create_dataset('vector_morphology/Mat_1_alignment',data=s)
+        f.create_dataset('vector_morphology/Mat_2_unaligned',data=phi,
+                         chunks=(1,8,8),compression='gzip')
+        f.create_dataset('vector_morphology/Mat_2_alignment',data=s)
+        f.create_dataset('empty',shape=(4,8,8))
+
+    with h5py.File(my_test_file,'r') as f:
+        mapped = _reader.memmap_dataset(f['vector_morphology/Mat_1_unaligned'])
+        assert _reader.memmap_dataset(f['vector_morphology/Mat_2_unaligned']) is None
+        # never written, so not allocated in the file
+        assert _reader.memmap_dataset(f['empty']) is None
+    # the map outlives the file
+    assert isinstance(mapped, np.memmap) and not mapped.flags.writeable
+    np.testing.assert_array_equal(mapped, phi)
+
+    # eager reads copy unless asked to map
+    assert not isinstance(read_hdf5(my_test_file, cache=False)[0][0], np.memmap)
+    layers = read_hdf5(my_test_file, cache=False, mmap=True)
+    assert isinstance(layers[0][0], np.memmap)
+    assert not isinstance(layers[2][0], np.memmap)
+    np.testing.assert_array_equal(layers[2][0], phi)
+    np.testing.assert_array_equal(layers[3][0][:,1], layers[1][0][:,1])
+
+    # and so do lazy reads
+    def mapped_graph(data):
+        return any(isinstance(value, np.memmap) for value in dict(data.dask).values())
+    assert not mapped_graph(read_hdf5(my_test_file, lazy=True)[0][0])
+    data = read_hdf5(my_test_file, lazy=True, mmap=True)[0][0]
+    assert mapped_graph(data)
+    np.testing.assert_array_equal(data, phi)
+
+    lazy = read_hdf5(my_test_file, lazy=True)
+    np.testing.assert_array_equal(lazy[0][0][1], phi[1])
+    np.testing.assert_array_equal(lazy[0][1]['metadata']['alignment'][2], s[2])
+
+
+def _write_euler(path, shape=(4,8,8), num_mat=2, **options):
+    rng = np.random.default_rng(0)
+    fields = {}
+    with h5py.File(path,'w') as f:
+        for i in range(num_mat):
+            fields[i] = {'Vfrac': rng.random(shape)/num_mat, 'S': rng.random(shape),
+                         'Theta': rng.random(shape)*np.pi/2, 'Psi': rng.random(shape)*np.pi}
+            for name, data in fields[i].items():
+                f.create_dataset(f'Euler_Angles/Mat_{i+1}_{name}', data=data, **options)
+    return fields
+
+
+def test_reader_euler(tmp_path):
+    from cyrsoxs_visualizer._morphology import alignment_orientation, Angle
+
+    my_test_file = str(tmp_path / "euler.hdf5")
+    fields = _write_euler(my_test_file)
+    f = fields[1]
+    unaligned = f['Vfrac']*(1 - f['S'])
+    aligned = f['Vfrac']*f['S']
+    alignment = aligned[...,None]*np.stack([np.cos(f['Theta']),
+                                            np.sin(f['Theta'])*np.sin(f['Psi']),
+                                            np.sin(f['Theta'])*np.cos(f['Psi'])], axis=-1)
+
+    layers = read_hdf5(my_test_file, cache=False)
+    assert [meta['name'] for _, meta, _ in layers] == ['Mat_1_unaligned', 'Mat_1_alignment',
+                                                       'Mat_2_unaligned', 'Mat_2_alignment']
+    np.testing.assert_allclose(layers[2][0], unaligned, rtol=1e-6)
+    np.testing.assert_allclose(layers[3][0][:,1], alignment.reshape(-1, 3), rtol=1e-5, atol=1e-7)
+
+    data, meta, _ = read_hdf5(my_test_file, lazy=True)[1]
+    s = meta['metadata']['alignment']
+    assert s.shape == (4, 8, 8, 3) and s.chunksize == (1, 8, 8, 3)
+    np.testing.assert_allclose(data[2], unaligned[2], rtol=1e-6)
+    np.testing.assert_allclose(s[1, 2:5, :, 0], alignment[1, 2:5, :, 0], rtol=1e-5, atol=1e-7)
+    # the decoded orientation is the stored one
+    theta = alignment_orientation(s, Angle.theta)
+    np.testing.assert_allclose(theta, np.degrees(f['Theta']), atol=1e-3)
+
+    # chunked datasets are decoded through h5py
+    chunked_file = str(tmp_path / "euler_chunked.hdf5")
+    _write_euler(chunked_file, chunks=(1,8,8))
+    np.testing.assert_allclose(read_hdf5(chunked_file, lazy=True)[1][0][3], unaligned[3], rtol=1e-6)
+
+
+def _write_step(path, value, shape=(4,8,8)):
+    with h5py.File(path,'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum',data=2)
+        f.create_dataset('vector_morphology/Mat_1_unaligned',data=np.full(shape,value))
+        f.create_dataset('vector_morphology/Mat_1_alignment',data=np.zeros(shape+(3,)))
+
+
+def test_reader_stack(tmp_path):
+    paths = [str(tmp_path / f"step{i}.hd5") for i in range(3)]
+    for i, path in enumerate(paths):
+        _write_step(path, i)
+
+    reader = napari_get_reader(paths)
+    assert callable(reader)
+    layer_data_list = reader(paths)
+    assert len(layer_data_list) == 1
+    data, meta, layer_type = layer_data_list[0]
+    assert layer_type == 'image' and meta['metadata']['paths'] == paths
+    assert data.shape == (3, 4, 8, 8)
+    np.testing.assert_array_equal(data[:,2,0,0], [0, 1, 2])
+
+    # reading one step prefetches the same region of its neighbours
+    source = StackSource([h5py.File(path,'r')['vector_morphology/Mat_1_unaligned'] for path in paths])
+    region = (slice(1,2), slice(0,8), slice(0,8))
+    np.testing.assert_array_equal(source.read(0, region), 0)
+    source._pool.shutdown(wait=True)
+    key = (2, tuple(r.indices(n) for r, n in zip(region, (4,8,8))))
+    np.testing.assert_array_equal(source.cache.get(key), 2)
+
+
+def test_reader_stack_mismatch(tmp_path):
+    paths = [str(tmp_path / "a.hd5"), str(tmp_path / "b.hd5")]
+    _write_step(paths[0], 0)
+    _write_step(paths[1], 1, shape=(2,8,8))
+    with pytest.raises(ValueError, match='same materials and shape'):
+        read_hdf5(paths)
+    assert napari_get_reader(paths + ["notes.txt"]) is None
+
+
 def test_get_reader_pass():
     reader = napari_get_reader("fake.file")
     assert reader is None
 
 
+def test_synthetic_morphology(tmp_path):
+    from cyrsoxs_visualizer._synthetic import make_morphology
+    from cyrsoxs_visualizer._function import validate_morphology
+
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    make_morphology(my_test_file, (6, 8, 10), num_materials=3, sparsity=0.75,
+                    chunks=(2, 8, 8), compression='gzip')
+    layer_data_list = read_hdf5(my_test_file, cache=False)
+    images = [data for data, _, layer_type in layer_data_list if layer_type == 'image']
+    vectors = [data for data, _, layer_type in layer_data_list if layer_type == 'vectors']
+    assert len(images) == 3 and images[0].shape == (6, 8, 10)
+    # about a quarter of the voxels of each material are aligned
+    assert all(0 < len(v) < 0.5*images[0].size for v in vectors)
+    assert not validate_morphology(my_test_file).any()
+
+
 # if __name__ == '__main__':
 #     import pathlib
 #     tmp_path = pathlib.Path('.').absolute()
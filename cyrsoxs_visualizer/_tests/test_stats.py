@@ -0,0 +1,66 @@
+import csv
+import h5py
+import numpy as np
+from cyrsoxs_visualizer._stats import morphology_stats, main
+from cyrsoxs_visualizer import _morphology
+from cyrsoxs_visualizer._writer import write_morphology
+
+
+def _write_morphology(path, phi, s):
+    """Writes the materials with the plugin's writer, which adds vacuum"""
+    write_morphology(path, [(p, {'name': f'Mat_{i+1}_unaligned', 'metadata': {'alignment': a}}, 'image')
+                            for i, (p, a) in enumerate(zip(phi, s))])
+
+
+def test_morphology_stats(tmp_path, monkeypatch):
+    # force several slabs
+    monkeypatch.setattr(_morphology, 'SLAB_BYTES', 1)
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    phi = [np.random.rand(4, 6, 5).astype(np.float32)*0.3 for _ in range(2)]
+    s = [np.zeros((4, 6, 5, 3), dtype=np.float32) for _ in range(2)]
+    # material 2 is aligned along z in half the voxels, magnitude 0.25
+    s[1][:2, ..., 0] = 0.25
+    _write_morphology(my_test_file, phi, s)
+
+    rows = morphology_stats(my_test_file, bins=4)
+    # and the vacuum the writer adds
+    assert [row['material'] for row in rows] == [1, 2, 3]
+    np.testing.assert_allclose(rows[0]['volume_fraction'], phi[0].mean(), rtol=1e-6)
+    np.testing.assert_allclose(rows[1]['volume_fraction'], phi[1].mean() + 0.125, rtol=1e-6)
+    np.testing.assert_allclose(rows[1]['aligned_fraction'], 0.125)
+    total = phi[0] + phi[1] + np.where(s[1][..., 0] > 0, 0.25, 0)
+    np.testing.assert_allclose(rows[2]['volume_fraction'], 1 - total.mean(), rtol=1e-6)
+    # the composition sum of a valid file is 1 everywhere
+    for name in ('composition_min', 'composition_mean', 'composition_max'):
+        np.testing.assert_allclose(rows[0][name], 1, rtol=1e-6)
+
+    assert [rows[1][f'magnitude_hist_{b}'] for b in range(4)] == [0.5, 0.5, 0, 0]
+    assert [rows[1][f'theta_hist_{b}'] for b in range(4)] == [1, 0, 0, 0]
+    assert rows[0]['theta_hist_0'] == 0
+
+
+def test_stats_cli(tmp_path):
+    paths = []
+    for n in range(3):
+        path = str(tmp_path / f"myfile_{n}.hdf5")
+        _write_morphology(path, [np.full((2, 4, 4), 0.1*n)], [np.zeros((2, 4, 4, 3))])
+        paths.append(path)
+    output = str(tmp_path / "stats.csv")
+    assert main(paths + ['-o', output, '-j', '2']) == 0
+
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    # material 1 and vacuum of each file
+    assert [row['file'] for row in rows] == [path for path in paths for _ in range(2)]
+    np.testing.assert_allclose([float(row['volume_fraction']) for row in rows],
+                               [0, 1, 0.1, 0.9, 0.2, 0.8])
+
+    # a malformed file is skipped, keeping the others' rows
+    bad = str(tmp_path / "bad.hdf5")
+    with h5py.File(bad, 'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum', data=1)
+        f.create_dataset('vector_morphology/Mat_1_unaligned', data=np.zeros((2, 4, 4)))
+        f.create_dataset('vector_morphology/Mat_1_alignment', data=np.zeros((3, 4, 4, 3)))
+    assert main([bad, paths[1], '-o', output]) == 1
+    with open(output) as f:
+        assert [row['file'] for row in csv.DictReader(f)] == [paths[1]]*2
@@ -0,0 +1,82 @@
+import inspect
+import json
+import numpy as np
+import pytest
+from cyrsoxs_visualizer import _trace
+from cyrsoxs_visualizer._reader import read_hdf5
+import h5py
+
+
+@pytest.fixture
+def tracing():
+    _trace.reset()
+    _trace.enable()
+    yield
+    _trace.disable()
+    _trace.reset()
+
+
+def test_trace_off_records_nothing():
+    _trace.reset()
+    with _trace.span('nothing'):
+        _trace.count('bytes read', 10)
+    assert _trace.counters() == {}
+    assert _trace.summary().count('\n') == 0
+
+
+def test_traced_callbacks(tracing):
+    @_trace.traced('drag')
+    def drag(event):
+        yield
+        while event['type'] == 'mouse_move':
+            yield
+
+    # napari only runs generator functions as drag callbacks
+    assert inspect.isgeneratorfunction(drag)
+    event = {'type': 'mouse_press'}
+    steps = drag(event)
+    next(steps)
+    event['type'] = 'mouse_move'
+    next(steps)
+    next(steps)
+    event['type'] = 'mouse_release'
+    next(steps, None)
+    assert sum(_trace.latency_histograms()['drag']) == 4
+
+    @_trace.traced('click')
+    def click():
+        return 1
+    assert click() == 1
+    assert sum(_trace.latency_histograms()['click']) == 1
+
+
+def test_trace_reader(tracing, tmp_path):
+    my_test_file = str(tmp_path / "myfile.hd5")
+    phi = np.random.rand(2, 10, 10)
+    s = np.random.rand(2, 10, 10, 3)
+    with h5py.File(my_test_file,'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum',data=2)
+        f.create_dataset('vector_morphology/Mat_1_unaligned',data=phi)
+        f.create_dataset('vector_morphology/Mat_1_alignment',data=s)
+    read_hdf5(my_test_file, cache=False)
+
+    counters = _trace.counters()
+    assert counters['vectors emitted'] == 200
+    # the alignment field is streamed twice
+    assert counters['bytes read'] == phi.nbytes + 2*s.nbytes
+    assert 'read_hdf5' in _trace.summary()
+
+    # mapped datasets are counted once, when mapped
+    _trace.reset()
+    read_hdf5(my_test_file, cache=False, mmap=True)
+    counters = _trace.counters()
+    assert counters['bytes mapped'] == phi.nbytes + s.nbytes
+    assert 'bytes read' not in counters
+
+    trace_file = str(tmp_path / "trace.json")
+    _trace.dump(trace_file)
+    with open(trace_file) as f:
+        trace = json.load(f)
+    names = {event['name'] for event in trace['traceEvents']}
+    assert {'read_hdf5', 'read unaligned', 'fill vectors'} <= names
+    assert trace['otherData']['counters'] == counters
@@ -1,7 +1,87 @@
-# from cyrsoxs_visualizer import napari_get_writer, napari_write_image
+import numpy as np
+from cyrsoxs_visualizer import napari_get_writer
+from cyrsoxs_visualizer._reader import read_hdf5, alignment_to_vectors
+from cyrsoxs_visualizer._writer import write_morphology
+from cyrsoxs_visualizer import _morphology
 
-# add your tests here...
 
+def test_get_writer():
+    assert napari_get_writer("fake.hdf5", ["image", "vectors"]) is not None
+    assert napari_get_writer("fake.hdf5", ["labels"]) is None
+    assert napari_get_writer("fake.tif", ["image"]) is None
 
-def test_something():
-    pass
+
+def test_writer_round_trip(tmp_path, monkeypatch):
+    # force several slabs
+    monkeypatch.setattr(_morphology, 'SLAB_BYTES', 1)
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    phi = [np.random.rand(4, 10, 12).astype(np.float32) for _ in range(2)]
+    s = np.random.rand(4, 10, 12, 3).astype(np.float32)
+    s[np.random.rand(4, 10, 12) > 0.5] = 0
+    layer_data = [
+        (phi[1], {'name': 'Mat_2_unaligned'}, 'image'),
+        (phi[0], {'name': 'Mat_1_unaligned'}, 'image'),
+        (alignment_to_vectors(s), {'name': 'Mat_2_alignment'}, 'vectors'),
+    ]
+    stats = write_morphology(my_test_file, layer_data, chunks=(1, 5, 6))
+    # two materials and vacuum
+    assert stats.nbytes == 3*(phi[0].nbytes + s.nbytes)
+    assert stats.file_size > 0
+
+    layer_data_list = read_hdf5(my_test_file, cache=False)
+    names = [meta['name'] for _, meta, _ in layer_data_list]
+    assert names == ['Mat_1_unaligned', 'Mat_2_unaligned', 'Mat_2_alignment']
+    np.testing.assert_array_equal(layer_data_list[0][0], phi[0])
+    np.testing.assert_array_equal(layer_data_list[1][0], phi[1])
+    np.testing.assert_array_equal(layer_data_list[2][0], alignment_to_vectors(s))
+
+    # vacuum is stored as material 3 and counted in igormaterialnum
+    import h5py
+    from cyrsoxs_visualizer._reader import material_datasets
+    with h5py.File(my_test_file, 'r') as f:
+        assert f['igor_parameters/igormaterialnum'][()] == 3
+        (_, _), (_, _), (vacuum, vacuum_s) = material_datasets(f, vacuum=True)
+        expected = 1 - phi[0] - phi[1] - np.linalg.norm(s, axis=-1)
+        np.testing.assert_allclose(vacuum[()], expected, rtol=1e-5, atol=1e-6)
+        assert not vacuum_s[()].any()
+
+
+def test_writer_overwrites_mapped_file(tmp_path):
+    import h5py
+    my_test_file = str(tmp_path / "myfile.hdf5")
+    phi = np.random.rand(4, 10, 12)
+    with h5py.File(my_test_file, 'w') as f:
+        f.create_dataset('igor_parameters/igormaterialnum', data=2)
+        f.create_dataset('vector_morphology/Mat_1_unaligned', data=phi)
+        f.create_dataset('vector_morphology/Mat_1_alignment', data=np.zeros((4, 10, 12, 3)))
+    layers = read_hdf5(my_test_file, cache=False, mmap=True)
+    assert isinstance(layers[0][0], np.memmap)
+
+    # saving over the file the layer is mapped from keeps the map valid
+    write_morphology(my_test_file, [(layers[0][0][::-1], layers[0][1], 'image')])
+    np.testing.assert_array_equal(layers[0][0], phi)
+    np.testing.assert_allclose(read_hdf5(my_test_file, cache=False)[0][0], phi[::-1], rtol=1e-6)
+    assert [p.name for p in tmp_path.iterdir()] == ["myfile.hdf5"]
+
+
+def test_save_morphology_widget(tmp_path, qtbot):
+    from magicgui import magicgui
+    from napari.components import ViewerModel
+    from cyrsoxs_visualizer._function import save_morphology
+
+    my_test_file = tmp_path / "myfile.hdf5"
+    phi = [np.random.rand(3, 6, 5).astype(np.float32)*0.5 for _ in range(2)]
+    s = np.random.rand(3, 6, 5, 3).astype(np.float32)*0.1
+    viewer = ViewerModel()
+    viewer.add_image(phi[0], name='Mat_1_unaligned')
+    viewer.add_image(phi[1], name='Mat_2_unaligned')
+    viewer.add_vectors(alignment_to_vectors(s), name='Mat_1_alignment')
+    viewer.add_image(np.zeros((3, 6, 5)), name='scratch')
+    widget = magicgui(save_morphology)
+    widget.path.value = my_test_file
+    widget(viewer)
+
+    layers = read_hdf5(str(my_test_file), cache=False)
+    assert [meta['name'] for _, meta, _ in layers] == ['Mat_1_unaligned', 'Mat_1_alignment',
+                                                       'Mat_2_unaligned']
+    np.testing.assert_allclose(layers[0][0], phi[0])
@@ -0,0 +1,206 @@
+"""
+Timing spans, counters and callback latency histograms.
+
+Tracing is off unless the ``CYRSOXS_TRACE`` environment variable is set or
+``enable`` is called. When off, ``span`` returns a shared no-op context
+manager, ``count`` returns immediately and ``traced`` callbacks only pay
+one flag check. When on, every span becomes a Chrome trace event, which
+can be saved with ``dump`` and opened in chrome://tracing or Perfetto.
+
+``CYRSOXS_TRACE`` may be set to the path of the trace file, which is then
+written when the process exits, or to ``1`` to collect without saving.
+
+Usage::
+
+    with span('read unaligned', material=1):
+        ...
+    count('bytes read', block.nbytes)
+
+    @traced('LineProfiler.profile_lines')
+    def profile_lines(self):
+        ...
+"""
+import atexit
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+TRACE_ENV = 'CYRSOXS_TRACE'
+# upper edges of the latency histogram buckets, in ms; the last bucket is open
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 16, 33, 50, 100, 200, 500, 1000)
+
+_enabled = False
+_events = []
+_counters = defaultdict(float)
+_latencies = defaultdict(lambda: np.zeros(len(LATENCY_BUCKETS_MS) + 1, dtype=np.int64))
+_lock = threading.Lock()
+_start_ns = time.perf_counter_ns()
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Drops every recorded event, counter and histogram"""
+    with _lock:
+        _events.clear()
+        _counters.clear()
+        _latencies.clear()
+
+
+def _now_us():
+    return (time.perf_counter_ns() - _start_ns)/1000
+
+
+def _record(name, start_us, end_us, args):
+    event = {'name': name, 'ph': 'X', 'ts': start_us, 'dur': end_us - start_us,
+             'pid': os.getpid(), 'tid': threading.get_ident()}
+    if args:
+        event['args'] = args
+    _events.append(event)
+
+
+@contextlib.contextmanager
+def _span(name, args):
+    start = _now_us()
+    try:
+        yield
+    finally:
+        _record(name, start, _now_us(), args)
+
+
+def span(name, **args):
+    """Context manager timing the enclosed block as the trace event ``name``"""
+    if not _enabled:
+        return _NULL_SPAN
+    return _span(name, args)
+
+
+def count(name, value=1):
+    """Adds ``value`` to the counter ``name``"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += value
+        total = _counters[name]
+    _events.append({'name': name, 'ph': 'C', 'ts': _now_us(), 'pid': os.getpid(),
+                    'args': {name: total}})
+
+
+def _observe(name, start_us, end_us):
+    _record(name, start_us, end_us, None)
+    bucket = np.searchsorted(LATENCY_BUCKETS_MS, (end_us - start_us)/1000)
+    with _lock:
+        _latencies[name][bucket] += 1
+
+
+def traced(name):
+    """Decorator timing each call of a callback and keeping its latency histogram
+
+    Generator callbacks, such as napari mouse drag callbacks, stay generator
+    functions, and each step (press, every move, release) is timed as one
+    event.
+    """
+    def decorate(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return (yield from func(*args, **kwargs))
+                steps = func(*args, **kwargs)
+                while True:
+                    start = _now_us()
+                    try:
+                        value = next(steps)
+                    except StopIteration as stop:
+                        _observe(name, start, _now_us())
+                        return stop.value
+                    _observe(name, start, _now_us())
+                    yield value
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return func(*args, **kwargs)
+                start = _now_us()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    _observe(name, start, _now_us())
+        return wrapper
+    return decorate
+
+
+def counters():
+    """Current value of every counter"""
+    with _lock:
+        return dict(_counters)
+
+
+def latency_histograms():
+    """Per-callback counts in each ``LATENCY_BUCKETS_MS`` bucket, plus the open one"""
+    with _lock:
+        return {name: counts.tolist() for name, counts in _latencies.items()}
+
+
+def summary():
+    """Total and mean duration and call count of each span, slowest first"""
+    totals = defaultdict(lambda: [0.0, 0])
+    for event in list(_events):
+        if event['ph'] == 'X':
+            totals[event['name']][0] += event['dur']/1000
+            totals[event['name']][1] += 1
+    lines = [f"{'span':<40}{'calls':>8}{'total ms':>12}{'mean ms':>10}"]
+    for name, (total, calls) in sorted(totals.items(), key=lambda item: -item[1][0]):
+        lines.append(f'{name:<40}{calls:>8}{total:>12.1f}{total/calls:>10.2f}')
+    return '\n'.join(lines)
+
+
+def dump(path):
+    """Writes the recorded events as a Chrome trace JSON file
+
+    Counters and latency histograms are stored under ``otherData``.
+    """
+    trace = {
+        'traceEvents': list(_events),
+        'displayTimeUnit': 'ms',
+        'otherData': {
+            'counters': counters(),
+            'latency_buckets_ms': list(LATENCY_BUCKETS_MS),
+            'latency_histograms': latency_histograms(),
+        },
+    }
+    with open(path, 'w') as f:
+        # span arguments may be NumPy scalars
+        json.dump(trace, f, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+
+
+def _setup_from_env():
+    value = os.environ.get(TRACE_ENV, '')
+    if value in ('', '0'):
+        return
+    enable()
+    if value != '1':
+        atexit.register(dump, value)
+
+
+_setup_from_env()
@@ -1,20 +1,172 @@
 """
-This module is an example of a barebones writer plugin for napari
+This module is a writer plugin for napari that saves morphologies in the
+CyRSoXS hdf5 layout read by ``_reader.read_hdf5``.
 
-It implements the ``napari_get_writer`` and ``napari_write_image`` hook specifications.
+Its ``write_hdf5`` is returned by the ``napari_get_writer`` and
+``napari_write_image`` hooks in ``_hooks``, and called by the
+``save_morphology`` function widget, as npe2 doesn't convert the
+multi-layer ``napari_get_writer`` hook.
 see: https://napari.org/docs/dev/plugins/hook_specifications.html
-
-Replace code below according to your needs
 """
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+
+import numpy as np
+import h5py
+
+from ._trace import span, count
+from ._morphology import VectorField, vacuum_fraction, _slab_size
+
+logger = logging.getLogger(__name__)
+
+WriteStats = namedtuple('WriteStats', ['nbytes', 'file_size', 'seconds', 'throughput'])
+
+
+def write_hdf5(path, layer_data):
+    """napari writer function, see ``write_morphology``
+
+    Returns
+    -------
+    list of str
+        The written path.
+    """
+    stats = write_morphology(path, layer_data)
+    logger.info('wrote %s: %.1f MB in %.2f s (%.1f MB/s), %.1f MB on disk',
+                path, stats.nbytes/1e6, stats.seconds, stats.throughput/1e6,
+                stats.file_size/1e6)
+    return [path]
+
+
+def _material_number(name):
+    match = re.match(r'Mat_(\d+)', name or '')
+    return int(match.group(1)) if match else None
+
+
+def _group_materials(layer_data):
+    """Maps material number to its (image data, alignment source) pair
+
+    Images named ``Mat_N_...`` are ordered by N, other images follow in
+    layer order, and materials are then renumbered from 1. Alignment comes
+    from a vectors layer named ``Mat_N_...``, or else from the image's
+    ``metadata['alignment']``.
+    """
+    images = [(data, meta) for data, meta, layer_type in layer_data if layer_type == 'image']
+    vectors = {_material_number(meta.get('name')): data
+               for data, meta, layer_type in layer_data if layer_type == 'vectors'}
+
+    materials = {}
+    unnumbered = []
+    for data, meta in images:
+        if meta.get('multiscale'):
+            data = data[0]
+        number = _material_number(meta.get('name'))
+        alignment = vectors.get(number, meta.get('metadata', {}).get('alignment'))
+        if number is None or number in materials:
+            unnumbered.append((data, alignment))
+        else:
+            materials[number] = (data, alignment)
+    ordered = [materials[number] for number in sorted(materials)] + unnumbered
+    return {i+1: material for i, material in enumerate(ordered)}
+
+
+def _write_field(dset, field):
+    """Streams an array-like into ``dset`` one Z-slab at a time"""
+    slab = _slab_size(dset.shape, dset.dtype.itemsize)
+    for z0 in range(0, dset.shape[0], slab):
+        dset[z0:z0+slab] = np.asarray(field[z0:z0+slab], dtype=dset.dtype)
+
+
+def _write_vectors(dset, vectors):
+    """Scatters (N,2,D) napari vectors into a (Z,Y,X,D) dataset slab by slab"""
+    _write_field(dset, VectorField(vectors, dset.shape[:-1]))
+
+
+def write_morphology(path, layer_data, dtype=np.float32, chunks=None,
+                     compression='gzip', compression_opts=4):
+    """Writes image and vectors layers as a CyRSoXS morphology
+
+    Each image layer becomes a ``vector_morphology/Mat_N_unaligned`` dataset
+    and its alignment a ``Mat_N_alignment`` dataset. The data is streamed
+    one Z-slab at a time, so lazy layers are never loaded in full.
 
-from napari_plugin_engine import napari_hook_implementation
+    Vacuum is written as one more material, ``Mat_{N+1}``, with the
+    fraction left over by the others, ``1 - sum of fractions``, and no
+    alignment, and ``igormaterialnum`` counts it: N materials are stored as
+    ``igormaterialnum = N + 1``, the convention ``read_hdf5`` reads.
 
+    Parameters
+    ----------
+    path : str
+        Output hdf5 file.
+    layer_data : list of tuples
+        (data, meta, layer_type) tuples, as passed to napari writers. All
+        image layers must have the same 3D shape.
+    dtype : numpy dtype
+        dtype of the written datasets.
+    chunks : tuple of int, optional
+        (Z,Y,X) HDF5 chunk shape. Defaults to one plane, tiled at 256 pixels.
+    compression : str or None
+        h5py compression filter, e.g. 'gzip', 'lzf' or None.
+    compression_opts : int, optional
+        Compression level for 'gzip'.
 
-@napari_hook_implementation
-def napari_get_writer():
-    pass
+    Returns
+    -------
+    stats : WriteStats
+        Uncompressed bytes written, file size, elapsed seconds and
+        throughput in bytes per second.
+    """
+    materials = _group_materials(layer_data)
+    if not materials:
+        raise ValueError('No image layers to write')
+    shapes = {tuple(data.shape) for data, _ in materials.values()}
+    if len(shapes) != 1:
+        raise ValueError(f'Material images have different shapes: {shapes}')
+    (shape,) = shapes
+    if chunks is None:
+        chunks = (1,) + tuple(min(n, 256) for n in shape[1:])
+    chunks = tuple(chunks)
+    if compression != 'gzip':
+        compression_opts = None
+    options = dict(dtype=dtype, compression=compression, compression_opts=compression_opts)
 
+    start = time.perf_counter()
+    # written next to ``path`` and moved over it, so arrays memory mapped
+    # from an older ``path`` keep reading the old file
+    partial = f'{path}.{os.getpid()}.partial'
+    try:
+        with h5py.File(partial, 'w') as h5, span('write_morphology', path=str(path)):
+            vacuum = max(materials) + 1
+            h5.create_dataset('igor_parameters/igormaterialnum', data=vacuum)
+            written = []
+            for number, (data, alignment) in materials.items():
+                phi = h5.create_dataset(f'vector_morphology/Mat_{number}_unaligned', shape=shape,
+                                        chunks=chunks, **options)
+                _write_field(phi, data)
+                s = h5.create_dataset(f'vector_morphology/Mat_{number}_alignment', shape=shape + (3,),
+                                      chunks=chunks + (3,), fillvalue=0, **options)
+                # without alignment the chunks stay unwritten and read back as zeros
+                if alignment is not None and np.ndim(alignment) == 3:
+                    _write_vectors(s, alignment)
+                elif alignment is not None:
+                    _write_field(s, alignment)
+                written.append((phi, s))
+            # vacuum, slab by slab from the written materials, without alignment
+            phi = h5.create_dataset(f'vector_morphology/Mat_{vacuum}_unaligned', shape=shape,
+                                    chunks=chunks, **options)
+            vacuum_fraction(written, out=phi)
+            s = h5.create_dataset(f'vector_morphology/Mat_{vacuum}_alignment', shape=shape + (3,),
+                                  chunks=chunks + (3,), fillvalue=0, **options)
+            nbytes = sum(dset.size*dset.dtype.itemsize for pair in written + [(phi, s)] for dset in pair)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, path)
+    seconds = time.perf_counter() - start
+    count('bytes written', nbytes)
 
-@napari_hook_implementation
-def napari_write_image():
-    pass
+    return WriteStats(nbytes, os.path.getsize(path), seconds, nbytes/max(seconds, 1e-9))